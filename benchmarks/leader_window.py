@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# the ont leader search over the whole read against the search in the 5' window (--leader-margin), on the same reads
+#
+#   python benchmarks/leader_window.py tests/ont/reads.bam
+#   python benchmarks/leader_window.py --simulate 5000 --margins 0,20,40
+#
+# every read the classifier searches (leader_score_needed) is aligned to the leader over the whole read and over the
+# leading soft clip plus each margin, and classified with both scores. We report the time spent aligning, how many
+# scores changed and, what matters, how many reads changed class (with the reads that did, so they can be looked at).
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pysam
+
+dirname = os.path.dirname(os.path.abspath(__file__))
+root = os.path.abspath(os.path.join(dirname, ".."))
+leader = 'AACCAACTTTCGATCTCTTGTAGATCTGTTCT'
+
+
+def compare(bam, margins, score_cutoff, scheme):
+    """
+    :param bam: the aligned bam
+    :param margins: list of margins to compare to the whole read search
+    :param score_cutoff: cut-off for alignment score of leader
+    :param scheme: the compiled primer scheme
+    :return: (number of reads searched, seconds aligning the whole reads, dictionary of margin to its summary)
+    """
+    from periscope.scheme import Scheme
+    from periscope.scripts import search_for_sgRNA_ont as ont
+
+    orf_bed = list(ont.open_bed(os.path.join(root, "periscope", "resources", "orf_start.bed")))
+    primer_bed = Scheme(scheme)
+
+    searched = []
+    with pysam.AlignmentFile(bam) as f:
+        for read in f:
+            if read.seq is None or read.is_unmapped or read.is_supplementary or read.is_secondary:
+                continue
+            orf = ont.check_start(orf_bed, read)
+            amplicons = ont.find_amplicon(read, primer_bed)
+            if ont.leader_score_needed(read, orf, amplicons):
+                searched.append((read, orf, amplicons))
+
+    def run(margin):
+        start = time.perf_counter()
+        scores = [ont.search_reads(read, leader, margin)["align_score"] for read, _, _ in searched]
+        elapsed = time.perf_counter() - start
+        classes = [ont.classify_read(read, score, score_cutoff, orf, amplicons)
+                   for (read, orf, amplicons), score in zip(searched, scores)]
+        return elapsed, scores, classes
+
+    full_seconds, full_scores, full_classes = run(None)
+    summaries = {}
+    for margin in margins:
+        seconds, scores, classes = run(margin)
+        changed = [(read.query_name, full_score, score, full_class, read_class)
+                   for (read, _, _), full_score, score, full_class, read_class
+                   in zip(searched, full_scores, scores, full_classes, classes) if full_class != read_class]
+        summaries[margin] = dict(seconds=seconds,
+                                 scores_changed=sum(1 for a, b in zip(full_scores, scores) if a != b),
+                                 classes_changed=changed)
+    return len(searched), full_seconds, summaries
+
+
+def main(args):
+    workdir = None
+    bam = args.bam
+    if bam is None:
+        from periscope.simulate import simulate
+        workdir = tempfile.mkdtemp()
+        simulate(os.path.join(workdir, "sim"), args.simulate, technology="ont", seed=args.seed, error_rate=args.error_rate)
+        bam = os.path.join(workdir, "sim.bam")
+    try:
+        margins = [int(margin) for margin in args.margins.split(",")]
+        searched, full_seconds, summaries = compare(bam, margins, args.score_cutoff, args.scheme)
+    finally:
+        if workdir:
+            shutil.rmtree(workdir)
+
+    print("{} reads searched, whole read {:.1f} us/read".format(searched, full_seconds / max(searched, 1) * 1e6))
+    for margin, summary in summaries.items():
+        print("margin {:>4}  {:>8.1f} us/read  {:>5.1f}x  scores changed {:>6}  classes changed {:>6}".format(
+            margin, summary["seconds"] / max(searched, 1) * 1e6, full_seconds / max(summary["seconds"], 1e-9),
+            summary["scores_changed"], len(summary["classes_changed"])))
+        for query_name, full_score, score, full_class, read_class in summary["classes_changed"]:
+            print("    {} {} ({}) -> {} ({})".format(query_name, full_class, full_score, read_class, score))
+    return 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='periscope: compare the ont leader search over the whole read to the 5\' window')
+    parser.add_argument('bam', help='aligned ont bam, leave out to simulate reads', nargs='?', default=None)
+    parser.add_argument('--simulate', help='number of reads to simulate when no bam is given (5000)', type=int, default=5000)
+    parser.add_argument('--seed', help='simulation seed (1)', type=int, default=1)
+    parser.add_argument('--error-rate', dest='error_rate', help='simulated sequencing error rate (0.05)', type=float, default=0.05)
+    parser.add_argument('--margins', help='comma separated margins to compare (0,10,20,40,80)', default="0,10,20,40,80")
+    parser.add_argument('--score-cutoff', dest='score_cutoff', help='cut-off for alignment score of leader (50)', type=int, default=50)
+    parser.add_argument('--scheme', help='compiled primer scheme', default=os.path.join(root, "periscope", "resources", "schemes", "artic_V3.pscheme"))
+
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# macro-benchmark of the counting stage on simulated reads (periscope.simulate), at increasing read counts
+#
+#   python benchmarks/macro.py --technology illumina --sizes 10000,100000 --threads 4
+#
+# each size is simulated once into the work directory (and reused after that), then counted in a fresh python process
+# so peak memory is per size. For every size we report reads/s and peak memory per stage from the run metrics, and
+# how close the counts are to the simulated truth, so a change can be checked for speed and accuracy together.
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+import time
+
+default_sizes = "10000,100000,1000000,10000000"
+
+
+def simulate(workdir, technology, size, artic_primers, seed, threads):
+    """
+    simulate size reads, unless they were simulated before
+    :return: the simulated prefix
+    """
+    from periscope.simulate import simulate as simulate_reads
+
+    prefix = os.path.join(workdir, "sim_{}_{}_{}_{}".format(technology, artic_primers, size, seed))
+    if not os.path.exists(prefix + "_truth.json"):
+        start = time.time()
+        simulate_reads(prefix, size, technology=technology, artic_primers=artic_primers, seed=seed, threads=threads)
+        print("simulated {} {} reads in {:.1f}s".format(size, technology, time.time() - start), file=sys.stderr)
+    return prefix
+
+
+def count(bam, output_prefix, technology, artic_primers, threads):
+    """
+    run the counting stage on bam in a new interpreter
+    :return: the run metrics
+    """
+    code = "import periscope; periscope.run(bam={!r}, technology={!r}, output_prefix={!r}, artic_primers={!r}, threads={})".format(
+        bam, technology, output_prefix, artic_primers, threads)
+    subprocess.run([sys.executable, "-c", code], check=True)
+    with open(output_prefix + "_periscope_metrics.json") as f:
+        return json.load(f)
+
+
+def observed_counts(output_prefix, technology):
+    """
+    the sgRNA counts periscope called, per ORF and per novel junction
+    """
+    observed = {}
+    for file in [output_prefix + "_periscope_counts.csv", output_prefix + "_periscope_novel_counts.csv"]:
+        with open(file) as f:
+            for row in csv.DictReader(f):
+                if technology == "illumina":
+                    observed[row["orf"]] = int(row["sgRNA_count"])
+                elif "novel" in row["orf"]:
+                    observed[row["orf"]] = int(row["nsgRNA_HQ_count"]) + int(row["nsgRNA_LQ_count"])
+                else:
+                    observed[row["orf"]] = int(row["sgRNA_HQ_count"]) + int(row["sgRNA_LQ_count"])
+    return {orf: n for orf, n in observed.items() if n}
+
+
+def accuracy(truth, observed):
+    """
+    compare the called sgRNA counts to the truth
+    :return: dictionary of recall, precision and the absolute error summed over ORFs
+    """
+    expected = dict(truth["sgRNA"], **truth["nsgRNA"])
+    agreed = sum(min(n, observed.get(orf, 0)) for orf, n in expected.items())
+    total_observed = sum(observed.values())
+    return dict(
+        expected=sum(expected.values()),
+        observed=total_observed,
+        recall=agreed / sum(expected.values()) if expected else None,
+        precision=agreed / total_observed if total_observed else None,
+        absolute_error=sum(abs(expected.get(orf, 0) - observed.get(orf, 0)) for orf in set(expected) | set(observed))
+    )
+
+
+def summarise(size, metrics):
+    # reads/s and peak memory per stage, peak memory includes any waited for children (the classification workers)
+    stages = []
+    for stage in metrics["stages"]:
+        peaks = [peak for peak in [stage.get("peak_rss_bytes"), stage.get("peak_rss_children_bytes")] if peak]
+        stages.append(dict(
+            name=stage["name"],
+            wall_seconds=stage["wall_seconds"],
+            reads_per_second=size / stage["wall_seconds"] if stage["wall_seconds"] else None,
+            peak_rss_bytes=max(peaks) if peaks else None
+        ))
+    return stages
+
+
+def main(args):
+    sizes = [int(size) for size in args.sizes.split(",")]
+    os.makedirs(args.workdir, exist_ok=True)
+
+    report = dict(technology=args.technology, artic_primers=args.artic_primers, threads=args.threads, seed=args.seed, sizes=[])
+    for size in sizes:
+        prefix = simulate(args.workdir, args.technology, size, args.artic_primers, args.seed, args.threads)
+        with open(prefix + "_truth.json") as f:
+            truth = json.load(f)
+
+        output_prefix = prefix + "_out"
+        start = time.time()
+        metrics = count(prefix + ".bam", output_prefix, args.technology, args.artic_primers, args.threads)
+        wall_seconds = time.time() - start
+
+        result = dict(
+            reads=size,
+            records=truth["records"],
+            wall_seconds=wall_seconds,
+            reads_per_second=size / wall_seconds,
+            stages=summarise(size, metrics),
+            workers=metrics["workers"],
+            accuracy=accuracy(truth, observed_counts(output_prefix, args.technology))
+        )
+        report["sizes"].append(result)
+
+        print("{:>10} reads  {:>10.0f} reads/s  recall {:.4f}  precision {:.4f}".format(
+            size, result["reads_per_second"], result["accuracy"]["recall"] or 0, result["accuracy"]["precision"] or 0))
+        for stage in result["stages"]:
+            print("    {:<16} {:>9.2f}s {:>12.0f} reads/s {:>9.1f} MB".format(
+                stage["name"], stage["wall_seconds"], stage["reads_per_second"] or 0, (stage["peak_rss_bytes"] or 0) / 1e6))
+
+    output = args.output or os.path.join(args.workdir, "macro_{}.json".format(args.technology))
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+    print("report written to " + output)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='periscope: benchmark the counting stage on simulated reads')
+    parser.add_argument('--technology', help='the sequencing technology to simulate', choices=['ont', 'illumina'], default='ont')
+    parser.add_argument('--sizes', help='comma separated read counts (read pairs for illumina)', default=default_sizes)
+    parser.add_argument('--artic-primers', dest='artic_primers', help='bundled artic primer scheme', default='V3')
+    parser.add_argument('-t', '--threads', dest='threads', help='number of threads used for sgRNA counting', type=int, default=1)
+    parser.add_argument('--seed', help='random seed', type=int, default=1)
+    parser.add_argument('--workdir', help='where simulated reads and outputs are kept', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "work"))
+    parser.add_argument('--output', help='the json report, defaults to <WORKDIR>/macro_<TECHNOLOGY>.json', default=None)
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# micro-benchmarks of the functions that run once per read, compared to stored baselines
+#
+#   python benchmarks/micro.py                 # compare to benchmarks/micro_baselines.json, exit 1 on a regression
+#   python benchmarks/micro.py --save          # record new baselines (do this on the machine you compare on)
+#
+# every primitive runs over fixed corpora: the hand curated test reads and reads from the simulator with a fixed seed.
+# Each benchmark is timed over the whole corpus (several passes for the small ones) --repeat times and the fastest round
+# is kept, which is the least noisy estimate of the cost per read. A primitive more than --threshold percent slower
+# than its baseline is a regression.
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import pysam
+
+dirname = os.path.dirname(os.path.abspath(__file__))
+root = os.path.abspath(os.path.join(dirname, ".."))
+default_baselines = os.path.join(dirname, "micro_baselines.json")
+
+# the corpora are fixed so baselines stay comparable, change these and the baselines need saving again
+simulated = dict(ont=dict(reads=2000, seed=1, error_rate=0.02), illumina=dict(reads=1000, seed=1, error_rate=0.005))
+leader = 'AACCAACTTTCGATCTCTTGTAGATCTGTTCT'
+
+
+def classifiable(reads):
+    # the reads process_reads looks at
+    return [read for read in reads if read.seq is not None and not read.is_unmapped and not read.is_supplementary and not read.is_secondary]
+
+
+def load_corpora(workdir):
+    """
+    :param workdir: where the simulated reads are written
+    :return: dictionary of corpus name to (header, list of pysam reads)
+    """
+    from periscope.simulate import simulate
+
+    files = {
+        "ont_test": os.path.join(root, "tests", "ont", "reads.sam"),
+        "illumina_test": os.path.join(root, "tests", "illumina", "reads.sam"),
+    }
+    for technology, settings in simulated.items():
+        prefix = os.path.join(workdir, "sim_" + technology)
+        simulate(prefix, settings["reads"], technology=technology, seed=settings["seed"], error_rate=settings["error_rate"])
+        files[technology + "_sim"] = prefix + ".bam"
+
+    corpora = {}
+    for name, file in files.items():
+        with pysam.AlignmentFile(file) as f:
+            corpora[name] = (f.header, classifiable(list(f)))
+    return corpora
+
+
+def have_artic():
+    try:
+        import artic
+    except ImportError:
+        return False
+    return True
+
+
+def benchmarks(corpora, resources):
+    """
+    the benchmarks, each is (name, corpus, function run once per read, setup) where setup is called once with the
+    corpus reads and returns the per read arguments, None if a dependency is missing
+    """
+    from periscope.scripts import search_for_sgRNA_ont as ont
+    from periscope.scripts import search_for_sgRNA_illumina as illumina
+
+    orf_bed = list(ont.open_bed(os.path.join(resources, "orf_start.bed")))
+    primer_bed = None
+    if have_artic():
+        from artic.vcftagprimersites import read_bed_file
+        primer_bed = read_bed_file(os.path.join(resources, "artic_primers_V3.bed"))
+
+    def amplicon_args(reads):
+        return [(read, primer_bed) for read in reads]
+
+    def classify_args(reads):
+        args = []
+        for read in reads:
+            score = ont.search_reads(read, leader)["align_score"]
+            args.append((read, score, 50, ont.check_start(orf_bed, read), ont.find_amplicon(read, primer_bed)))
+        return args
+
+    def write_args(header):
+        def setup(reads):
+            outbamfile = pysam.AlignmentFile(os.devnull, "wb", header=header)
+            return [(outbamfile, read) for read in reads]
+        return setup
+
+    def tag_and_write(outbamfile, read):
+        ont.tag_read(read, 60.0, 71, "sgRNA_HQ", "N")
+        outbamfile.write(read)
+
+    for corpus in ["ont_test", "ont_sim"]:
+        header, reads = corpora[corpus]
+        yield "search_reads", corpus, ont.search_reads, lambda reads: [(read, leader) for read in reads]
+        yield "search_reads_window", corpus, ont.search_reads, lambda reads: [(read, leader, ont.default_leader_margin) for read in reads]
+        yield "check_start_ont", corpus, ont.check_start, lambda reads: [(orf_bed, read) for read in reads]
+        yield "find_amplicon", corpus, ont.find_amplicon, amplicon_args if primer_bed else None
+        yield "classify_read", corpus, ont.classify_read, classify_args if primer_bed else None
+        yield "tag_and_write_ont", corpus, tag_and_write, write_args(header)
+
+    for corpus in ["illumina_test", "illumina_sim"]:
+        header, reads = corpora[corpus]
+        yield "extact_soft_clipped_bases", corpus, illumina.extact_soft_clipped_bases, lambda reads: [(read,) for read in reads]
+        yield "check_start_illumina", corpus, illumina.check_start, lambda reads: [(read, True, orf_bed) for read in reads]
+
+
+def time_benchmark(function, args, repeat, min_time):
+    """
+    :return: the fastest round in seconds per call
+    """
+    # an untimed pass to warm up imports and caches, it also sets how many passes over the corpus make up a round so
+    # that small corpora aren't timed over a few microseconds
+    start = time.perf_counter()
+    for arg in args:
+        function(*arg)
+    passes = max(1, int(min_time / max(time.perf_counter() - start, 1e-9)))
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(passes):
+            for arg in args:
+                function(*arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / (len(args) * passes)
+
+
+def main(args):
+    resources = os.path.join(root, "periscope", "resources")
+    workdir = tempfile.mkdtemp()
+    try:
+        corpora = load_corpora(workdir)
+        results = {}
+        skipped = []
+        for name, corpus, function, setup in benchmarks(corpora, resources):
+            key = name + ":" + corpus
+            if args.only and name not in args.only:
+                continue
+            if setup is None:
+                skipped.append(key)
+                continue
+            results[key] = time_benchmark(function, setup(corpora[corpus][1]), args.repeat, args.min_time)
+    finally:
+        shutil.rmtree(workdir)
+
+    if skipped:
+        print("skipped (artic not installed): " + ", ".join(skipped), file=sys.stderr)
+
+    if args.save:
+        baselines = dict(python=platform.python_version(), machine=platform.machine(), processor=platform.processor(),
+                         seconds_per_read=results)
+        with open(args.baselines, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        for key, seconds in sorted(results.items()):
+            print("{:<50} {:>10.2f} us/read".format(key, seconds * 1e6))
+        print("baselines written to " + args.baselines)
+        return 0
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)["seconds_per_read"]
+
+    regressions = []
+    for key, seconds in sorted(results.items()):
+        baseline = baselines.get(key)
+        if baseline is None:
+            print("{:<50} {:>10.2f} us/read  (no baseline)".format(key, seconds * 1e6))
+            continue
+        change = (seconds - baseline) / baseline * 100
+        flag = ""
+        if change > args.threshold:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print("{:<50} {:>10.2f} us/read  baseline {:>10.2f}  {:>+7.1f}%{}".format(key, seconds * 1e6, baseline * 1e6, change, flag))
+
+    if regressions:
+        print("{} primitive(s) more than {}% slower than baseline: {}".format(len(regressions), args.threshold, ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='periscope: micro-benchmarks of the per read classification functions')
+    parser.add_argument('--baselines', help='baseline json file', default=default_baselines)
+    parser.add_argument('--save', help='save the results as the new baselines', action='store_true')
+    parser.add_argument('--threshold', help='percentage slow down flagged as a regression (20)', type=float, default=20.0)
+    parser.add_argument('--repeat', help='timed rounds per benchmark, the fastest is kept (15)', type=int, default=15)
+    parser.add_argument('--min-time', dest='min_time', help='minimum seconds per timed round (0.1)', type=float, default=0.1)
+    parser.add_argument('--only', help='only run these benchmarks', nargs='+', default=None)
+
+    args = parser.parse_args()
+    sys.exit(main(args))
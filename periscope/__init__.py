@@ -1,3 +1,12 @@
 _program = "periscope"
 __version__ = "0.1.3"
 
+
+def run(*args, **kwargs):
+    """
+    run periscope on a sample, see periscope.runner.run for the arguments. The runner is imported on the first call so
+    that importing the package (setup.py reads __version__) stays cheap and loads nothing else
+    :return: a periscope.runner.PeriscopeResult
+    """
+    from periscope.runner import run
+    return run(*args, **kwargs)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# aligned reads as BAM or CRAM
+#
+# CRAM stores reads as their differences to the reference, a sample's aligned and tagged reads take about a third of
+# the space of the BAM. The format of a file is taken from its extension (.cram), CRAMs are written against and read
+# with the bundled nCoV-2019.reference.fasta, which has to be the reference the reads were aligned to. pysam decodes
+# and encodes with --io-threads threads per open file.
+#
+# the classification reads either format through the same chunks (periscope.chunks). A BAM chunk is a range of BGZF
+# virtual offsets, CRAM can't seek to a record so its chunks are coordinate ranges read through the .crai index.
+import os
+
+import pysam
+
+output_formats = ["bam", "cram"]
+
+
+def is_cram(path):
+    """
+    :param path: an alignment file
+    :return: whether it is a CRAM, by its extension
+    """
+    return path.endswith(".cram")
+
+
+def extension(output_format):
+    """
+    :param output_format: bam or cram
+    :return: the file extension, .bam or .cram
+    """
+    if output_format not in output_formats:
+        raise ValueError("{} is not a supported output format, use bam or cram".format(output_format))
+    return "." + output_format
+
+
+def index_path(path):
+    """
+    :param path: a coordinate sorted BAM or CRAM
+    :return: its index, <PATH>.bai or <PATH>.crai
+    """
+    return path + (".crai" if is_cram(path) else ".bai")
+
+
+def default_reference():
+    # the bundled reference, the reads are always aligned to it
+    return os.path.join(os.path.dirname(__file__), "resources", "nCoV-2019.reference.fasta")
+
+
+def open_alignments(path, mode="r", reference=None, threads=1, header=None, compression=None):
+    """
+    open a BAM or CRAM for reading or writing
+
+    :param path: the file, CRAM when it ends in .cram
+    :param mode: r or w
+    :param reference: the reference fasta CRAMs are encoded against, the bundled reference when None
+    :param threads: pysam compression/decompression threads
+    :param header: the header, when writing
+    :param compression: compression level 0-9 when writing, the htslib default when None
+    :return: pysam.AlignmentFile
+    """
+    options = dict(threads=max(1, int(threads or 1)))
+    if is_cram(path):
+        options["reference_filename"] = reference or default_reference()
+    if header is not None:
+        options["header"] = header
+    if mode[0] == "w" and compression is not None:
+        # pysam only takes the level 0 in the mode, others are passed to htslib as an option
+        options["format_options"] = [("level=" + str(int(compression))).encode()]
+    mode = mode[0] + ("c" if is_cram(path) else "b")
+    return pysam.AlignmentFile(path, mode, **options)
+
+
+def samtools_options(path, reference=None, output=False):
+    """
+    the samtools options to read (or, with output, write) path in its format
+    :param path: the file samtools reads or writes
+    :param reference: the reference fasta CRAMs are encoded against, the bundled reference when None
+    :param output: samtools writes path
+    :return: list of samtools arguments
+    """
+    if not is_cram(path):
+        return ["--output-fmt", "BAM"] if output else []
+    if output:
+        return ["--output-fmt", "CRAM", "--reference", reference or default_reference()]
+    return ["--input-fmt-option", "reference=" + (reference or default_reference())]
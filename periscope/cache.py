@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# content addressed cache of aligned bams and results, so a sample submitted again is not realigned or reclassified
+#
+# entries are keyed on a sha256 of what they were computed from, the contents of the input files rather than their
+# names or times:
+#
+#   alignment   the fastqs, the reference, the technology (mapper settings), bam or cram and the periscope version
+#   results     the aligned bam (its alignment key, or the contents of a bam given as input), the sample id (every
+#               row of the tables carries it), the primer, amplicon and ORF beds, --score-cutoff, --target-precision,
+#               --leader-margin (ont), the technology and the periscope version, the --columnar format when the
+#               tables are written, and for ont the --tagged-bam policy with the settings the tagged bam is written
+#               with (--grna-subsample, --xs-sentinel, --bam-compression and --output-format)
+#
+# so a changed score cutoff or primer scheme reuses the cached alignment and only reclassifies. Each entry is a
+# directory holding copies of the files and an entry.json, its modification time is the last use. Once the cache is
+# over its size limit the least recently used entries are removed.
+#
+#   <CACHE>/alignment/<KEY>/{.bam,.bam.bai,entry.json}          (.cram and .cram.crai for a cram)
+#   <CACHE>/results/<KEY>/{_periscope_counts.csv,...,_periscope.bam,entry.json}
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from periscope import __version__
+
+# the outputs cached for a run, the metrics and profiles are per run and never cached. The ont tagged bam is cached
+# with them unless --tagged-bam none
+result_outputs = ["counts", "novel_counts", "amplicons"]
+
+size_units = dict(K=1024, M=1024 ** 2, G=1024 ** 3, T=1024 ** 4)
+
+
+def parse_size(size):
+    """
+    :param size: a number of bytes, or a number followed by K, M, G or T (e.g. 20G)
+    :return: bytes as an int
+    """
+    text = str(size).strip().upper().rstrip("B")
+    if text and text[-1] in size_units:
+        return int(float(text[:-1]) * size_units[text[-1]])
+    return int(float(text))
+
+
+def json_default(value):
+    # numpy scalars in the tables (e.g. the median coverage)
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError("{} is not JSON serializable".format(type(value)))
+
+
+def cache_keys(technology, reference, primer_bed, amplicon_bed, orf_bed, score_cutoff, fastq=None, bam=None,
+               target_precision=None, leader_margin=None, output_format="bam", columnar=None, sample=None,
+               tagged_bam="full", grna_subsample=0.0, xs_sentinel=None, bam_compression=None):
+    """
+    the cache keys of a run, the input files are hashed so this reads all of them once
+
+    :param technology: ont or illumina
+    :param reference: the reference fasta
+    :param primer_bed: the primer bed
+    :param amplicon_bed: the amplicon bed
+    :param orf_bed: the ORF start bed
+    :param score_cutoff: cut-off for alignment score of leader
+    :param fastq: list of input fastqs, when starting from reads
+    :param bam: the input bam, when starting from an aligned bam
+    :param target_precision: the triage precision, None for a full count
+    :param leader_margin: ont, the bases after the leading soft clip searched for the leader
+    :param output_format: bam or cram, the format the alignment is cached in
+    :param columnar: parquet or arrow when the results include the columnar tables
+    :param sample: the sample id, written in every row of the results
+    :param tagged_bam: ont, the tagged bam policy (none, sgrna or full)
+    :param grna_subsample: ont, the fraction of the gRNA reads written to the tagged bam with the sgrna policy
+    :param xs_sentinel: ont, the XS tag of reads whose leader search was skipped
+    :param bam_compression: ont, the compression level of the tagged bam
+    :return: dictionary with the "results" key and, when starting from fastqs, the "alignment" key
+    """
+    from periscope.indexes import file_checksum
+
+    keys = {}
+    if fastq:
+        alignment = dict(kind="alignment", version=__version__, technology=technology,
+                         fastq=[file_checksum(file) for file in fastq], reference=file_checksum(reference))
+        # bam entries keep the keys they had before crams could be cached
+        if output_format != "bam":
+            alignment["output_format"] = output_format
+        keys["alignment"] = digest(alignment)
+        aligned = keys["alignment"]
+    else:
+        aligned = file_checksum(bam)
+    results = dict(kind="results", version=__version__, technology=technology, aligned=aligned, sample=sample,
+                   primer_bed=file_checksum(primer_bed), amplicon_bed=file_checksum(amplicon_bed),
+                   orf_bed=file_checksum(orf_bed), score_cutoff=float(score_cutoff),
+                   target_precision=float(target_precision) if target_precision else None,
+                   leader_margin=leader_margin if technology == "ont" else None)
+    # the columnar tables are part of the entry, results without them keep their keys
+    if columnar:
+        results["columnar"] = columnar
+    # the ont tagged bam is part of the entry, the settings it was written with are part of the key
+    if technology == "ont":
+        results["tagged_bam"] = tagged_bam
+        if tagged_bam != "none":
+            results.update(grna_subsample=float(grna_subsample or 0.0), xs_sentinel=xs_sentinel,
+                           bam_compression=bam_compression, output_format=output_format)
+    keys["results"] = digest(results)
+    return keys
+
+
+def digest(values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache():
+    """
+    the cache directory, look entries up with restore() and add them with put()
+
+        cache = ResultCache(directory, parse_size("20G"))
+        if not cache.restore("alignment", key, output_prefix):
+            ... align ...
+            cache.put("alignment", key, output_prefix, dict(bam=output_prefix + ".bam", bai=output_prefix + ".bam.bai"))
+    """
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, kind, key):
+        return os.path.join(self.directory, kind, key)
+
+    def get(self, kind, key):
+        """
+        :return: the entry.json of a cached entry, None when it isn't cached
+        """
+        entry_file = os.path.join(self.path(kind, key), "entry.json")
+        try:
+            with open(entry_file) as f:
+                entry = json.load(f)
+            # the modification time is the last use, for the eviction
+            os.utime(entry_file)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def restore(self, kind, key, output_prefix):
+        """
+        copy a cached entry's files to the outputs of this run
+
+        :param kind: alignment or results
+        :param key: the entry key from cache_keys
+        :param output_prefix: the output prefix of this run, the files are restored under it
+        :return: the entry.json with "outputs" as the restored paths, None when it isn't cached
+        """
+        entry = self.get(kind, key)
+        if entry is None:
+            return None
+        outputs = {}
+        try:
+            for name, suffix in entry["outputs"].items():
+                outputs[name] = output_prefix + suffix
+                shutil.copyfile(os.path.join(self.path(kind, key), suffix), outputs[name])
+        except OSError:
+            # evicted while we were copying
+            return None
+        entry["outputs"] = outputs
+        return entry
+
+    def put(self, kind, key, output_prefix, outputs, tables=None):
+        """
+        add the outputs of a run to the cache, then evict entries over the size limit
+
+        :param kind: alignment or results
+        :param key: the entry key from cache_keys
+        :param output_prefix: the output prefix of the run, files are stored by their name after it
+        :param outputs: dictionary of output name to file, every file starts with output_prefix
+        :param tables: the result tables, returned as they are when the entry is restored
+        """
+        if self.get(kind, key) is not None:
+            return
+        os.makedirs(os.path.join(self.directory, kind), exist_ok=True)
+        # filled in a temporary directory and renamed into place, a concurrent run sees the whole entry or nothing
+        temp = tempfile.mkdtemp(dir=os.path.join(self.directory, kind), prefix=".tmp")
+        try:
+            entry = dict(kind=kind, key=key, version=__version__, created=time.time(), outputs={}, tables=tables)
+            for name, file in outputs.items():
+                suffix = file[len(output_prefix):]
+                shutil.copyfile(file, os.path.join(temp, suffix))
+                entry["outputs"][name] = suffix
+            with open(os.path.join(temp, "entry.json"), "w") as f:
+                json.dump(entry, f, default=json_default)
+            try:
+                os.rename(temp, self.path(kind, key))
+            except OSError:
+                # cached by another run in the meantime
+                pass
+        finally:
+            if os.path.exists(temp):
+                shutil.rmtree(temp)
+        self.evict()
+
+    def entries(self):
+        """
+        :return: list of (last used, bytes, path) of every entry
+        """
+        entries = []
+        for kind in ["alignment", "results"]:
+            kind_dir = os.path.join(self.directory, kind)
+            if not os.path.isdir(kind_dir):
+                continue
+            for key in os.listdir(kind_dir):
+                path = os.path.join(kind_dir, key)
+                if key.startswith(".tmp"):
+                    continue
+                try:
+                    used = os.path.getmtime(os.path.join(path, "entry.json"))
+                    size = sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+                except OSError:
+                    continue
+                entries.append((used, size, path))
+        return entries
+
+    def evict(self):
+        """
+        remove the least recently used entries until the cache is within max_bytes
+        :return: the number of entries removed
+        """
+        if self.max_bytes is None:
+            return 0
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+
+def read_tables(outputs):
+    """
+    the result tables of cached CSVs, for entries cached without their tables (the snakemake pipeline)
+    :param outputs: dictionary of output name to CSV file
+    :return: dictionary of "counts", "novel_counts", "amplicons" rows and "mapped_reads"
+    """
+    import csv
+
+    def value(column, text):
+        if column in ["sample", "orf"]:
+            return text
+        for convert in [int, float]:
+            try:
+                return convert(text)
+            except ValueError:
+                pass
+        return text
+
+    tables = {}
+    for name in result_outputs:
+        with open(outputs[name]) as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            rows = [dict((column, value(column, text)) for column, text in zip(header, row)) for row in reader]
+        tables[name] = rows
+    counts = tables["counts"] + tables["novel_counts"]
+    tables["mapped_reads"] = counts[0]["mapped_reads"] if counts else None
+    return tables
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# the classification work is cut into many small chunks of the input bam rather than one shard per worker
+#
+# one pass over the bam records the BGZF virtual offset every --chunk-reads reads, each chunk is then just a
+# (start, end) offset range that a worker seeks to, nothing is copied or rewritten. The chunks are handed to the pool
+# one at a time, so a worker that finishes early takes the next chunk rather than waiting while a slow shard (deep
+# amplicons, many leader alignments) holds up the run.
+#
+# CRAM can't seek to a record, there a chunk is a range of read start coordinates, (reference id, position) at either
+# end, read through the .crai index. Reads starting at the same position always fall in one chunk.
+#
+# the same pass counts the mapped reads the counts are normalised by, as samtools flagstat's "mapped" line does (every
+# record that is not unmapped and not QC failed, secondary and supplementary alignments included), so nothing has to
+# read the whole bam again for it.
+from periscope.alignments import is_cram, open_alignments
+
+# reads per chunk, small enough that the tail of a run is short on many cores and large enough that the per chunk
+# cost (opening the bam, a temp bam per chunk for ont) doesn't show
+default_chunk_reads = 50000
+
+
+# flags of the records flagstat does not count as mapped
+unmapped_flags = 0x4 | 0x200
+
+
+def make_chunks(bam, chunk_reads=default_chunk_reads, reference=None, threads=1, totals=None):
+    """
+    find the chunk boundaries of a bam in one pass
+    :param bam: the input bam (or cram)
+    :param chunk_reads: number of reads per chunk
+    :param reference: the reference fasta, for a cram
+    :param threads: pysam decompression threads
+    :param totals: optional dictionary, "mapped_reads" is set to the mapped reads of the whole file as samtools
+    flagstat counts them
+    :return: list of (start, end, reads) where start and end are virtual offsets, end is None for the last chunk. For
+    a cram start and end are (reference id, position) and the reads without a position are left out
+    """
+    chunk_reads = max(1, int(chunk_reads))
+    if is_cram(bam):
+        return make_coordinate_chunks(bam, chunk_reads, reference, threads, totals)
+    chunks = []
+    mapped = 0
+    with open_alignments(bam, reference=reference, threads=threads) as inbamfile:
+        start = inbamfile.tell()
+        reads = 0
+        for read in inbamfile:
+            if not read.flag & unmapped_flags:
+                mapped += 1
+            reads += 1
+            if reads == chunk_reads:
+                end = inbamfile.tell()
+                chunks.append((start, end, reads))
+                start = end
+                reads = 0
+        if reads:
+            chunks.append((start, None, reads))
+    if totals is not None:
+        totals["mapped_reads"] = mapped
+    return chunks
+
+
+def make_coordinate_chunks(bam, chunk_reads, reference=None, threads=1, totals=None):
+    # the chunks of a sorted cram, split between read start positions every chunk_reads reads or more
+    chunks = []
+    mapped = 0
+    with open_alignments(bam, reference=reference, threads=threads) as inbamfile:
+        start = None
+        reads = 0
+        for read in inbamfile:
+            if read.reference_id < 0:
+                # the unplaced reads at the end, the classifiers skip them and none of them are mapped
+                break
+            if not read.flag & unmapped_flags:
+                mapped += 1
+            position = (read.reference_id, read.reference_start)
+            if start is None:
+                start = position
+            elif reads >= chunk_reads and position != last:
+                chunks.append((start, position, reads))
+                start = position
+                reads = 0
+            last = position
+            reads += 1
+        if reads:
+            chunks.append((start, None, reads))
+    if totals is not None:
+        totals["mapped_reads"] = mapped
+    return chunks
+
+
+def coordinate_reads(inbamfile, start, end):
+    # the reads starting in [start, end) of a sorted, indexed cram
+    last_id = end[0] if end else inbamfile.nreferences - 1
+    for reference_id in range(start[0], last_id + 1):
+        begin = start[1] if reference_id == start[0] else 0
+        stop = end[1] if end and reference_id == end[0] else None
+        if stop == 0:
+            continue
+        for read in inbamfile.fetch(inbamfile.get_reference_name(reference_id), begin, stop):
+            # fetch also gives the reads overlapping the start, they belong to the chunk before
+            if read.reference_start >= begin:
+                yield read
+
+
+def chunk_reads(inbamfile, chunk):
+    """
+    iterate over the reads of one chunk
+    :param inbamfile: the open input bam (or cram)
+    :param chunk: (start, end, reads) from make_chunks, None for every read in the file
+    :return: generator of pysam reads
+    """
+    if chunk is None:
+        for read in inbamfile:
+            yield read
+        return
+
+    start, end, reads = chunk
+    if isinstance(start, tuple):
+        for read in coordinate_reads(inbamfile, start, end):
+            yield read
+        return
+
+    inbamfile.seek(start)
+    for _ in range(reads):
+        yield next(inbamfile)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# a cohort store: the counts of many samples in one sqlite file, so reports don't re-read every sample's CSVs
+#
+#   periscope cohort ingest --database cohort.sqlite <OUTPUT_PREFIX> [<OUTPUT_PREFIX> ...]
+#   periscope cohort query --database cohort.sqlite --table matrix --metric sgRPHT_HQ
+#   periscope cohort query --database cohort.sqlite --table recurrence --min-samples 5
+#
+# ingest reads <OUTPUT_PREFIX>_periscope_counts.csv and <OUTPUT_PREFIX>_periscope_novel_counts.csv. A sample is
+# ingested in one transaction that first deletes its rows, so ingesting a sample again replaces it and an interrupted
+# ingest leaves the sample as it was. The ont and illumina CSVs have different columns, the values are kept long:
+#
+#   samples   sample, run_date, technology, prefix, periscope_version, ingested
+#   counts    sample, run_date, orf, novel (0/1), metric (the CSV column), value
+#   novel     sample, run_date, orf, position, reads (the novel sgRNA reads of the junction)
+#
+# with indexes on sample, orf and run date. The queries are plain sql, the module only needs the standard library.
+import argparse
+import csv
+import datetime
+import os
+import sqlite3
+import sys
+
+from periscope import __version__
+
+schema_version = 1
+
+schema = """
+create table if not exists samples (
+    sample text primary key,
+    run_date text,
+    technology text,
+    prefix text,
+    periscope_version text,
+    ingested text
+);
+create table if not exists counts (
+    sample text not null,
+    run_date text,
+    orf text not null,
+    novel integer not null,
+    metric text not null,
+    value real
+);
+create table if not exists novel (
+    sample text not null,
+    run_date text,
+    orf text not null,
+    position integer,
+    reads integer
+);
+create index if not exists counts_sample on counts (sample);
+create index if not exists counts_orf on counts (orf, metric);
+create index if not exists counts_run_date on counts (run_date);
+create index if not exists novel_sample on novel (sample);
+create index if not exists novel_orf on novel (orf);
+create index if not exists novel_run_date on novel (run_date);
+"""
+
+# the columns counted as novel sgRNA reads, by technology
+novel_read_columns = dict(ont=["nsgRNA_HQ_count", "nsgRNA_LQ_count"], illumina=["sgRNA_count"])
+
+
+def connect(database):
+    """
+    open (and if needed create) a cohort database
+
+    :param database: path of the sqlite file
+    :return: sqlite3 connection
+    """
+    connection = sqlite3.connect(database)
+    version = connection.execute("pragma user_version").fetchone()[0]
+    if version not in (0, schema_version):
+        connection.close()
+        raise ValueError("{} has cohort schema version {}, this periscope writes version {}".format(
+            database, version, schema_version))
+    connection.executescript(schema)
+    connection.execute("pragma user_version = {}".format(schema_version))
+    return connection
+
+
+def read_csv(path):
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def to_value(value):
+    # the CSVs write missing ratios as NA
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def ingest(connection, output_prefix, sample=None, run_date=None):
+    """
+    add one sample's counts to the cohort, replacing any rows it already has
+
+    :param connection: sqlite3 connection from connect()
+    :param output_prefix: the --output-prefix of the periscope run
+    :param sample: sample id, defaults to the sample column of the counts
+    :param run_date: run date (YYYY-MM-DD), defaults to the date the counts file was written
+    :return: dictionary with the "sample", "run_date", "technology" and the number of "counts" and "novel" rows
+    """
+    counts_file = output_prefix + "_periscope_counts.csv"
+    novel_file = output_prefix + "_periscope_novel_counts.csv"
+    counts = read_csv(counts_file)
+    novel = read_csv(novel_file) if os.path.exists(novel_file) else []
+    if not counts:
+        raise ValueError("{} has no counts".format(counts_file))
+
+    header = list(counts[0])
+    technology = "ont" if "sgRNA_HQ_count" in header else "illumina"
+    if sample is None:
+        sample = counts[0]["sample"]
+    if run_date is None:
+        run_date = datetime.date.fromtimestamp(os.path.getmtime(counts_file)).isoformat()
+
+    def long_rows(rows, novel_flag):
+        for row in rows:
+            for metric, value in row.items():
+                if metric in ("sample", "orf"):
+                    continue
+                yield sample, run_date, row["orf"], novel_flag, metric, to_value(value)
+
+    junctions = []
+    for row in novel:
+        reads = sum(int(float(row[column])) for column in novel_read_columns[technology])
+        junctions.append((sample, run_date, row["orf"], int(row["orf"].split("_")[1]), reads))
+
+    # the connection as a context manager commits, or rolls back on an error
+    with connection:
+        connection.execute("delete from counts where sample = ?", (sample,))
+        connection.execute("delete from novel where sample = ?", (sample,))
+        connection.execute("insert or replace into samples values (?, ?, ?, ?, ?, ?)",
+                           (sample, run_date, technology, os.path.abspath(output_prefix), __version__,
+                            datetime.datetime.now().isoformat(timespec="seconds")))
+        connection.executemany("insert into counts values (?, ?, ?, ?, ?, ?)", long_rows(counts, 0))
+        connection.executemany("insert into counts values (?, ?, ?, ?, ?, ?)", long_rows(novel, 1))
+        connection.executemany("insert into novel values (?, ?, ?, ?, ?)", junctions)
+    return dict(sample=sample, run_date=run_date, technology=technology, counts=len(counts), novel=len(novel))
+
+
+def date_filter(since=None, until=None, samples=None):
+    clauses = []
+    values = []
+    if since:
+        clauses.append("run_date >= ?")
+        values.append(since)
+    if until:
+        clauses.append("run_date <= ?")
+        values.append(until)
+    if samples:
+        clauses.append("sample in ({})".format(",".join("?" * len(samples))))
+        values.extend(samples)
+    return clauses, values
+
+
+def orf_matrix(connection, metric, novel=False, orfs=None, samples=None, since=None, until=None):
+    """
+    an ORF x sample matrix of one metric
+
+    :param connection: sqlite3 connection from connect()
+    :param metric: a column of the counts CSVs, e.g. sgRPHT_HQ (ont) or sgRPHT (illumina)
+    :param novel: the novel junctions instead of the canonical ORFs
+    :param orfs: only these ORFs
+    :param samples: only these samples
+    :param since: only samples run on or after this date
+    :param until: only samples run on or before this date
+    :return: (orfs, samples, values), values is a dictionary of (orf, sample) to the value, absent where the sample has
+    no row for the ORF. The ORFs are in the order of the counts CSVs (by position for novel junctions), the samples by
+    run date
+    """
+    clauses, values = date_filter(since, until, samples)
+    clauses = ["metric = ?", "novel = ?"] + clauses
+    values = [metric, int(novel)] + values
+    if orfs:
+        clauses.append("orf in ({})".format(",".join("?" * len(orfs))))
+        values.extend(orfs)
+    rows = connection.execute("select orf, sample, run_date, value from counts where {} order by rowid".format(
+        " and ".join(clauses)), values).fetchall()
+
+    matrix = {}
+    orf_order = {}
+    sample_dates = {}
+    for orf, sample, run_date, value in rows:
+        matrix[(orf, sample)] = value
+        orf_order.setdefault(orf, len(orf_order))
+        sample_dates[sample] = run_date or ""
+    if novel:
+        orf_names = sorted(orf_order, key=lambda orf: int(orf.split("_")[1]))
+    else:
+        orf_names = sorted(orf_order, key=orf_order.get)
+    sample_names = sorted(sample_dates, key=lambda sample: (sample_dates[sample], sample))
+    return orf_names, sample_names, matrix
+
+
+def novel_recurrence(connection, min_samples=1, min_reads=1, since=None, until=None):
+    """
+    how many samples each novel junction was found in
+
+    :param connection: sqlite3 connection from connect()
+    :param min_samples: only junctions found in at least this many samples
+    :param min_reads: a junction is found in a sample with at least this many novel sgRNA reads
+    :param since: only samples run on or after this date
+    :param until: only samples run on or before this date
+    :return: list of dictionaries with the "orf", "position", number of "samples", total "reads", the "first_run" and
+    "last_run" dates, most recurrent first
+    """
+    clauses, values = date_filter(since, until)
+    clauses = ["reads >= ?"] + clauses
+    values = [min_reads] + values + [min_samples]
+    rows = connection.execute("""
+        select orf, position, count(distinct sample) as samples, sum(reads), min(run_date), max(run_date)
+        from novel where {}
+        group by orf, position having samples >= ?
+        order by samples desc, position""".format(" and ".join(clauses)), values).fetchall()
+    columns = ["orf", "position", "samples", "reads", "first_run", "last_run"]
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def get_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='periscope: keep the counts of a cohort of samples in one indexed sqlite file')
+    commands = parser.add_subparsers(dest='command')
+
+    ingest_parser = commands.add_parser('ingest', help='add samples to the cohort, replacing their rows if they were added before')
+    ingest_parser.add_argument('--database', help='the cohort sqlite file, created if it does not exist', required=True)
+    ingest_parser.add_argument('output_prefixes', metavar='OUTPUT_PREFIX', help='the --output-prefix of a periscope run', nargs='+')
+    ingest_parser.add_argument('--sample', help='sample id, with a single OUTPUT_PREFIX (the sample column of the counts)', default=None)
+    ingest_parser.add_argument('--run-date', dest='run_date', help='run date as YYYY-MM-DD (the date the counts were written)', default=None)
+
+    query_parser = commands.add_parser('query', help='ORF x sample matrices and novel junction recurrence, as CSV')
+    query_parser.add_argument('--database', help='the cohort sqlite file', required=True)
+    query_parser.add_argument('--table', help='matrix (ORF x sample values of --metric) or recurrence (samples per novel junction)', choices=['matrix', 'recurrence'], default='matrix')
+    query_parser.add_argument('--metric', help='matrix: the counts column to tabulate, e.g. sgRPHT_HQ (ont) or sgRPHT (illumina)', default='sgRPHT_HQ')
+    query_parser.add_argument('--novel', help='matrix: the novel junctions instead of the canonical ORFs', action='store_true')
+    query_parser.add_argument('--orf', help='matrix: only these ORFs', nargs='+', default=None)
+    query_parser.add_argument('--samples', help='matrix: only these samples', nargs='+', default=None)
+    query_parser.add_argument('--since', help='only samples run on or after this date', default=None)
+    query_parser.add_argument('--until', help='only samples run on or before this date', default=None)
+    query_parser.add_argument('--min-samples', dest='min_samples', help='recurrence: junctions found in at least this many samples (1)', type=int, default=1)
+    query_parser.add_argument('--min-reads', dest='min_reads', help='recurrence: novel sgRNA reads for a junction to be found in a sample (1)', type=int, default=1)
+    query_parser.add_argument('--output', help='CSV to write (stdout)', default=None)
+    return parser
+
+
+def main(args):
+    if args.command is None:
+        get_parser("periscope cohort").print_usage(sys.stderr)
+        return 1
+    try:
+        connection = connect(args.database)
+    except (sqlite3.Error, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    try:
+        if args.command == "ingest":
+            if args.sample and len(args.output_prefixes) > 1:
+                print("--sample can only be given with a single OUTPUT_PREFIX", file=sys.stderr)
+                return 1
+            for output_prefix in args.output_prefixes:
+                try:
+                    ingested = ingest(connection, output_prefix, args.sample, args.run_date)
+                except (OSError, KeyError, ValueError) as e:
+                    print("{}: {}".format(output_prefix, e), file=sys.stderr)
+                    return 1
+                print("{sample} ({technology}, {run_date}): {counts} ORFs, {novel} novel junctions".format(**ingested))
+            return 0
+
+        output = open(args.output, "w", newline="") if args.output else sys.stdout
+        try:
+            writer = csv.writer(output)
+            if args.table == "matrix":
+                orfs, samples, values = orf_matrix(connection, args.metric, args.novel, args.orf, args.samples,
+                                                   args.since, args.until)
+                writer.writerow(["orf"] + samples)
+                for orf in orfs:
+                    writer.writerow([orf] + ["NA" if values.get((orf, sample)) is None else values[(orf, sample)]
+                                             for sample in samples])
+            else:
+                rows = novel_recurrence(connection, args.min_samples, args.min_reads, args.since, args.until)
+                writer.writerow(["orf", "position", "samples", "reads", "first_run", "last_run"])
+                for row in rows:
+                    writer.writerow(row.values())
+        finally:
+            if args.output:
+                output.close()
+        return 0
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(get_parser().parse_args()))
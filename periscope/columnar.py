@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# columnar copies of the outputs (--columnar parquet or arrow), for loading many samples into a warehouse without
+# parsing the CSVs
+#
+# every table has a declared schema per technology: the column types are fixed, "NA" and missing values are nulls and
+# the counts are integers. Each file carries the schema version in its metadata (periscope.schema_version), it is
+# bumped whenever a column is added, removed or changes type, so a reader can check what it is loading.
+#
+#   <OUTPUT_PREFIX>_periscope_counts.parquet        the rows of _periscope_counts.csv
+#   <OUTPUT_PREFIX>_periscope_novel_counts.parquet  the rows of _periscope_novel_counts.csv
+#   <OUTPUT_PREFIX>_periscope_amplicons.parquet     the rows of _periscope_amplicons.csv
+#   <OUTPUT_PREFIX>_periscope_reads.parquet         one row per classified read (for illumina with its pair's class
+#                                                   and amplicon)
+#
+# arrow writes the same tables as Arrow IPC (feather v2) files ending in .arrow. pyarrow is only needed with
+# --columnar. The ont workers write the read features of their chunk to a part file, the parent copies the parts in
+# chunk order into the reads table, one row group (record batch) per part, so the whole table is never held in memory.
+import itertools
+import math
+
+from periscope import __version__
+
+schema_version = 2
+
+columnar_formats = ["parquet", "arrow"]
+
+# (technology, table) to the list of (column, type) in file order
+schemas = {
+    ("ont", "counts"): [
+        ("sample", "string"), ("orf", "string"), ("mapped_reads", "int64"), ("amplicons", "string"),
+        ("gRNA_count", "int64"), ("sgRNA_HQ_count", "int64"), ("sgRNA_LQ_count", "int64"),
+        ("sgRNA_LLQ_count", "int64"), ("gRHPT", "float64"), ("sgRPTg_HQ", "float64"), ("sgRPTg_LQ", "float64"),
+        ("sgRPTg_LLQ", "float64"), ("sgRPTg_ALL", "float64"), ("sgRPHT_HQ", "float64"), ("sgRPHT_LQ", "float64"),
+        ("sgRPHT_LLQ", "float64"), ("sgRPHT_ALL", "float64")],
+    ("ont", "novel_counts"): [
+        ("sample", "string"), ("orf", "string"), ("mapped_reads", "int64"), ("amplicons", "string"),
+        ("gRNA_count", "int64"), ("nsgRNA_HQ_count", "int64"), ("nsgRNA_LQ_count", "int64"), ("gRHPT", "float64"),
+        ("nsgRPTg_HQ", "float64"), ("nsgRPTg_LQ", "float64"), ("nsgRPTg_ALL", "float64"), ("nsgRPHT_HQ", "float64"),
+        ("nsgRPHT_LQ", "float64"), ("nsgRPHT_ALL", "float64")],
+    ("ont", "amplicons"): [
+        ("sample", "string"), ("amplicon", "int64"), ("mapped_reads", "int64"), ("orf", "string"),
+        ("quality", "string"), ("gRNA_count", "int64"), ("gRPTH", "float64"), ("sgRNA_count", "int64"),
+        ("sgRPHT", "float64"), ("sgRPTg", "float64")],
+    ("ont", "reads"): [
+        ("sample", "string"), ("read_id", "string"), ("reference_start", "int64"), ("reference_end", "int64"),
+        ("is_reverse", "bool"), ("amplicon", "int64"), ("orf", "string"), ("read_class", "string"),
+        ("leader_score", "float64")],
+    ("illumina", "counts"): [
+        ("sample", "string"), ("mapped_reads", "int64"), ("gRNA_count", "int64"), ("orf", "string"),
+        ("sgRNA_count", "int64"), ("coverage", "float64"), ("sgRPTL", "float64"), ("sgRPHT", "float64")],
+    ("illumina", "novel_counts"): [
+        ("sample", "string"), ("mapped_reads", "int64"), ("orf", "string"), ("sgRNA_count", "int64"),
+        ("coverage", "float64"), ("sgRPTL", "float64"), ("sgRPHT", "float64")],
+    ("illumina", "amplicons"): [
+        ("sample", "string"), ("amplicon", "int64"), ("mapped_reads", "int64"), ("orf", "string"),
+        ("gRNA_count", "int64"), ("gRPTH", "float64"), ("sgRNA_count", "int64"), ("sgRPHT", "float64"),
+        ("sgRPTg", "float64")],
+    ("illumina", "reads"): [
+        ("sample", "string"), ("read_id", "string"), ("reference_start", "int64"), ("orf", "string"),
+        ("sgRNA", "bool"), ("pair_orf", "string"), ("pair_class", "string"), ("pair_amplicon", "int64")],
+}
+
+converters = dict(string=str, int64=int, float64=float, bool=bool)
+
+# rows converted and written at a time, one row group (record batch) each
+batch_rows = 100000
+
+
+def require_pyarrow():
+    # checked before the counting starts rather than failing once the reads are classified
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("--columnar needs pyarrow, install it with `pip install pyarrow` or "
+                          "`conda install -c conda-forge pyarrow`")
+
+
+def extension(columnar_format):
+    if columnar_format not in columnar_formats:
+        raise ValueError("{} is not a supported columnar format, use parquet or arrow".format(columnar_format))
+    return "." + columnar_format
+
+
+def output_path(output_prefix, table, columnar_format):
+    """
+    :return: <OUTPUT_PREFIX>_periscope_<TABLE>.parquet (or .arrow)
+    """
+    return "{}_periscope_{}{}".format(output_prefix, table, extension(columnar_format))
+
+
+def tables(technology):
+    """
+    :return: the tables written for a technology, in order
+    """
+    return [table for tech, table in schemas if tech == technology]
+
+
+def outputs(output_prefix, technology, columnar_format):
+    """
+    :return: dictionary of table name to the file it is written to, for every table of the technology
+    """
+    return {table: output_path(output_prefix, table, columnar_format) for table in tables(technology)}
+
+
+def convert(value, column_type):
+    # None for the missing values the CSVs spell NA (or as a nan), otherwise the value as the column type
+    if value is None or value == "NA" or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return converters[column_type](value)
+
+
+def typed_columns(rows, technology, table):
+    """
+    :param rows: list of dictionaries keyed on the column names, as returned in the result tables
+    :param technology: ont or illumina
+    :param table: counts, novel_counts, amplicons or reads
+    :return: dictionary of column name to the list of its values, typed as the schema declares
+    """
+    schema = schemas[(technology, table)]
+    return {column: [convert(row.get(column), column_type) for row in rows] for column, column_type in schema}
+
+
+def arrow_schema(technology, table):
+    import pyarrow
+
+    types = dict(string=pyarrow.string(), int64=pyarrow.int64(), float64=pyarrow.float64(), bool=pyarrow.bool_())
+    metadata = {"periscope.schema_version": str(schema_version), "periscope.table": table,
+                "periscope.technology": technology, "periscope.version": __version__}
+    return pyarrow.schema([(column, types[column_type]) for column, column_type in schemas[(technology, table)]],
+                          metadata=metadata)
+
+
+def to_arrow(rows, technology, table):
+    import pyarrow
+
+    return pyarrow.Table.from_pydict(typed_columns(rows, technology, table), schema=arrow_schema(technology, table))
+
+
+class TableWriter():
+    """
+    write a table in bulk, one row group per call to write()
+
+        with TableWriter(path, "ont", "reads", "parquet") as writer:
+            writer.write(rows)
+    """
+    def __init__(self, path, technology, table, columnar_format):
+        self.path = path
+        self.technology = technology
+        self.table = table
+        self.schema = arrow_schema(technology, table)
+        if columnar_format == "parquet":
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+        self.rows = 0
+
+    def write(self, rows):
+        self.write_table(to_arrow(rows, self.technology, self.table))
+
+    def write_table(self, table):
+        if table.num_rows:
+            self.writer.write_table(table)
+            self.rows += table.num_rows
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_table(rows, path, technology, table, columnar_format):
+    """
+    :param rows: list (or iterator) of dictionaries keyed on the column names, written batch_rows at a time
+    :param path: the output file
+    :param technology: ont or illumina
+    :param table: counts, novel_counts, amplicons or reads
+    :param columnar_format: parquet or arrow
+    :return: the number of rows written
+    """
+    rows = iter(rows)
+    with TableWriter(path, technology, table, columnar_format) as writer:
+        batch = list(itertools.islice(rows, batch_rows))
+        while batch:
+            writer.write(batch)
+            batch = list(itertools.islice(rows, batch_rows))
+    return writer.rows
+
+
+def write_part(rows, path, technology, table):
+    # one chunk's rows as an uncompressed arrow file, copied into the output by combine_parts
+    return write_table(rows, path, technology, table, "arrow")
+
+
+def combine_parts(parts, path, technology, table, columnar_format):
+    """
+    copy the part files written by the workers into one table, in order
+
+    :param parts: list of part files from write_part
+    :param path: the output file
+    :return: the number of rows written
+    """
+    import pyarrow
+    import pyarrow.ipc
+
+    with TableWriter(path, technology, table, columnar_format) as writer:
+        for part in parts:
+            with pyarrow.memory_map(part) as source:
+                writer.write_table(pyarrow.ipc.open_file(source).read_all())
+    return writer.rows
+
+
+def write_outputs(output_prefix, technology, result_tables, columnar_format, metrics):
+    """
+    write the tables of a run that are in result_tables, e.g. counts, novel_counts and amplicons
+
+    :param output_prefix: prefix of the output files
+    :param technology: ont or illumina
+    :param result_tables: dictionary of table name to its rows, e.g. the tables returned by classify
+    :param columnar_format: parquet or arrow
+    :param metrics: the run metrics, a columnar_writing stage is added
+    :return: dictionary of table name to the file written
+    """
+    written = {table: file for table, file in outputs(output_prefix, technology, columnar_format).items()
+               if table in result_tables}
+    with metrics.stage("columnar_writing", outputs=list(written.values())) as stage:
+        stage["records"] = sum(write_table(result_tables[table], file, technology, table, columnar_format)
+                               for table, file in written.items())
+    return written
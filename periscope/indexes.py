@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# prebuilt aligner indexes, reused across runs and samples
+#
+# minimap2 builds its minimizer index of the reference on every run unless it is given a prebuilt .mmi, for short runs
+# that is a noticeable part of the alignment. The index is built once into a cache directory (index_cache in the
+# resources directory, or ~/.cache/periscope/indexes when that isn't writable) under a name keyed on the reference
+# checksum and the k-mer size:
+#
+#   <CACHE>/nCoV-2019.reference.fasta.<SHA256[:16]>.k15.mmi
+#   <CACHE>/nCoV-2019.reference.fasta.<SHA256[:16]>.k15.mmi.json    manifest: checksum, k, preset, minimap2 version, size
+#
+# an index is only used when its manifest matches, otherwise it is rebuilt. The bwa index shipped next to the reference
+# is used when it holds the same sequence as the reference, its packed sequence (.pac) is compared base by base with
+# the fasta, otherwise one is built into the cache the same way.
+#
+#   python -m periscope.indexes --technology ont      # build (or check) the index ahead of a batch of samples
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# minimap2 settings used by the ont align step, the k-mer size and preset are part of the index
+minimap2_preset = "map-ont"
+minimap2_kmer = 15
+
+bwa_extensions = ["amb", "ann", "bwt", "pac", "sa"]
+
+
+def file_checksum(file):
+    """
+    :param file: path of the file
+    :return: hex sha256 of the file contents
+    """
+    sha = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def default_cache_dir(resources):
+    """
+    the index cache next to the reference, or in the user's cache directory when the resources aren't writable (e.g.
+    installed site-wide)
+    :param resources: the periscope resources directory
+    :return: the cache directory
+    """
+    if os.access(resources, os.W_OK):
+        return os.path.join(resources, "index_cache")
+    return os.path.join(os.path.expanduser("~"), ".cache", "periscope", "indexes")
+
+
+def tool_version(command):
+    """
+    :param command: the version command, e.g. ["minimap2", "--version"]
+    :return: the first line the tool prints
+    """
+    output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout
+    return output.strip().split("\n")[0]
+
+
+def read_manifest(manifest):
+    try:
+        with open(manifest) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(manifest, values):
+    # written to a temporary file and renamed so a concurrent run never reads half a manifest
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(manifest), suffix=".json.tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(values, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(temp, manifest)
+
+
+def minimap2_index_path(reference, cache_dir, kmer=minimap2_kmer, checksum=None):
+    """
+    :param reference: the reference fasta
+    :param cache_dir: the index cache directory
+    :param kmer: minimap2 -k
+    :param checksum: sha256 of the reference, computed when not given
+    :return: path of the cached .mmi for this reference and k
+    """
+    checksum = checksum or file_checksum(reference)
+    return os.path.join(cache_dir, "{}.{}.k{}.mmi".format(os.path.basename(reference), checksum[:16], kmer))
+
+
+def minimap2_index(reference, cache_dir, kmer=minimap2_kmer, build=True):
+    """
+    the cached minimap2 index of the reference, validated against its manifest and (re)built when missing or stale
+
+    :param reference: the reference fasta
+    :param cache_dir: the index cache directory
+    :param kmer: minimap2 -k
+    :param build: build the index when it isn't valid, otherwise only return the path (for dry runs)
+    :return: path of the .mmi
+    """
+    checksum = file_checksum(reference)
+    index = minimap2_index_path(reference, cache_dir, kmer, checksum)
+    if not build:
+        return index
+
+    expected = dict(reference=os.path.basename(reference), reference_sha256=checksum, kmer=kmer,
+                    preset=minimap2_preset, minimap2_version=tool_version(["minimap2", "--version"]))
+    manifest = read_manifest(index + ".json")
+    if manifest and os.path.exists(index) and os.path.getsize(index) == manifest.get("index_bytes") and \
+            all(manifest.get(key) == value for key, value in expected.items()):
+        return index
+
+    print("building minimap2 index {}".format(index), file=sys.stderr)
+    os.makedirs(cache_dir, exist_ok=True)
+    # built under a temporary name and renamed, runs sharing the cache see the old index or the new one
+    fd, temp = tempfile.mkstemp(dir=cache_dir, suffix=".mmi.tmp")
+    os.close(fd)
+    try:
+        subprocess.run(["minimap2", "-x", minimap2_preset, "-k", str(kmer), "-d", temp, reference], check=True,
+                       stdout=subprocess.DEVNULL)
+        os.replace(temp, index)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    expected["index_bytes"] = os.path.getsize(index)
+    write_manifest(index + ".json", expected)
+    return index
+
+
+def fasta_lengths(reference):
+    # sequence names and lengths of a fasta file, in order
+    lengths = []
+    with open(reference) as f:
+        for line in f:
+            if line.startswith(">"):
+                lengths.append([line[1:].split()[0], 0])
+            elif lengths:
+                lengths[-1][1] += len(line.strip())
+    return [tuple(length) for length in lengths]
+
+
+def bwa_index_lengths(prefix):
+    # sequence names and lengths recorded in a bwa index (.ann), None when it can't be read
+    try:
+        with open(prefix + ".ann") as f:
+            lines = f.read().split("\n")
+        lengths = []
+        for i in range(int(lines[0].split()[1])):
+            name = lines[1 + 2 * i].split()[1]
+            length = int(lines[2 + 2 * i].split()[1])
+            lengths.append((name, length))
+        return lengths
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def fasta_sequence(reference):
+    # the sequences of a fasta file concatenated, as bwa packs them
+    with open(reference) as f:
+        return "".join(line.strip() for line in f if not line.startswith(">"))
+
+
+def bwa_index_matches(prefix, reference, lengths=None):
+    """
+    whether a bwa index holds the sequence of the reference: the same sequence names and lengths (.ann) and the same
+    bases in the packed sequence (.pac), which is 2 bits a base, the first base in the high bits. bwa packs ambiguous
+    bases as a random base and lists them in the .amb, those are skipped
+
+    :param prefix: the index prefix
+    :param reference: the reference fasta
+    :param lengths: the fasta_lengths of the reference, read when not given
+    :return: True when the index matches
+    """
+    if not all(os.path.exists(prefix + "." + extension) for extension in bwa_extensions):
+        return False
+    if bwa_index_lengths(prefix) != (lengths or fasta_lengths(reference)):
+        return False
+    sequence = fasta_sequence(reference).upper()
+    try:
+        with open(prefix + ".pac", "rb") as f:
+            pac = f.read()
+        with open(prefix + ".amb") as f:
+            lines = f.read().split("\n")
+        holes = set()
+        for line in lines[1:1 + int(lines[0].split()[2])]:
+            offset, length, _ = line.split()
+            holes.update(range(int(offset), int(offset) + int(length)))
+    except (OSError, IndexError, ValueError):
+        return False
+    if len(pac) < (len(sequence) + 3) // 4:
+        return False
+    codes = dict(A=0, C=1, G=2, T=3)
+    for i, base in enumerate(sequence):
+        if i not in holes and codes.get(base) != (pac[i >> 2] >> ((~i & 3) << 1)) & 3:
+            return False
+    return True
+
+
+def bwa_index(reference, cache_dir, build=True):
+    """
+    the bwa index of the reference, the one shipped next to the reference when it matches it, otherwise one built
+    into the cache
+
+    :param reference: the reference fasta
+    :param cache_dir: the index cache directory
+    :param build: build the index when there isn't a valid one, otherwise only return the prefix (for dry runs)
+    :return: the index prefix to give bwa mem
+    """
+    lengths = fasta_lengths(reference)
+    if bwa_index_matches(reference, reference, lengths):
+        return reference
+
+    checksum = file_checksum(reference)
+    prefix = os.path.join(cache_dir, "{}.{}".format(os.path.basename(reference), checksum[:16]))
+    if not build:
+        return prefix
+
+    expected = dict(reference=os.path.basename(reference), reference_sha256=checksum)
+    manifest = read_manifest(prefix + ".json")
+    if manifest and all(manifest.get(key) == value for key, value in expected.items()) and \
+            bwa_index_matches(prefix, reference, lengths):
+        return prefix
+
+    print("building bwa index {}".format(prefix), file=sys.stderr)
+    os.makedirs(cache_dir, exist_ok=True)
+    temp = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        subprocess.run(["bwa", "index", "-p", os.path.join(temp, "index"), reference], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for extension in bwa_extensions:
+            os.replace(os.path.join(temp, "index." + extension), prefix + "." + extension)
+    finally:
+        shutil.rmtree(temp, ignore_errors=True)
+    write_manifest(prefix + ".json", expected)
+    return prefix
+
+
+def aligner_index(technology, reference, cache_dir, build=True):
+    """
+    :param technology: ont (minimap2) or illumina (bwa)
+    :param reference: the reference fasta
+    :param cache_dir: the index cache directory
+    :param build: build the index when there isn't a valid one
+    :return: what to give the aligner in place of the reference fasta
+    """
+    if technology == "illumina":
+        return bwa_index(reference, cache_dir, build)
+    return minimap2_index(reference, cache_dir, build=build)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='periscope: build or check the cached aligner index of the reference')
+    parser.add_argument('--technology', help='ont (minimap2 .mmi) or illumina (bwa)', default="ont")
+    parser.add_argument('--resources', help='the periscope resources directory', default=os.path.join(os.path.dirname(__file__), "resources"))
+    parser.add_argument('--reference', help='the reference fasta (nCoV-2019.reference.fasta in the resources directory)', default=None)
+    parser.add_argument('--index-cache', dest='index_cache', help='the index cache directory (index_cache in the resources directory)', default=None)
+
+    args = parser.parse_args()
+    reference = args.reference or os.path.join(args.resources, "nCoV-2019.reference.fasta")
+    print(aligner_index(args.technology, reference, args.index_cache or default_cache_dir(args.resources)))
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# per-stage timing and resource metrics, written to <OUTPUT_PREFIX>_periscope_metrics.json at the end of a run
+#
+# every stage records wall and cpu time (including child processes), peak rss, the bytes of the files it read and
+# wrote and the number of records it processed. Stages run by snakemake are timed by running their commands through
+# this module:
+#
+#   python -m periscope.metrics --stage minimap2 --log <LOG> --input <FASTQ> -- minimap2 ...
+#
+# which appends the stage to <LOG> (one json object per line), the classifier then merges that log into the final
+# metrics file
+#
+# the peak rss of a stage is its own: on linux the high-water mark of the process is reset when a stage starts (writing
+# 5 to /proc/self/clear_refs) and read back from VmHWM in /proc/self/status when it ends, a stage enclosing others
+# keeps the peak it had reached before each reset. Where it can't be reset ru_maxrss only gives the peak of the whole
+# process so far, peak_rss_bytes is then null and that value is reported as peak_rss_so_far_bytes. ru_maxrss of the
+# children can't be reset either, peak_rss_children_bytes is the largest child the stage waited for when that is larger
+# than every child before it, otherwise null. Commands run with run_pipeline are measured one process at a time.
+from periscope import __version__
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak rss is then not reported
+    resource = None
+
+
+def peak_rss(who="self"):
+    """
+    peak resident set size in bytes so far, of this process or of all of its waited for children
+    :param who: "self" or "children"
+    :return: peak rss in bytes, None if it can't be measured on this platform
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+    return rusage_rss(usage)
+
+
+def reset_peak_rss():
+    """
+    reset the high-water mark of this process's rss, linux only
+    :return: whether it was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def high_water_rss():
+    """
+    :return: the high-water mark of this process's rss (VmHWM) in bytes since the last reset_peak_rss, None when it
+    can't be read
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def rusage_rss(usage):
+    # linux reports ru_maxrss in kilobytes, macos in bytes
+    if sys.platform == "darwin":
+        return usage.ru_maxrss
+    return usage.ru_maxrss * 1024
+
+
+def file_bytes(files):
+    """
+    total size of the files that exist
+    :param files: list of file paths
+    :return: bytes
+    """
+    return sum(os.path.getsize(file) for file in files if file and os.path.exists(file))
+
+
+def cpu_seconds(times):
+    # user + system time of this process and its waited for children
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def worker_metrics(bam, reads, seconds, cpu_seconds, timings, chunk=None):
+    """
+    the metrics a worker reports for the chunk it processed
+    :param bam: the file processed
+    :param reads: number of reads classified
+    :param seconds: wall time
+    :param cpu_seconds: cpu time of the worker
+    :param timings: seconds spent in each part of the read loop, the remainder is reported as "other"
+    :param chunk: index of the chunk of the file processed
+    :return: dictionary of worker metrics
+    """
+    timings["other"] = max(0.0, seconds - sum(timings.values()))
+    return dict(
+        file=bam,
+        chunk=chunk,
+        pid=os.getpid(),
+        reads=reads,
+        seconds=seconds,
+        cpu_seconds=cpu_seconds,
+        reads_per_second=reads / seconds if seconds else None,
+        time_split=timings
+    )
+
+
+class Metrics():
+    """
+    collects the stages and workers of a run and writes them as json
+    """
+    def __init__(self, prefix=None):
+        self.prefix = prefix
+        self.stages = []
+        self.workers = []
+        self.extra = {}
+        # the peak rss each open stage reached before an inner stage reset the high-water mark
+        self._open_peaks = []
+
+    @contextmanager
+    def stage(self, name, inputs=(), outputs=()):
+        """
+        time a stage run in this process (and any children it waits for), use as a context manager:
+
+            with metrics.stage("flagstat", inputs=[bam]) as stage:
+                stage["records"] = ...
+
+        :param name: stage name
+        :param inputs: files read by the stage
+        :param outputs: files written by the stage, sized once the stage is done
+        """
+        stage = dict(name=name, records=None)
+        # the enclosing stages keep the peak they reached, then the high-water mark starts again for this one
+        high_water = high_water_rss()
+        for peak in self._open_peaks:
+            peak[0] = max(peak[0], high_water or 0)
+        resettable = reset_peak_rss() and high_water is not None
+        peak = [0]
+        self._open_peaks.append(peak)
+        children_before = peak_rss("children")
+        start_wall = time.time()
+        start_times = os.times()
+        try:
+            yield stage
+        finally:
+            end_times = os.times()
+            self._open_peaks.remove(peak)
+            stage["wall_seconds"] = time.time() - start_wall
+            stage["cpu_seconds"] = cpu_seconds(end_times) - cpu_seconds(start_times)
+            if resettable:
+                stage["peak_rss_bytes"] = max(peak[0], high_water_rss() or 0)
+            else:
+                stage["peak_rss_bytes"] = None
+                stage["peak_rss_so_far_bytes"] = peak_rss("self")
+            # the largest child waited for so far, only this stage's when it grew during it
+            children = peak_rss("children")
+            stage["peak_rss_children_bytes"] = children if children and children > (children_before or 0) else None
+            # the stage can set these itself when its files are only known once it has run
+            stage.setdefault("bytes_read", file_bytes(inputs))
+            stage.setdefault("bytes_written", file_bytes(outputs))
+            self.stages.append(stage)
+
+    def run_pipeline(self, commands, stdout=None):
+        """
+        run shell-free commands connected by pipes (cmd1 | cmd2 | ...) and record one stage per command
+
+        :param commands: list of dictionaries with "name", "command" (argument list) and optional "inputs"/"outputs"
+        :param stdout: file object the last command writes to, defaults to inheriting ours
+        """
+        processes = []
+        previous = None
+        start_wall = time.time()
+        for i, command in enumerate(commands):
+            last = i == len(commands) - 1
+            process = subprocess.Popen(command["command"], stdin=previous, stdout=stdout if last else subprocess.PIPE)
+            if previous is not None:
+                # let the upstream process get SIGPIPE if this one exits early
+                previous.close()
+            previous = process.stdout
+            processes.append(process)
+
+        failed = []
+        for command, process in zip(commands, processes):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            self.stages.append(dict(
+                name=command["name"],
+                records=None,
+                wall_seconds=time.time() - start_wall,
+                cpu_seconds=usage.ru_utime + usage.ru_stime,
+                peak_rss_bytes=rusage_rss(usage),
+                peak_rss_children_bytes=None,
+                bytes_read=file_bytes(command.get("inputs", [])),
+                bytes_written=file_bytes(command.get("outputs", []))
+            ))
+            if process.returncode != 0:
+                failed.append(command)
+        if failed:
+            raise subprocess.CalledProcessError(processes[commands.index(failed[0])].returncode, failed[0]["command"])
+
+    def add_workers(self, workers):
+        """
+        :param workers: list of per-worker dictionaries returned by the classifier workers
+        """
+        self.workers += workers
+
+    def read_log(self, log):
+        """
+        add the stages appended to a stage log by `python -m periscope.metrics`, these are stages that ran before this
+        process started
+        :param log: the stage log
+        """
+        if not os.path.exists(log):
+            return
+        with open(log) as f:
+            self.stages = [json.loads(line) for line in f if line.strip()] + self.stages
+
+    def to_dict(self):
+        total_reads = sum(worker["reads"] for worker in self.workers)
+        worker_seconds = sum(worker["seconds"] for worker in self.workers)
+        return dict(
+            periscope_version=__version__,
+            prefix=self.prefix,
+            stages=self.stages,
+            workers=self.workers,
+            reads_per_second=total_reads / worker_seconds if worker_seconds else None,
+            **self.extra
+        )
+
+    def write(self, outfile):
+        """
+        write the metrics as json
+        :param outfile: usually <OUTPUT_PREFIX>_periscope_metrics.json
+        """
+        with open(outfile, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write("\n")
+
+
+def main(args):
+    metrics = Metrics()
+    metrics.run_pipeline([dict(name=args.stage, command=args.command, inputs=args.input, outputs=args.output)])
+    with open(args.log, "a") as f:
+        f.write(json.dumps(metrics.stages[0]) + "\n")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='periscope: run a command and append its timing and resource use to a stage log')
+    parser.add_argument('--stage', help='name of the stage', required=True)
+    parser.add_argument('--log', help='stage log to append to, one json object per line', required=True)
+    parser.add_argument('--input', help='files read by the command', nargs='+', action='append', default=[])
+    parser.add_argument('--output', help='files written by the command', nargs='+', action='append', default=[])
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='the command to run, after --')
+
+    args = parser.parse_args()
+    if args.command and args.command[0] == "--":
+        args.command = args.command[1:]
+    args.input = [file for files in args.input for file in files]
+    args.output = [file for files in args.output for file in files]
+
+    try:
+        main(args)
+    except subprocess.CalledProcessError as e:
+        sys.exit(e.returncode)
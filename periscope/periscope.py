@@ -1,30 +1,93 @@
 #!/usr/bin/env python3
 from periscope import __version__
 import argparse
+import json
 import sys
 import os
-import snakemake
 import glob
 import logging
 
+# primer schemes shipped in the resources directory
+primer_versions = ["V1", "V2", "V3", "V4", "V4.1", "2kb", "midnight"]
+
+def get_primer_beds(artic_primers, resources_dir):
+    """
+    work out the amplicon and primer bed files for an artic primer version or a custom amplicons/primers pair
+    :param artic_primers: a primer version (e.g. "V3") or a list of [amplicons_bed, primers_bed] for custom primers
+    :param resources_dir: the periscope resources directory
+    :return: the amplicons bed and the primers bed
+    """
+    version = [artic_primers] if isinstance(artic_primers, str) else artic_primers
+
+    if version[0] in primer_versions:
+        amplicons_bed=os.path.join(resources_dir, "artic_amplicons_{}.bed".format(version[0]))
+        primers_bed=os.path.join(resources_dir, "artic_primers_{}.bed".format(version[0]))
+    elif len(version)>1:
+        amplicons_bed=version[0]
+        primers_bed=version[1]
+
+        for file in [amplicons_bed, primers_bed]:
+            if not os.path.exists(file):
+                raise ValueError("Cannot find resource file {}".format(file))
+    else:
+        raise ValueError("{} artic primer version incorrect".format(version[0]))
+
+    return amplicons_bed, primers_bed
+
 def main():
 
-    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,description='periscope: Search for sgRNA reads in artic network SARS-CoV-2 sequencing data. A tool from Sheffield Bioinformatics Core/Florey Institute',usage='''periscope [options]''')
+    # subcommands, run before the pipeline's own options are parsed
+    if len(sys.argv) > 1 and sys.argv[1] == "compile-scheme":
+        from periscope import scheme
+        sys.exit(scheme.main(scheme.get_parser("periscope compile-scheme").parse_args(sys.argv[2:])))
+    if len(sys.argv) > 1 and sys.argv[1] == "cohort":
+        from periscope import cohort
+        sys.exit(cohort.main(cohort.get_parser("periscope cohort").parse_args(sys.argv[2:])))
+    if len(sys.argv) > 1 and sys.argv[1] == "plan":
+        from periscope import plan
+        sys.exit(plan.main(plan.get_parser("periscope plan").parse_args(sys.argv[2:])))
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        from periscope import workqueue
+        sys.exit(workqueue.main(workqueue.get_parser("periscope worker").parse_args(sys.argv[2:])))
+    if len(sys.argv) > 1 and sys.argv[1] == "distribute":
+        from periscope import workqueue
+        sys.exit(workqueue.distribute_main(workqueue.get_distribute_parser("periscope distribute").parse_args(sys.argv[2:])))
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,description='periscope: Search for sgRNA reads in artic network SARS-CoV-2 sequencing data. A tool from Sheffield Bioinformatics Core/Florey Institute',usage='''periscope [options]\n       periscope compile-scheme [options]\n       periscope plan --cores <N> [options]\n       periscope cohort ingest|query [options]\n       periscope worker --queue <DIR> [options]\n       periscope distribute --queue <DIR> --samples <CSV> [options]''')
     parser.add_argument('--fastq-dir',dest='fastq_dir', help='the folder containing the raw pass demultiplexed fastqs from the artic protocol, if this is illumina data the tool expects a file labelled R1 and R2 in this dir.', default=None,required=False)
     parser.add_argument('--fastq',dest='fastq',help='if you already have a single fastq then you can use this flag instead, if illumina paired end separate fastq by space', nargs='+',required=False,default=[])
     parser.add_argument('--output-prefix',dest='output_prefix', help='Prefix of the output file',default="test")
     parser.add_argument('--score-cutoff',dest='score_cutoff', help='Cut-off for alignment score of leader (50)',default=50)
     parser.add_argument('--artic-primers', dest='artic_primers', help='artic network primer version used:\n* V1 (default), V2, V3, V4\n* 2kb (for the UCL longer amplicons)\n* midnight (1.2kb midnight amplicons)\n* for custom primers provide path to amplicons file first and primers file second', nargs='*', default="V1")
     parser.add_argument('-t', '--threads', dest='threads', help='number of threads used for sgRNA counting',default="1")
+    parser.add_argument('--cores', dest='cores', help="plan the run from a sample of the input and split this many cores between mapping and sgRNA counting\n(periscope plan), within --max-memory. Overrides --threads and --mapping-threads", type=int, default=None)
     parser.add_argument('-mp', '--mapping-threads', dest='mapping_threads', help='number of threads used for mapping. Defaults to the number of threads used for sgRNA counting.')
     parser.add_argument('-r', '--resources', dest='resources', help="the path to the periscope resources directory - this is the place you cloned periscope into")
     parser.add_argument('-d', '--dry-run', action='store_true', help="perform a snakemake dryrun")
+    parser.add_argument('--engine', choices=['snakemake', 'python'], default='snakemake', help="how to run the pipeline:\n* snakemake (default)\n* python - in-process, without snakemake or a python subprocess per step")
     parser.add_argument('-f', '--force', action='store_true', help="Overwrite all output", dest="force")
     parser.add_argument('--tmp',
                         help="pybedtools likes to write to /tmp if you want to write somewhere else define it here",
                         default="/tmp")
     parser.add_argument('--sample', help='sample id', default="SHEF-D2BD9")
     parser.add_argument('--technology', help='the sequencing technology used, either:\n*ont\n*illumina', default="ont")
+    parser.add_argument('--index-cache', dest='index_cache', help="directory the aligner index (minimap2 .mmi, bwa) is built into and reused from,\ndefaults to index_cache in the resources directory", default=None)
+    parser.add_argument('--cache-dir', dest='cache_dir', help="cache aligned bams and results in this directory, a sample with the same inputs and settings is restored\nfrom it rather than realigned and reclassified", default=None)
+    parser.add_argument('--cache-max-size', dest='cache_max_size', help="size the cache is kept within, least recently used entries are removed first (20G)", default="20G")
+    parser.add_argument('--output-format', dest='output_format', choices=['bam', 'cram'], default='bam', help="format of the aligned reads (<OUTPUT_PREFIX>.bam or .cram) and of the ont tagged reads:\n* bam (default)\n* cram - encoded against the bundled nCoV-2019.reference.fasta, a fraction of the size")
+    parser.add_argument('--io-threads', dest='io_threads', help="threads pysam uses to compress and decompress each bam or cram (1)", type=int, default=1)
+    parser.add_argument('--tagged-bam', dest='tagged_bam', choices=['none', 'sgrna', 'full'], default='full', help="ont: the reads written to <OUTPUT_PREFIX>_periscope.bam with their periscope tags:\n* none - no tagged bam, counts only\n* sgrna - the sgRNA and nsgRNA reads, and --grna-subsample of the gRNA reads\n* full (default) - every read")
+    parser.add_argument('--grna-subsample', dest='grna_subsample', help="ont: with --tagged-bam sgrna, the fraction of the gRNA reads also written (0)", type=float, default=0.0)
+    parser.add_argument('--bam-compression', dest='bam_compression', help="ont: compression level of the tagged bam, 0 (fastest) to 9 (smallest), the htslib default\nwhen not given", type=int, choices=range(10), default=None)
+    parser.add_argument('--columnar', choices=['parquet', 'arrow'], default=None, help="also write the counts, novel counts, amplicons and a row per read as columnar files with\na declared schema, <OUTPUT_PREFIX>_periscope_<TABLE>.parquet (or .arrow), needs pyarrow")
+    parser.add_argument('--max-memory', dest='max_memory', help="memory budget of the sgRNA counting, shared by the counting threads and the parent (e.g. 16G).\nThe chunks are cut to fit it and the illumina reads waiting for their mates are spilled to disk past it", default=None)
+    parser.add_argument('--chunk-reads', dest='chunk_reads', help="reads per chunk of sgRNA counting work (50000), chunks are handed to the counting threads as they become free", type=int, default=50000)
+    parser.add_argument('--leader-margin', dest='leader_margin', help="ont: search for the leader in the leading soft clip of the read and this many bases after it (40),\n-1 searches the whole read", type=int, default=40)
+    parser.add_argument('--xs-sentinel', dest='xs_sentinel', help="ont: XS tag value written on reads whose leader search was skipped because it could not change\ntheir class (reads starting at ORF1a/ORF1b or at their left primer), e.g. -1. By default they have no XS tag", type=float, default=None)
+    parser.add_argument('--target-precision', dest='target_precision', help="triage: count random chunks of the reads until every ORF and amplicon ratio is known to\nthis relative precision (e.g. 0.05 for +/-5%%), the intervals reached and the fraction of reads\ncounted are written to <OUTPUT_PREFIX>_periscope_precision.csv", type=float, default=None)
+    parser.add_argument('--progress-textfile', dest='progress_textfile', help="write live sgRNA counting progress (reads, classes, throughput, ETA) to this prometheus textfile,\ne.g. <NODE_EXPORTER_TEXTFILE_DIR>/periscope_<SAMPLE>.prom", default=None)
+    parser.add_argument('--progress-interval', dest='progress_interval', help="seconds between progress textfile updates (15)", type=float, default=15)
+    parser.add_argument('--profile', help="profile sgRNA counting in the parent and every worker:\n* all (default) - sampling profiler and cProfile\n* sample - sampling profiler only, lowest overhead\n* cprofile - cProfile only\nwrites <OUTPUT_PREFIX>_periscope_profile.collapsed (flame graph) and <OUTPUT_PREFIX>_periscope_profile.pstats", nargs='?', const='all', choices=['all', 'sample', 'cprofile'], default=None)
 
     print("""
              /yddmmmddds:                         
@@ -118,23 +181,11 @@ oso/.`.````..-+ssss+-`..```..-omhss+-` .ms``.-/oso
         
     
     #check if version number is correct or if resource files exist when using custom primers
-    version = args.artic_primers
-    version = [version] if isinstance(version, str) else version
     interest_bed = "artic_amplicons_of_interest.bed"
-    
-    if version[0] in ["V1", "V2", "V3", "V4", "V4.1", "2kb", "midnight"]:
-        amplicons_bed=os.path.join(resources_dir, "artic_amplicons_{}.bed".format(version[0]))
-        primers_bed=os.path.join(resources_dir, "artic_primers_{}.bed".format(version[0]))
-    elif len(version)>1:
-        amplicons_bed=version[0]
-        primers_bed=version[1]
-
-        for file in [amplicons_bed, primers_bed]:
-            if not os.path.exists(file):
-                print("Cannot find resource file {}".format(file), file=sys.stderr)
-                exit(1)
-    else:
-        print("{} artic primer version incorrect".format(version[0]), file=sys.stderr)
+    try:
+        amplicons_bed, primers_bed = get_primer_beds(args.artic_primers, resources_dir)
+    except ValueError as e:
+        print(e, file=sys.stderr)
         exit(1)
 
     # default mapping_threads to sgRNA counting threads specified
@@ -143,6 +194,20 @@ oso/.`.````..-+ssss+-`..```..-omhss+-` .ms``.-/oso
     else: 
         mapping_threads = args.threads
 
+    # --cores plans the run and sets the threads from it, the python engine plans in run()
+    if args.cores and args.engine != "python":
+        from periscope.plan import plan, summary
+        try:
+            planned = plan(args.technology, fastq=args.fastq, fastq_dir=args.fastq_dir, cores=args.cores,
+                           max_memory=args.max_memory, chunk_reads=args.chunk_reads, artic_primers=args.artic_primers,
+                           resources=resources_dir)
+        except (ValueError, OSError) as e:
+            print(e, file=sys.stderr)
+            exit(1)
+        print(summary(planned), file=sys.stderr)
+        args.threads = planned["allocation"]["threads"]
+        mapping_threads = planned["allocation"]["mapping_threads"]
+
     config = dict(
         fastq_dir=args.fastq_dir,
         extension=extension,
@@ -161,11 +226,106 @@ oso/.`.````..-+ssss+-`..```..-omhss+-` .ms``.-/oso
         threads=args.threads,
         mapping_threads=mapping_threads,
         tmp=args.tmp,
-        technology=args.technology
+        technology=args.technology,
+        chunk_reads=args.chunk_reads,
+        output_format=args.output_format,
+        io_threads=args.io_threads,
+        columnar=args.columnar,
+        tagged_bam=args.tagged_bam,
+        grna_subsample=args.grna_subsample,
+        bam_compression=args.bam_compression,
+        max_memory=args.max_memory,
+        target_precision=args.target_precision,
+        xs_sentinel=args.xs_sentinel,
+        leader_margin=args.leader_margin,
+        progress_textfile=args.progress_textfile,
+        progress_interval=args.progress_interval,
+        profile=args.profile
     )
 
     print(config['threads'], config['mapping_threads'])
 
+    if args.engine == "python":
+        from periscope.runner import run
+
+        result = run(
+            fastq=args.fastq,
+            fastq_dir=args.fastq_dir,
+            technology=args.technology,
+            output_prefix=args.output_prefix,
+            sample=args.sample,
+            artic_primers=args.artic_primers,
+            score_cutoff=args.score_cutoff,
+            threads=args.threads,
+            mapping_threads=mapping_threads,
+            resources=resources_dir,
+            tmp=args.tmp,
+            chunk_reads=args.chunk_reads,
+            progress_textfile=args.progress_textfile,
+            progress_interval=args.progress_interval,
+            profile=args.profile,
+            index_cache=args.index_cache,
+            cache_dir=None if args.force else args.cache_dir,
+            cache_max_size=args.cache_max_size,
+            target_precision=args.target_precision,
+            xs_sentinel=args.xs_sentinel,
+            leader_margin=args.leader_margin,
+            output_format=args.output_format,
+            io_threads=args.io_threads,
+            columnar=args.columnar,
+            tagged_bam=args.tagged_bam,
+            grna_subsample=args.grna_subsample,
+            bam_compression=args.bam_compression,
+            max_memory=args.max_memory,
+            cores=args.cores
+        )
+        print("{} ORFs counted from {} mapped reads".format(len(result.counts), result.metrics["mapped_reads"]))
+        exit(0)
+
+
+    # results (or the alignment) of a sample seen before are restored from the cache, the pipeline then skips the
+    # steps whose outputs exist
+    cache = None
+    if args.cache_dir and not args.dry_run:
+        from periscope.cache import ResultCache, cache_keys, parse_size, result_outputs
+        from periscope.runner import find_fastqs
+        cache = ResultCache(args.cache_dir, parse_size(args.cache_max_size) if args.cache_max_size else None)
+        fastq = args.fastq or find_fastqs(args.fastq_dir)
+        keys = cache_keys(args.technology, os.path.join(resources_dir, config['reference_fasta']), primers_bed, amplicons_bed,
+                          os.path.join(resources_dir, config['orf_bed']), args.score_cutoff, fastq=fastq,
+                          target_precision=args.target_precision, leader_margin=args.leader_margin,
+                          output_format=args.output_format, columnar=args.columnar, sample=args.sample,
+                          tagged_bam=args.tagged_bam, grna_subsample=args.grna_subsample, xs_sentinel=args.xs_sentinel,
+                          bam_compression=args.bam_compression)
+        if os.path.dirname(args.output_prefix):
+            os.makedirs(os.path.dirname(args.output_prefix), exist_ok=True)
+        if not args.force:
+            aligned = cache.restore("alignment", keys["alignment"], args.output_prefix)
+            if aligned and cache.restore("results", keys["results"], args.output_prefix):
+                print("restored {} from the cache".format(args.output_prefix), file=sys.stderr)
+                exit(0)
+
+    # the prebuilt aligner index, checked (and built when it's missing or stale) here rather than in a rule so that
+    # snakemake never deletes an index other samples are using, timed like the snakemake stages
+    from periscope.indexes import aligner_index, default_cache_dir
+    from periscope.metrics import Metrics
+    metrics = Metrics(args.output_prefix)
+    reference = os.path.join(resources_dir, config['reference_fasta'])
+    index_cache = args.index_cache or default_cache_dir(resources_dir)
+    with metrics.stage("aligner_index", inputs=[reference]):
+        config['reference_index'] = aligner_index(args.technology, reference, index_cache, build=not args.dry_run)
+    # the compiled primer scheme the counting workers memory map, shipped for the bundled primer versions
+    if not args.dry_run:
+        from periscope.scheme import bundled_scheme, resolve_scheme
+        version = [args.artic_primers] if isinstance(args.artic_primers, str) else args.artic_primers
+        with metrics.stage("scheme", inputs=[amplicons_bed, primers_bed]):
+            config['scheme'] = resolve_scheme(amplicons_bed, primers_bed, os.path.join(resources_dir, config['orf_bed']),
+                                              reference, index_cache, bundled_scheme(version[0], resources_dir))
+        if os.path.dirname(args.output_prefix):
+            os.makedirs(os.path.dirname(args.output_prefix), exist_ok=True)
+        with open(args.output_prefix + "_periscope_stages.jsonl", "a") as f:
+            for stage in metrics.stages:
+                f.write(json.dumps(stage) + "\n")
 
     snakefile = os.path.join(scripts_dir, 'Snakefile')
     print(snakefile)
@@ -175,11 +335,25 @@ oso/.`.````..-+ssss+-`..```..-omhss+-` .ms``.-/oso
     else:
         print("Found the snakefile")
 
+    # snakemake is slow to import, only pay for it once we know we are going to run the pipeline
+    import snakemake
+
     status = snakemake.snakemake(snakefile, printshellcmds=True,
                                  dryrun=args.dry_run, forceall=args.force, force_incomplete=True,
-                                 config=config, cores=int(args.threads), lock=False
+                                 config=config, cores=int(args.cores or args.threads), lock=False
                                  )
     if status:  # translate "success" into shell exit code of 0
+        if cache:
+            from periscope.alignments import extension, index_path
+            aligned_bam = args.output_prefix + extension(args.output_format)
+            cache.put("alignment", keys["alignment"], args.output_prefix, dict(bam=aligned_bam, bai=index_path(aligned_bam)))
+            results = {name: args.output_prefix + "_periscope_{}.csv".format(name) for name in result_outputs + (["precision"] if args.target_precision else [])}
+            if args.technology == "ont" and args.tagged_bam != "none":
+                results["tagged_bam"] = args.output_prefix + "_periscope" + extension(args.output_format)
+            if args.columnar:
+                from periscope.columnar import outputs as columnar_tables
+                results.update({"columnar_" + table: file for table, file in columnar_tables(args.output_prefix, args.technology, args.columnar).items()})
+            cache.put("results", keys["results"], args.output_prefix, results)
         exit(0)
 
     exit(1)
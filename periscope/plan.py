@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# plan a run: sample the input, predict the wall time and peak memory of each stage and split the cores between them
+#
+#   periscope plan --technology ont --bam <BAM> --cores 16 --max-memory 32G
+#
+# writes the plan as json, for a cluster scheduler to size the job, and `periscope --cores 16` (cores= in the python
+# api) uses it to set --threads and --mapping-threads. The input is sampled, not read:
+#
+#   reads              from the bam index, counted for a cram (a .crai has no read counts) and estimated from the file
+#                      sizes and the bytes of the first records for fastqs
+#   mean read length   of --sample-reads reads, from windows spread along the reference for a bam, the first records of
+#                      a fastq
+#   leader hit rate    the fraction of those reads with the 3' end of the leader near their 5' end
+#   classification     an aligned input has the sampled reads classified and timed, fastqs use the rates below
+#
+# the aligner, samtools and classification rates below are rough, for the ~30kb reference, and the predictions are no
+# better than them. Alignment and sorting run as a pipe so they share the cores, classification runs once they are
+# done and gets every core the memory budget allows, no more than there are chunks.
+import argparse
+import gzip
+import json
+import math
+import os
+import sys
+
+# seconds of cpu per read classified, about twice the rate measured on the simulated reads (real reads need more leader
+# alignments), used when the input is not aligned yet
+default_classify_seconds = dict(ont=100e-6, illumina=30e-6)
+# seconds to read a record, the chunking pass
+read_seconds = 2e-6
+# aligned bases per second per mapping thread, minimap2 map-ont and bwa mem
+aligner_bases_per_second = dict(ont=5e6, illumina=3e6)
+# resident memory of the aligner and per mapping thread, minimap2 holds a 500M base batch
+aligner_bytes = dict(ont=(600 * 2 ** 20, 50 * 2 ** 20), illumina=(100 * 2 ** 20, 30 * 2 ** 20))
+# samtools sort, records per second and its default -m 768M buffer, bytes per record are the read length and about 100
+sort_records_per_second = 500000
+sort_buffer_bytes = 768 * 2 ** 20
+# samtools index, records per second
+index_records_per_second = 2000000
+# the leader's 3' end, searched for in the first bases of the sampled reads
+leader_kmer = "TCTTGTAGATCT"
+leader_window = 100
+default_sample_reads = 2000
+
+
+def reverse_complement(sequence):
+    return sequence.translate(str.maketrans("ACGTN", "TGCAN"))[::-1]
+
+
+def leader_hit(sequence, both_strands=False):
+    if leader_kmer in sequence[:leader_window]:
+        return True
+    return both_strands and reverse_complement(leader_kmer) in sequence[-leader_window:]
+
+
+def sample_alignments(bam, sample_reads=default_sample_reads, reference=None, windows=10):
+    """
+    the read count of an aligned input and a sample of its reads, from windows spread evenly along the reference (the
+    first reads of a sorted bam are all from the first amplicon)
+
+    :param bam: the bam (or cram), indexed
+    :param sample_reads: number of reads sampled
+    :param reference: the reference fasta, for a cram
+    :param windows: number of windows the sample is taken from
+    :return: dictionary of the "reads", where they came from ("reads_source"), the "sampled_reads", their
+    "mean_read_length" and "leader_hit_rate" and the "chunks" of the sampled reads for
+    periscope.chunks.chunk_reads
+    """
+    import pysam
+    from periscope.alignments import is_cram, open_alignments, samtools_options
+
+    lengths = []
+    hits = 0
+    chunks = []
+    with open_alignments(bam, reference=reference) as f:
+        length = sum(f.lengths)
+        per_window = max(1, sample_reads // windows)
+        for window in range(windows):
+            # the window's start on the references laid end to end
+            offset = window * length // windows
+            reference_id = 0
+            while offset >= f.lengths[reference_id]:
+                offset -= f.lengths[reference_id]
+                reference_id += 1
+            begin = (reference_id, offset)
+            end = None
+            reads = 0
+            last = None
+            for read in f.fetch(f.get_reference_name(reference_id), offset):
+                if read.reference_start < offset:
+                    continue
+                position = (read.reference_id, read.reference_start)
+                # a window ends between read start positions, as the chunks do
+                if reads >= per_window and position != last:
+                    end = position
+                    break
+                lengths.append(read.infer_read_length() or read.query_length or 0)
+                hits += bool(read.query_sequence) and leader_hit(read.query_sequence)
+                reads += 1
+                last = position
+            if reads:
+                chunks.append((begin, end, reads))
+            if end is None:
+                # the window ran to the end of the reference, the windows after it would overlap
+                break
+        if is_cram(bam):
+            count = int(pysam.view(*["-c"] + samtools_options(bam, reference) + [bam]).strip())
+            reads_source = "cram records"
+        else:
+            count = f.mapped + f.unmapped
+            reads_source = "bam index"
+    return dict(reads=count, reads_source=reads_source, sampled_reads=len(lengths),
+                mean_read_length=sum(lengths) / len(lengths) if lengths else 0,
+                leader_hit_rate=hits / len(lengths) if lengths else 0, chunks=chunks)
+
+
+def sample_fastqs(fastqs, sample_reads=default_sample_reads):
+    """
+    estimate the reads of fastqs from their size and the bytes of their first records
+
+    :param fastqs: list of fastq files, gzipped or not
+    :param sample_reads: number of records sampled from the first file
+    :return: dictionary of the "reads", "reads_source", "sampled_reads", "mean_read_length" and "leader_hit_rate"
+    """
+    lengths = []
+    hits = 0
+    with open(fastqs[0], "rb") as raw:
+        f = gzip.GzipFile(fileobj=raw) if fastqs[0].endswith(".gz") else raw
+        while len(lengths) < sample_reads:
+            record = [f.readline() for _ in range(4)]
+            if not record[3]:
+                break
+            sequence = record[1].strip().decode()
+            lengths.append(len(sequence))
+            hits += leader_hit(sequence, both_strands=True)
+        # the compressed bytes read so far, gzip reads ahead so this is a slight overestimate for a gzipped file
+        exhausted = not f.readline()
+        consumed = raw.tell()
+    total_bytes = sum(os.path.getsize(fastq) for fastq in fastqs)
+    if exhausted and len(fastqs) == 1:
+        reads = len(lengths)
+    else:
+        reads = int(round(total_bytes / (consumed / max(1, len(lengths)))))
+    return dict(reads=reads, reads_source="fastq size", sampled_reads=len(lengths),
+                mean_read_length=sum(lengths) / len(lengths) if lengths else 0,
+                leader_hit_rate=hits / len(lengths) if lengths else 0)
+
+
+def classify_sample(bam, technology, chunks, artic_primers="V1", resources=None, reference=None, score_cutoff=50):
+    """
+    classify and time the sampled reads
+
+    :param bam: the bam (or cram)
+    :param technology: ont or illumina
+    :param chunks: the chunks of sampled reads from sample_alignments
+    :param artic_primers: artic primer version or [amplicons_bed, primers_bed]
+    :param resources: the periscope resources directory
+    :param reference: the reference fasta, for a cram
+    :param score_cutoff: cut-off for alignment score of leader
+    :return: the cpu seconds per read classified
+    """
+    import tempfile
+    from periscope.indexes import default_cache_dir
+    from periscope.periscope import get_primer_beds
+    from periscope.scheme import bundled_scheme, resolve_scheme
+    if technology == "ont":
+        from periscope.scripts import search_for_sgRNA_ont as classifier
+    else:
+        from periscope.scripts import search_for_sgRNA_illumina as classifier
+
+    if resources is None:
+        resources = os.path.join(os.path.dirname(__file__), "resources")
+    amplicons_bed, primers_bed = get_primer_beds(artic_primers, resources)
+    orf_bed = os.path.join(resources, "orf_start.bed")
+    fasta = os.path.join(resources, "nCoV-2019.reference.fasta")
+    version = [artic_primers] if isinstance(artic_primers, str) else artic_primers
+    scheme = resolve_scheme(amplicons_bed, primers_bed, orf_bed, fasta, default_cache_dir(resources),
+                            bundled_scheme(version[0], resources))
+    with tempfile.TemporaryDirectory() as tmp:
+        args = argparse.Namespace(bam=bam, output_prefix=os.path.join(tmp, "plan"), score_cutoff=score_cutoff,
+                                  orf_bed=orf_bed, primer_bed=primers_bed, amplicon_bed=amplicons_bed, scheme=scheme,
+                                  sample="plan", tagged_bam="none", reference=reference or fasta)
+        # the resources are parsed before the reads are timed, as the workers do
+        classifier.load_resources(args)
+        workers = [classifier.process_reads([bam, args, task, chunk])[1] for task, chunk in enumerate(chunks)]
+    return sum(worker["cpu_seconds"] for worker in workers) / max(1, sum(worker["reads"] for worker in workers))
+
+
+def predict(technology, sampled, cores, max_memory=None, chunk_reads=None, aligned=False):
+    """
+    split the cores between the stages and predict their wall time and peak memory
+
+    :param technology: ont or illumina
+    :param sampled: the input sample, from sample_alignments or sample_fastqs, with the "classify_seconds" per read
+    :param cores: cores the run may use
+    :param max_memory: memory budget in bytes, None for no budget
+    :param chunk_reads: reads per chunk
+    :param aligned: the input is already aligned
+    :return: dictionary of the "allocation" (mapping_threads, threads, chunk_reads) and the "stages", each with its
+    "cores", "wall_seconds" and "peak_memory_bytes"
+    """
+    from periscope.chunks import default_chunk_reads
+    from periscope.spill import memory_plan, process_bytes, read_bytes
+
+    cores = max(1, int(cores))
+    chunk_reads = chunk_reads or default_chunk_reads
+    reads = max(1, sampled["reads"])
+    bases = reads * sampled["mean_read_length"]
+    stages = []
+    mapping_threads = None
+
+    if not aligned:
+        # the aligner and samtools sort run as a pipe, sort takes a core once there are three
+        mapping_threads = cores - 1 if cores > 2 else cores
+        base, per_thread = aligner_bytes[technology]
+        sort_bytes = min(sort_buffer_bytes, reads * (sampled["mean_read_length"] + 100)) + 50 * 2 ** 20
+
+        def align_bytes(threads):
+            return base + per_thread * threads + sort_bytes
+        while max_memory and mapping_threads > 1 and align_bytes(mapping_threads) > max_memory:
+            mapping_threads -= 1
+        if max_memory and align_bytes(mapping_threads) > max_memory:
+            raise ValueError("--max-memory {} is too small to align, give at least {} bytes".format(
+                max_memory, align_bytes(1)))
+        stages.append(dict(name="align", cores=min(cores, mapping_threads + 1),
+                           wall_seconds=max(bases / (aligner_bases_per_second[technology] * mapping_threads),
+                                            reads / sort_records_per_second),
+                           peak_memory_bytes=align_bytes(mapping_threads)))
+        stages.append(dict(name="index", cores=1, wall_seconds=reads / index_records_per_second,
+                           peak_memory_bytes=50 * 2 ** 20))
+
+    stages.append(dict(name="chunking", cores=1, wall_seconds=reads * read_seconds,
+                       peak_memory_bytes=process_bytes))
+
+    # as many workers as there are cores and chunks, fewer when the memory budget can't give each its share
+    threads = cores
+    plan = None
+    while max_memory:
+        try:
+            plan = memory_plan(max_memory, threads, chunk_reads, technology)
+            break
+        except ValueError:
+            if threads == 1:
+                raise
+            threads -= 1
+    chunks = max(1, math.ceil(reads / (plan["chunk_reads"] if plan else chunk_reads)))
+    if threads > chunks:
+        threads = chunks
+        if plan:
+            # fewer workers get bigger shares
+            plan = memory_plan(max_memory, threads, chunk_reads, technology)
+    if plan:
+        chunk_reads = plan["chunk_reads"]
+        chunks = max(1, math.ceil(reads / chunk_reads))
+        # the illumina parent spills its reads past its share
+        parent_bytes = process_bytes + min(plan["parent_bytes"], reads * read_bytes[technology])
+    else:
+        parent_bytes = process_bytes + reads * read_bytes[technology]
+    worker_bytes = process_bytes + min(chunk_reads, reads) * read_bytes[technology]
+    classify_seconds = sampled.get("classify_seconds") or default_classify_seconds[technology]
+    # the chunks go out one at a time, the last round of chunks may leave workers idle
+    stages.append(dict(name="classification", cores=threads,
+                       wall_seconds=math.ceil(chunks / threads) * min(chunk_reads, reads) * classify_seconds,
+                       peak_memory_bytes=parent_bytes + threads * worker_bytes))
+
+    allocation = dict(cores=cores, max_memory=max_memory, mapping_threads=mapping_threads, threads=threads,
+                      chunk_reads=chunk_reads)
+    return dict(allocation=allocation, stages=stages)
+
+
+def plan(technology="ont", bam=None, fastq=None, fastq_dir=None, cores=1, max_memory=None, chunk_reads=None,
+         artic_primers="V1", resources=None, reference=None, sample_reads=default_sample_reads):
+    """
+    sample the input, predict each stage and split the cores
+
+    :param technology: ont or illumina
+    :param bam: an aligned, indexed bam (or cram)
+    :param fastq: list of fastq files, when there is no bam
+    :param fastq_dir: directory of demultiplexed ont fastqs, when there is no bam or fastq
+    :param cores: cores the run may use
+    :param max_memory: memory budget in bytes or as e.g. "16G", None for no budget
+    :param chunk_reads: reads per chunk, defaults to periscope.chunks.default_chunk_reads
+    :param artic_primers: artic primer version or [amplicons_bed, primers_bed], for classifying the sampled reads
+    :param resources: the periscope resources directory
+    :param reference: the reference fasta, for a cram
+    :param sample_reads: number of reads sampled
+    :return: dictionary of the "input" sampled, the "allocation" (mapping_threads, threads and chunk_reads to run
+    with), the "stages" predicted and the total "wall_seconds" and "peak_memory_bytes"
+    """
+    from periscope.cache import parse_size
+
+    if isinstance(max_memory, str):
+        max_memory = parse_size(max_memory)
+    if bam:
+        sampled = sample_alignments(bam, sample_reads, reference)
+        chunks = sampled.pop("chunks")
+        if chunks:
+            sampled["classify_seconds"] = classify_sample(bam, technology, chunks, artic_primers, resources, reference)
+    else:
+        if not fastq and fastq_dir:
+            from periscope.runner import find_fastqs
+            fastq = find_fastqs(fastq_dir)
+        if not fastq:
+            raise ValueError("no input given, provide fastq (or fastq_dir for ont data) or an aligned bam")
+        fastq = [fastq] if isinstance(fastq, str) else list(fastq)
+        sampled = sample_fastqs(fastq, sample_reads)
+
+    predicted = predict(technology, sampled, cores, max_memory, chunk_reads, aligned=bool(bam))
+    return dict(technology=technology, input=sampled, allocation=predicted["allocation"], stages=predicted["stages"],
+                wall_seconds=sum(stage["wall_seconds"] for stage in predicted["stages"]),
+                peak_memory_bytes=max(stage["peak_memory_bytes"] for stage in predicted["stages"]))
+
+
+def summary(planned):
+    # one line per stage, for the log
+    lines = ["plan for {reads} reads ({reads_source}), {threads} counting threads{mapping}".format(
+        mapping="" if planned["allocation"]["mapping_threads"] is None
+        else " and {} mapping threads".format(planned["allocation"]["mapping_threads"]),
+        threads=planned["allocation"]["threads"], **planned["input"])]
+    for stage in planned["stages"] + [dict(name="total", cores=planned["allocation"]["cores"],
+                                           wall_seconds=planned["wall_seconds"],
+                                           peak_memory_bytes=planned["peak_memory_bytes"])]:
+        lines.append("  {name:<15} {cores:>3} cores {wall_seconds:>10.1f}s {memory:>8.0f}M".format(
+            memory=stage["peak_memory_bytes"] / 2 ** 20, **stage))
+    return "\n".join(lines)
+
+
+def get_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='periscope: predict the time and memory of a run and split the cores between its stages, as json')
+    parser.add_argument('--technology', help='the sequencing technology used, ont or illumina (ont)', choices=['ont', 'illumina'], default='ont')
+    parser.add_argument('--bam', help='an aligned, indexed bam (or cram)', default=None)
+    parser.add_argument('--fastq', help='fastq files, R1 and R2 for illumina', nargs='+', default=None)
+    parser.add_argument('--fastq-dir', dest='fastq_dir', help='directory of demultiplexed ont fastqs', default=None)
+    parser.add_argument('--cores', help='cores the run may use (1)', type=int, default=1)
+    parser.add_argument('--max-memory', dest='max_memory', help='memory budget, e.g. 16G (none)', default=None)
+    parser.add_argument('--chunk-reads', dest='chunk_reads', help='reads per chunk (50000)', type=int, default=None)
+    parser.add_argument('--artic-primers', dest='artic_primers', help='artic primer version, or the amplicons and primers files (V1)', nargs='*', default="V1")
+    parser.add_argument('--sample-reads', dest='sample_reads', help='reads sampled ({})'.format(default_sample_reads), type=int, default=default_sample_reads)
+    return parser
+
+
+def main(args):
+    try:
+        planned = plan(args.technology, args.bam, args.fastq, args.fastq_dir, args.cores, args.max_memory,
+                       args.chunk_reads, args.artic_primers, sample_reads=args.sample_reads)
+    except (ValueError, OSError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(summary(planned), file=sys.stderr)
+    json.dump(planned, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(get_parser().parse_args()))
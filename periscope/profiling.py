@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# opt-in profiling of the classification, in the parent and inside every worker (--profile)
+#
+# each process runs a sampling profiler (the stack of the profiled thread is recorded every few milliseconds of cpu
+# time) and, unless --profile sample is given, cProfile. Every worker task dumps its profile next to the
+# outputs and the parent merges them once the pool is done:
+#
+#   <OUTPUT_PREFIX>_periscope_profile.collapsed   collapsed stacks (flamegraph.pl, speedscope, inferno...), one line per
+#                                                 stack rooted at "parent" or "worker" with the number of samples
+#   <OUTPUT_PREFIX>_periscope_profile.pstats      cProfile stats of all processes, python -m pstats <FILE>
+import glob
+import os
+import signal
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds between samples
+default_interval = 0.005
+
+
+class Sampler():
+    """
+    samples the stack of the calling thread, the overhead is a stack walk per sample rather than a hook on every call
+
+    in the main thread (process pool workers, the parent) a SIGPROF timer interrupts the thread every interval of cpu
+    time. Elsewhere (thread pool workers) a background thread samples the stack instead, it can only run when the
+    profiled thread releases the GIL so time in C code holding the GIL (pairwise2) is under-sampled.
+    """
+    def __init__(self, interval=default_interval, root=None):
+        self.thread_id = threading.get_ident()
+        self.interval = interval
+        # stacks are recorded from just above this frame, forked workers inherit the parent's frames below it
+        self.root = root
+        self.stacks = {}
+        self.use_signal = hasattr(signal, "SIGPROF") and threading.current_thread() is threading.main_thread()
+        self._previous_handler = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.use_signal:
+            self._previous_handler = signal.signal(signal.SIGPROF, self._handler)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        else:
+            self._thread = threading.Thread(target=self._run, name="periscope-sampler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self.use_signal:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        else:
+            self._stop.set()
+            if self._thread is not None:
+                self._thread.join()
+
+    def _handler(self, signum, frame):
+        self.record(frame)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.record(frame)
+
+    def record(self, frame):
+        stack = []
+        while frame is not None and frame is not self.root:
+            code = frame.f_code
+            stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        stack = ";".join(reversed(stack))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+
+class Profiler():
+    """
+    profile the calling thread until stop(), then dump() the profile to a partial file for merge_profiles
+    """
+    def __init__(self, mode="all", role="parent", interval=default_interval, root=None):
+        self.mode = mode
+        self.role = role
+        self.sampler = None
+        self.cprofile = None
+        if mode in ["all", "sample"]:
+            self.sampler = Sampler(interval, root)
+        if mode in ["all", "cprofile"]:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+
+    def start(self):
+        if self.sampler:
+            self.sampler.start()
+        if self.cprofile:
+            try:
+                self.cprofile.enable()
+            except ValueError:
+                # only one cProfile can run per process from python 3.12, a thread worker under a profiled parent
+                # falls back to sampling
+                self.cprofile = None
+
+    def stop(self):
+        if self.cprofile:
+            self.cprofile.disable()
+        if self.sampler:
+            self.sampler.stop()
+
+    def dump(self, output_prefix, name):
+        """
+        write this profile's partial files
+        :param output_prefix: the run output prefix
+        :param name: unique name of this profile (process and task)
+        """
+        partial = "{}_periscope_profile.{}".format(output_prefix, name)
+        if self.sampler:
+            with open(partial + ".collapsed", "w") as f:
+                for stack, count in self.sampler.stacks.items():
+                    f.write("{};{} {}\n".format(self.role, stack, count))
+        if self.cprofile:
+            self.cprofile.dump_stats(partial + ".pstats")
+
+
+class Profiled():
+    """
+    wraps a worker function (process_reads) so each call is profiled, it is picklable so it can be handed to a process
+    pool in place of the function
+    """
+    def __init__(self, func, output_prefix, mode="all"):
+        self.func = func
+        self.output_prefix = output_prefix
+        self.mode = mode
+
+    def __call__(self, data):
+        profiler = Profiler(self.mode, "worker", root=sys._getframe())
+        profiler.start()
+        try:
+            return self.func(data)
+        finally:
+            profiler.stop()
+            profiler.dump(self.output_prefix, "{}.{}.{}".format(os.getpid(), threading.get_ident(), time.time()))
+
+
+def merge_profiles(output_prefix):
+    """
+    merge the partial profiles of the parent and workers and remove them
+    :param output_prefix: the run output prefix
+    :return: dictionary of the merged files written ("collapsed" and/or "pstats")
+    """
+    outputs = {}
+
+    partials = sorted(glob.glob(output_prefix + "_periscope_profile.*.collapsed"))
+    if partials:
+        stacks = {}
+        for partial in partials:
+            with open(partial) as f:
+                for line in f:
+                    stack, count = line.rstrip("\n").rsplit(" ", 1)
+                    stacks[stack] = stacks.get(stack, 0) + int(count)
+            os.remove(partial)
+        outputs["collapsed"] = output_prefix + "_periscope_profile.collapsed"
+        with open(outputs["collapsed"], "w") as f:
+            for stack in sorted(stacks):
+                f.write("{} {}\n".format(stack, stacks[stack]))
+
+    partials = sorted(glob.glob(output_prefix + "_periscope_profile.*.pstats"))
+    if partials:
+        import pstats
+        stats = pstats.Stats(partials[0])
+        for partial in partials[1:]:
+            stats.add(partial)
+        outputs["pstats"] = output_prefix + "_periscope_profile.pstats"
+        stats.dump_stats(outputs["pstats"])
+        for partial in partials:
+            os.remove(partial)
+
+    return outputs
+
+
+@contextmanager
+def profile_run(mode, output_prefix, metrics=None):
+    """
+    profile the parent for the duration of the block, then merge it with the worker profiles written meanwhile
+
+        with profile_run(args.profile, args.output_prefix, metrics):
+            classify(args, metrics=metrics)
+
+    :param mode: all, sample or cprofile, nothing is profiled when None
+    :param output_prefix: the run output prefix
+    :param metrics: optional periscope.metrics.Metrics, the merged files are recorded under "profile"
+    """
+    if not mode:
+        yield
+        return
+
+    profiler = Profiler(mode, "parent")
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        profiler.dump(output_prefix, "parent.{}".format(os.getpid()))
+        outputs = merge_profiles(output_prefix)
+        if metrics is not None:
+            metrics.extra["profile"] = outputs
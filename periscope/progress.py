@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# live progress of the read classification, written as a prometheus textfile (for the node exporter textfile
+# collector) while the workers run
+#
+# every task (chunk of the bam) owns one row of a shared array. Workers count into a plain dictionary and copy it to their row
+# every few thousand reads, so the read loop never takes a lock or touches shared memory per read. A thread in the
+# parent sums the rows and rewrites the textfile every --progress-interval seconds with the throughput and an ETA.
+import ctypes
+import multiprocessing
+import os
+import threading
+import time
+
+import pysam
+
+# counters every task reports, the read classes are added after these
+counter_names = ["reads", "alignments_computed", "alignments_skipped", "bytes_written"]
+
+# the shared rows and counter names, set by Progress in the parent (where thread workers see it) and by init_worker in
+# worker processes
+_shared = None
+
+
+def init_worker(shared):
+    """
+    process pool initializer, hand the shared rows to a worker process
+    :param shared: Progress.shared_state() of the parent, None when progress isn't being reported
+    """
+    global _shared
+    _shared = shared
+
+
+class TaskCounter():
+    """
+    the counts of one task, use counts[...] += 1 in the read loop and call flush() every `every` reads and at the end
+    """
+    def __init__(self, task, classes, every=2000):
+        self.task = task
+        self.every = every
+        self.counts = dict.fromkeys(counter_names + list(classes), 0)
+
+    def flush(self, **values):
+        """
+        copy the counts to this task's row of the shared array, does nothing when progress isn't being reported
+        :param values: counters to set rather than count, e.g. bytes_written
+        """
+        self.counts.update(values)
+        if _shared is None or self.task is None:
+            return
+        array, names = _shared
+        offset = self.task * len(names)
+        for i, name in enumerate(names):
+            array[offset + i] = self.counts.get(name, 0)
+
+
+def format_value(value):
+    # the text format spells these NaN and +Inf
+    value = float(value)
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def expected_reads(bam):
+    # mapped reads from the bam index, used for the ETA, None when there's no index. A .crai has no read counts
+    if bam.endswith(".cram"):
+        return None
+    try:
+        with pysam.AlignmentFile(bam, "rb") as f:
+            return f.mapped
+    except (ValueError, OSError):
+        return None
+
+
+class Progress():
+    """
+    the parent side: owns the shared rows and the thread writing the textfile
+
+        progress = Progress(textfile, len(chunks), classes, expected_reads(bam), labels=dict(sample=...))
+        progress.start()
+        ... run the workers with TaskCounter(task, classes) ...
+        progress.stop()
+    """
+    def __init__(self, textfile, tasks, classes, expected=None, labels=None, interval=15):
+        global _shared
+        self.textfile = textfile
+        self.names = counter_names + list(classes)
+        self.classes = list(classes)
+        self.tasks = tasks
+        self.expected = expected
+        self.labels = labels or {}
+        self.interval = float(interval)
+        self.array = multiprocessing.RawArray(ctypes.c_double, tasks * len(self.names))
+        self._stop = threading.Event()
+        self._thread = None
+        self.started = None
+        _shared = self.shared_state()
+
+    def shared_state(self):
+        return (self.array, self.names)
+
+    def totals(self):
+        """
+        :return: dictionary of each counter summed over the tasks
+        """
+        values = list(self.array)
+        width = len(self.names)
+        return {name: sum(values[task * width + i] for task in range(self.tasks)) for i, name in enumerate(self.names)}
+
+    def start(self):
+        self.started = time.time()
+        self.write()
+        self._thread = threading.Thread(target=self._run, name="periscope-progress", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        """
+        stop the thread and write the final counts
+        """
+        global _shared
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write(done=True)
+        _shared = None
+
+    def lines(self, done=False):
+        """
+        :return: the textfile lines in the prometheus text format
+        """
+        totals = self.totals()
+        elapsed = time.time() - self.started if self.started else 0.0
+        reads = totals["reads"]
+        rate = reads / elapsed if elapsed else 0.0
+        if done:
+            eta = 0.0
+        elif self.expected and rate:
+            eta = max(0.0, (self.expected - reads) / rate)
+        else:
+            eta = float("nan")
+
+        def sample(name, value, **extra):
+            labels = dict(self.labels, **extra)
+            label_text = ",".join('{}="{}"'.format(key, str(label).replace("\\", "\\\\").replace('"', '\\"')) for key, label in labels.items())
+            return "{}{{{}}} {}".format(name, label_text, format_value(value))
+
+        def family(name, metric_type, help_text, samples):
+            return ["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, metric_type)] + samples
+
+        lines = []
+        lines += family("periscope_reads_processed_total", "counter", "Reads classified so far.", [sample("periscope_reads_processed_total", reads)])
+        lines += family("periscope_reads_by_class_total", "counter", "Reads classified so far by class.",
+                        [sample("periscope_reads_by_class_total", totals[read_class], **{"class": read_class}) for read_class in self.classes])
+        lines += family("periscope_alignments_total", "counter", "Leader alignments computed or skipped.",
+                        [sample("periscope_alignments_total", totals["alignments_" + result], result=result) for result in ["computed", "skipped"]])
+        lines += family("periscope_bytes_written_total", "counter", "Bytes of annotated reads written.", [sample("periscope_bytes_written_total", totals["bytes_written"])])
+        lines += family("periscope_reads_expected", "gauge", "Mapped reads in the input bam.", [sample("periscope_reads_expected", self.expected or float("nan"))])
+        lines += family("periscope_reads_per_second", "gauge", "Classification throughput since the start.", [sample("periscope_reads_per_second", rate)])
+        lines += family("periscope_eta_seconds", "gauge", "Estimated seconds until every read is classified.", [sample("periscope_eta_seconds", eta)])
+        lines += family("periscope_elapsed_seconds", "gauge", "Seconds since classification started.", [sample("periscope_elapsed_seconds", elapsed)])
+        lines += family("periscope_done", "gauge", "1 once classification has finished.", [sample("periscope_done", 1 if done else 0)])
+        return lines
+
+    def write(self, done=False):
+        # write then rename so the collector never reads a half written file
+        temp = self.textfile + ".tmp"
+        with open(temp, "w") as f:
+            f.write("\n".join(self.lines(done)) + "\n")
+        os.replace(temp, self.textfile)
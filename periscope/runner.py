@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# run periscope in-process: align -> classify -> aggregate, without building a snakemake DAG or starting a new
+# python interpreter for the classification step
+import argparse
+import glob
+import os
+import sys
+
+from periscope.periscope import get_primer_beds
+
+
+class PeriscopeResult():
+    """
+    the structured result of a periscope run
+
+    counts, novel_counts and amplicons are the rows of the output CSVs, one dictionary per row keyed on the CSV header,
+    metrics holds the run metrics (as written to <OUTPUT_PREFIX>_periscope_metrics.json) and outputs the paths of the
+    files written. In triage mode (target_precision) precision holds the rows of the achieved intervals
+    """
+    def __init__(self, counts, novel_counts, amplicons, metrics, outputs, precision=None):
+        self.counts = counts
+        self.novel_counts = novel_counts
+        self.amplicons = amplicons
+        self.metrics = metrics
+        self.outputs = outputs
+        self.precision = precision
+
+
+def find_fastqs(fastq_dir):
+    """
+    find the raw fastqs in a demultiplexed fastq directory, gzipped or not
+    :param fastq_dir: the fastq directory
+    :return: sorted list of fastq files
+    """
+    fastqs = []
+    for extension in ["fastq", "fq", "fastq.gz", "fq.gz"]:
+        fastqs += glob.glob(os.path.join(fastq_dir, "*." + extension))
+    return sorted(fastqs)
+
+
+def align(fastq, bam, technology, reference, threads, metrics, index_cache):
+    """
+    map the reads to the reference and write a sorted, indexed bam, these are the same commands as the snakemake
+    align rule
+    :param fastq: list of fastq files, R1 and R2 for illumina
+    :param bam: the output bam, a cram encoded against the reference when it ends in .cram
+    :param technology: ont or illumina
+    :param reference: the reference fasta
+    :param threads: number of mapping threads
+    :param metrics: the run metrics, one stage is recorded for the aligner index, the mapper, the sort and the index
+    :param index_cache: directory of the cached aligner indexes (periscope.indexes)
+    """
+    import pysam
+    from periscope.alignments import index_path, samtools_options
+    from periscope.indexes import aligner_index
+
+    # the prebuilt index, only built when the reference or the index settings change
+    with metrics.stage("aligner_index", inputs=[reference]):
+        index = aligner_index(technology, reference, index_cache)
+
+    if technology == "illumina":
+        mapper = dict(name="bwa", command=["bwa", "mem", "-Y", "-t", str(threads), index] + fastq)
+    else:
+        mapper = dict(name="minimap2", command=["minimap2", "-ax", "map-ont", "-t", str(threads), index] + fastq)
+    mapper["inputs"] = fastq
+    sort = dict(name="samtools_sort", command=["samtools", "sort"] + samtools_options(bam, reference, output=True) +
+                ["-o", bam, "-"], outputs=[bam])
+    metrics.run_pipeline([mapper, sort])
+
+    with metrics.stage("index", inputs=[bam], outputs=[index_path(bam)]):
+        pysam.index(bam)
+
+
+def run(fastq=None, fastq_dir=None, bam=None, technology="ont", output_prefix="periscope", sample="SAMPLE",
+        artic_primers="V1", score_cutoff=50, threads=1, mapping_threads=None, resources=None, tmp="/tmp",
+        executor=None, chunk_reads=50000, progress_textfile=None, progress_interval=15, profile=None, index_cache=None,
+        cache_dir=None, cache_max_size="20G", target_precision=None, xs_sentinel=None,
+        leader_margin=40, output_format="bam", io_threads=1, columnar=None, tagged_bam="full", grna_subsample=0.0,
+        bam_compression=None, max_memory=None, cores=None):
+    """
+    run periscope in-process, align -> classify -> aggregate, the output files are the same as the snakemake pipeline
+
+    :param fastq: list of fastq files, for illumina R1 and R2
+    :param fastq_dir: directory of demultiplexed ont fastqs, used when fastq is not given
+    :param bam: an already aligned, coordinate sorted and indexed bam (or cram against the bundled reference), skips the
+    alignment
+    :param technology: the sequencing technology used, ont or illumina
+    :param output_prefix: prefix of the output files, e.g. <DIR>/<SAMPLE_NAME>
+    :param sample: sample id
+    :param artic_primers: artic primer version (V1, V2, V3, V4, V4.1, 2kb, midnight) or [amplicons_bed, primers_bed]
+    :param score_cutoff: cut-off for alignment score of leader
+    :param threads: number of workers used for sgRNA counting
+    :param mapping_threads: number of threads used for mapping, defaults to threads
+    :param resources: the periscope resources directory, defaults to the one installed with periscope
+    :param tmp: where pybedtools writes its temporary files
+    :param executor: a concurrent.futures executor used to classify the reads, defaults to a process pool of threads
+    workers
+    :param chunk_reads: reads per chunk of the bam, the chunks are handed to the workers as they become free
+    :param progress_textfile: write live classification progress to this prometheus textfile, e.g. in the node
+    exporter textfile directory
+    :param progress_interval: seconds between progress textfile updates
+    :param profile: profile the run and every worker, "all" (sampling and cProfile), "sample" or "cprofile", the merged
+    profiles are written to <OUTPUT_PREFIX>_periscope_profile.collapsed and .pstats
+    :param index_cache: directory of the cached aligner indexes, defaults to index_cache in the resources directory
+    :param cache_dir: cache aligned bams and results here and restore them when the same inputs are seen again
+    (periscope.cache), nothing is cached when None
+    :param cache_max_size: size the cache is kept within by removing the least recently used entries, e.g. 20G
+    :param target_precision: triage mode, count random chunks of the bam until every ORF and amplicon ratio is known to
+    this relative precision (e.g. 0.05 for +/-5%), the intervals are written to <OUTPUT_PREFIX>_periscope_precision.csv
+    (periscope.triage)
+    :param xs_sentinel: ont, XS tag value for reads whose leader search was skipped because it could not change their
+    class, they have no XS tag when None
+    :param leader_margin: ont, search for the leader in the leading soft clip and this many bases after it, -1 searches
+    the whole read
+    :param output_format: bam or cram, the format of the aligned reads (<OUTPUT_PREFIX>.bam or .cram) and the ont tagged
+    reads, crams are encoded against the bundled reference
+    :param io_threads: pysam threads compressing and decompressing each bam or cram
+    :param columnar: parquet or arrow, also write the tables and a row per read with a declared schema
+    (periscope.columnar), needs pyarrow
+    :param tagged_bam: ont, the reads written to <OUTPUT_PREFIX>_periscope.bam, "none" (no tagged bam), "sgrna" (the
+    sgRNA and nsgRNA reads and grna_subsample of the gRNA reads) or "full" (every read)
+    :param grna_subsample: ont, with tagged_bam="sgrna" the fraction of the gRNA reads also written
+    :param bam_compression: ont, compression level of the tagged bam (0-9), the htslib default when None
+    :param max_memory: memory budget of the classification in bytes or as e.g. "16G", shared by the workers and the
+    parent, the chunks are cut to fit it and the illumina reads are spilled to disk past it (periscope.spill)
+    :param cores: plan the run from a sample of the input and split this many cores between mapping and counting
+    (periscope.plan), within max_memory, this overrides threads and mapping_threads. The plan is in the run metrics
+    :return: a PeriscopeResult
+    """
+    if technology == "ont":
+        from periscope.scripts import search_for_sgRNA_ont as classifier
+    elif technology == "illumina":
+        from periscope.scripts import search_for_sgRNA_illumina as classifier
+    else:
+        raise ValueError("{} is not a supported technology, use ont or illumina".format(technology))
+    from pybedtools import set_tempdir
+    # imported here rather than at the top so `python -m periscope.metrics` doesn't import itself twice via the package
+    from periscope.metrics import Metrics
+    from periscope.profiling import profile_run
+    from periscope.alignments import extension, index_path
+
+    if resources is None:
+        resources = os.path.join(os.path.dirname(__file__), "resources")
+    amplicons_bed, primers_bed = get_primer_beds(artic_primers, resources)
+
+    metrics = Metrics(output_prefix)
+    reference = os.path.join(resources, "nCoV-2019.reference.fasta")
+    orf_bed = os.path.join(resources, "orf_start.bed")
+
+    if bam is None:
+        if fastq:
+            fastq = [fastq] if isinstance(fastq, str) else list(fastq)
+        elif fastq_dir and technology == "ont":
+            fastq = find_fastqs(fastq_dir)
+        else:
+            raise ValueError("no input given, provide fastq (or fastq_dir for ont data) or an aligned bam")
+        for file in fastq:
+            if not os.path.exists(file):
+                raise ValueError("{} fastq file must exist".format(file))
+
+    # split the cores between mapping and counting, from a sample of the input
+    if cores:
+        from periscope.plan import plan, summary
+        planned = plan(technology, bam=bam, fastq=fastq, cores=cores, max_memory=max_memory, chunk_reads=chunk_reads,
+                       artic_primers=artic_primers, resources=resources)
+        print(summary(planned), file=sys.stderr)
+        threads = planned["allocation"]["threads"]
+        mapping_threads = planned["allocation"]["mapping_threads"]
+        metrics.extra["plan"] = planned
+
+    # a sample seen before is restored from the cache, alignment and results are cached separately so a new score
+    # cutoff or primer scheme only reclassifies
+    cache = None
+    if cache_dir:
+        from periscope.cache import ResultCache, cache_keys, parse_size, result_outputs
+        cache = ResultCache(cache_dir, parse_size(cache_max_size) if cache_max_size else None)
+        with metrics.stage("cache_lookup", inputs=fastq or [bam]):
+            keys = cache_keys(technology, reference, primers_bed, amplicons_bed, orf_bed, score_cutoff, fastq=fastq, bam=bam,
+                              target_precision=target_precision, leader_margin=leader_margin, output_format=output_format,
+                              columnar=columnar, sample=sample, tagged_bam=tagged_bam, grna_subsample=grna_subsample,
+                              xs_sentinel=xs_sentinel, bam_compression=bam_compression)
+            cached = cache.restore("results", keys["results"], output_prefix)
+            if cached and bam is None:
+                aligned = cache.restore("alignment", keys["alignment"], output_prefix)
+                bam = aligned["outputs"]["bam"] if aligned else None
+        metrics.extra["cache"] = dict(keys, hit="results" if cached else None)
+        if cached:
+            from periscope.cache import read_tables
+            tables = cached["tables"] or read_tables(cached["outputs"])
+            return finish(metrics, tables, dict(cached["outputs"], bam=bam), output_prefix)
+
+    # with a profile the parent is profiled from alignment to the outputs, the workers per task
+    with profile_run(profile, output_prefix, metrics):
+        # ALIGN
+        if bam is None:
+            bam = output_prefix + extension(output_format)
+            if cache and cache.restore("alignment", keys["alignment"], output_prefix):
+                metrics.extra["cache"]["hit"] = "alignment"
+            else:
+                if index_cache is None:
+                    from periscope.indexes import default_cache_dir
+                    index_cache = default_cache_dir(resources)
+                align(fastq, bam, technology, reference, mapping_threads or threads, metrics, index_cache)
+                if cache:
+                    cache.put("alignment", keys["alignment"], output_prefix, dict(bam=bam, bai=index_path(bam)))
+
+        # the compiled primer scheme, the bundled one for a shipped primer version
+        from periscope.scheme import bundled_scheme, resolve_scheme
+        if index_cache is None:
+            from periscope.indexes import default_cache_dir
+            index_cache = default_cache_dir(resources)
+        version = [artic_primers] if isinstance(artic_primers, str) else artic_primers
+        with metrics.stage("scheme", inputs=[amplicons_bed, primers_bed]):
+            scheme = resolve_scheme(amplicons_bed, primers_bed, orf_bed, reference, index_cache,
+                                    bundled_scheme(version[0], resources))
+
+        # CLASSIFY and AGGREGATE
+        args = argparse.Namespace(
+            bam=bam,
+            output_prefix=output_prefix,
+            score_cutoff=score_cutoff,
+            orf_bed=orf_bed,
+            primer_bed=primers_bed,
+            amplicon_bed=amplicons_bed,
+            scheme=scheme,
+            sample=sample,
+            tmp=tmp,
+            progress="",
+            threads=threads,
+            chunk_reads=chunk_reads,
+            progress_textfile=progress_textfile,
+            progress_interval=progress_interval,
+            profile=profile,
+            target_precision=target_precision,
+            xs_sentinel=xs_sentinel,
+            leader_margin=leader_margin,
+            reference=reference,
+            output_format=output_format,
+            io_threads=io_threads,
+            columnar=columnar,
+            tagged_bam=tagged_bam,
+            grna_subsample=grna_subsample,
+            bam_compression=bam_compression,
+            max_memory=max_memory
+        )
+        set_tempdir(tmp)
+
+        tables = classifier.classify(args, executor=executor, metrics=metrics)
+
+    outputs = dict(
+        bam=bam,
+        counts=output_prefix + "_periscope_counts.csv",
+        novel_counts=output_prefix + "_periscope_novel_counts.csv",
+        amplicons=output_prefix + "_periscope_amplicons.csv"
+    )
+    if target_precision:
+        outputs["precision"] = output_prefix + "_periscope_precision.csv"
+    if technology == "ont" and tagged_bam != "none":
+        outputs["tagged_bam"] = output_prefix + "_periscope" + extension(output_format)
+    columnar_outputs = {}
+    if columnar:
+        from periscope.columnar import outputs as columnar_tables
+        columnar_outputs = {"columnar_" + table: file
+                            for table, file in columnar_tables(output_prefix, technology, columnar).items()}
+        outputs.update(columnar_outputs)
+    if cache:
+        cache.put("results", keys["results"], output_prefix,
+                  dict({name: outputs[name] for name in result_outputs + ["precision", "tagged_bam"] if name in outputs},
+                       **columnar_outputs), tables)
+    for kind, file in metrics.extra.get("profile", {}).items():
+        outputs["profile_" + kind] = file
+    return finish(metrics, tables, outputs, output_prefix)
+
+
+def finish(metrics, tables, outputs, output_prefix):
+    """
+    write the run metrics and build the result
+    :param metrics: the run metrics
+    :param tables: the result tables from the classifier (or the cache)
+    :param outputs: dictionary of the outputs written, the metrics file is added to it
+    :param output_prefix: prefix of the output files
+    :return: a PeriscopeResult
+    """
+    metrics.extra["mapped_reads"] = tables["mapped_reads"]
+    outputs["metrics"] = output_prefix + "_periscope_metrics.json"
+    metrics.write(outputs["metrics"])
+    return PeriscopeResult(tables["counts"], tables["novel_counts"], tables["amplicons"], metrics.to_dict(), outputs,
+                           tables.get("precision"))
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+# compiled primer schemes: an amplicon bed, a primer bed and the ORF bed checked and packed into one binary bundle
+#
+# the bundle is memory mapped by every worker, the arrays are used in place (no parsing, no copy) and the pages are
+# shared between processes. It holds:
+#
+#   a primer index        the nearest LEFT primer (by start) and RIGHT primer (by end) of every reference position,
+#                         the same primer artic's find_primer returns, so finding a read's amplicon is two array reads
+#   an amplicon lookup    the (up to two, where amplicons overlap) amplicons covering every reference position
+#   an ORF map            the amplicons covering each ORF start window
+#   pool labels           the pool of every primer and amplicon
+#
+# the bundled schemes ship compiled in resources/schemes. Custom primer beds given to --artic-primers are compiled into
+# the index cache on their first run, or can be checked and compiled ahead of time with
+#
+#   periscope compile-scheme --amplicon-bed <AMPLICONS> --primer-bed <PRIMERS> --output <SCHEME>.pscheme
+#
+# file layout: 8 byte magic, uint32 format version, uint32 length of the json metadata, the metadata, then the arrays
+# (little endian, each 8 byte aligned) at the offsets listed in the metadata
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+from periscope import __version__
+
+magic = b"PSCHEME\0"
+format_version = 1
+extension = ".pscheme"
+
+
+def amplicon_number(name):
+    # nCoV-2019_71_LEFT, SARSCoV2120_1_RIGHT, nCoV-2019_71 -> 71
+    try:
+        return int(name.split("_")[1])
+    except (IndexError, ValueError):
+        raise ValueError("can't find the amplicon number in {}, names must look like <SCHEME>_<NUMBER>[_LEFT|_RIGHT]".format(name))
+
+
+def amplicon_bed_number(name):
+    # amplicon bed names are nCoV-2019_1, SARS-CoV-2_INSERT_1 or just 1 depending on the scheme
+    try:
+        return int(name.split("_")[-1])
+    except ValueError:
+        raise ValueError("can't find the amplicon number in {}, names must end in the amplicon number".format(name))
+
+
+def bed_rows(bed, columns):
+    """
+    :param bed: bed file
+    :param columns: number of columns required
+    :return: list of (line number, fields)
+    """
+    rows = []
+    with open(bed) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < columns:
+                raise ValueError("{} line {}: expected {} tab separated columns, found {}".format(bed, number, columns, len(fields)))
+            try:
+                fields[1], fields[2] = int(fields[1]), int(fields[2])
+            except ValueError:
+                raise ValueError("{} line {}: start and end must be integers".format(bed, number))
+            if fields[1] >= fields[2]:
+                raise ValueError("{} line {}: start must be before end".format(bed, number))
+            rows.append((number, fields))
+    return rows
+
+
+def read_primers(primer_bed):
+    """
+    read the primers the way artic's read_bed_file does: the primers in file order, then each alternative primer
+    (_alt) widens the primer it is an alternative for, or is added at the end when there isn't one
+    :param primer_bed: the primer bed
+    :return: list of primer dictionaries (chrom, start, end, Primer_ID, PoolName, direction)
+    """
+    primers = {}
+    alts = []
+    for number, fields in bed_rows(primer_bed, 5):
+        chrom, start, end, primer_id, pool = fields[:5]
+        if "LEFT" in primer_id:
+            direction = "+"
+        elif "RIGHT" in primer_id:
+            direction = "-"
+        else:
+            raise ValueError("{} line {}: {} is neither a LEFT nor a RIGHT primer".format(primer_bed, number, primer_id))
+        amplicon_number(primer_id)
+        primer = dict(chrom=chrom, start=start, end=end, Primer_ID=primer_id, PoolName=pool, direction=direction)
+        if "_alt" in primer_id:
+            alts.append(primer)
+        elif primer_id in primers:
+            raise ValueError("{} line {}: {} is given twice".format(primer_bed, number, primer_id))
+        else:
+            primers[primer_id] = primer
+
+    for alt in alts:
+        primer_id = alt["Primer_ID"].split("_alt")[0]
+        if primer_id not in primers:
+            primers[primer_id] = alt
+            continue
+        primer = primers[primer_id]
+        primer["start"] = min(primer["start"], alt["start"])
+        primer["end"] = max(primer["end"], alt["end"])
+    return list(primers.values())
+
+
+def read_named_bed(bed):
+    # (chrom, start, end, name) rows of an amplicon or ORF bed
+    return [tuple(fields[:4]) for _, fields in bed_rows(bed, 4)]
+
+
+def reference_length(reference):
+    """
+    :param reference: fasta with one sequence
+    :return: (name, length) of the sequence
+    """
+    name, length = None, 0
+    with open(reference) as f:
+        for line in f:
+            if line.startswith(">"):
+                if name is not None:
+                    raise ValueError("{} has more than one sequence".format(reference))
+                name = line[1:].split()[0]
+            else:
+                length += len(line.strip())
+    return name, length
+
+
+def nearest(positions, length):
+    """
+    for every position 0..length the index of the nearest of positions, the first in file order on a tie (what min()
+    over the primers in artic's find_primer returns)
+    :param positions: primer starts (LEFT) or ends (RIGHT) in file order
+    :param length: the reference length
+    :return: int32 array of length + 1 indexes into positions
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    indexes = np.empty(length + 1, dtype=np.int32)
+    # in blocks of positions to keep the distance matrix small, argmin takes the first of equal distances
+    for start in range(0, length + 1, 4096):
+        query = np.arange(start, min(start + 4096, length + 1))
+        indexes[query] = np.abs(positions[None, :] - query[:, None]).argmin(axis=1)
+    return indexes
+
+
+def compile_scheme(amplicon_bed, primer_bed, orf_bed, reference, output, name=None):
+    """
+    check a scheme and write its bundle
+
+    :param amplicon_bed: the amplicon bed
+    :param primer_bed: the primer bed
+    :param orf_bed: the ORF start bed
+    :param reference: the reference fasta, for the sequence name and length
+    :param output: the bundle to write
+    :param name: name of the scheme, defaults to the primer bed file name
+    :return: the bundle metadata
+    """
+    chrom, length = reference_length(reference)
+    primers = read_primers(primer_bed)
+    amplicons = read_named_bed(amplicon_bed)
+    orfs = read_named_bed(orf_bed)
+
+    # every row is on the reference and every amplicon has both primers and one pool
+    for bed, rows in [(primer_bed, [(p["chrom"], p["start"], p["end"], p["Primer_ID"]) for p in primers]), (amplicon_bed, amplicons), (orf_bed, orfs)]:
+        for row_chrom, start, end, row_name in rows:
+            if row_chrom != chrom:
+                raise ValueError("{}: {} is on {}, the reference is {}".format(bed, row_name, row_chrom, chrom))
+            if end > length:
+                raise ValueError("{}: {} ends at {}, after the end of the reference ({})".format(bed, row_name, end, length))
+    pools = []
+    primer_pools = {}
+    for primer in primers:
+        if primer["PoolName"] not in pools:
+            pools.append(primer["PoolName"])
+        number = amplicon_number(primer["Primer_ID"])
+        primer_pools.setdefault(number, set()).add(primer["PoolName"])
+    for direction, label in [("+", "LEFT"), ("-", "RIGHT")]:
+        numbers = {amplicon_number(p["Primer_ID"]) for p in primers if p["direction"] == direction}
+        missing = sorted(set(primer_pools) - numbers)
+        if missing:
+            raise ValueError("{}: amplicon(s) {} have no {} primer".format(primer_bed, ", ".join(str(n) for n in missing), label))
+    for number, amplicon_pools in primer_pools.items():
+        if len(amplicon_pools) > 1:
+            raise ValueError("{}: the primers of amplicon {} are in more than one pool ({})".format(primer_bed, number, ", ".join(sorted(amplicon_pools))))
+    numbers = [amplicon_bed_number(row[3]) for row in amplicons]
+    unknown = sorted(set(numbers) - set(primer_pools))
+    if unknown:
+        raise ValueError("{}: amplicon(s) {} have no primers in {}".format(amplicon_bed, ", ".join(str(n) for n in unknown), primer_bed))
+    if len(set(numbers)) != len(numbers):
+        raise ValueError("{}: an amplicon is given more than once".format(amplicon_bed))
+
+    arrays = {}
+    arrays["primer_start"] = np.array([p["start"] for p in primers], dtype=np.int32)
+    arrays["primer_end"] = np.array([p["end"] for p in primers], dtype=np.int32)
+    arrays["primer_amplicon"] = np.array([amplicon_number(p["Primer_ID"]) for p in primers], dtype=np.int32)
+    arrays["primer_pool"] = np.array([pools.index(p["PoolName"]) for p in primers], dtype=np.int16)
+    for direction, key, field in [("+", "nearest_left", "start"), ("-", "nearest_right", "end")]:
+        indexes = [i for i, p in enumerate(primers) if p["direction"] == direction]
+        arrays[key] = np.array(indexes, dtype=np.int16)[nearest([primers[i][field] for i in indexes], length)]
+
+    arrays["amplicon_number"] = np.array(numbers, dtype=np.int32)
+    arrays["amplicon_start"] = np.array([row[1] for row in amplicons], dtype=np.int32)
+    arrays["amplicon_end"] = np.array([row[2] for row in amplicons], dtype=np.int32)
+    arrays["amplicon_pool"] = np.array([pools.index(next(iter(primer_pools[n]))) for n in numbers], dtype=np.int16)
+    # the amplicons covering each position, -1 where there are fewer than two
+    covering = np.full((length + 1, 2), -1, dtype=np.int16)
+    for number, start, end in zip(numbers, arrays["amplicon_start"], arrays["amplicon_end"]):
+        span = covering[start:end]
+        first = span[:, 0] == -1
+        second = ~first & (span[:, 1] == -1)
+        span[first, 0] = number
+        span[second, 1] = number
+    arrays["position_amplicons"] = covering
+
+    offsets, orf_amplicons = [0], []
+    for _, start, end, _ in orfs:
+        orf_amplicons += [number for number, a_start, a_end in zip(numbers, arrays["amplicon_start"], arrays["amplicon_end"]) if a_start < end and start < a_end]
+        offsets.append(len(orf_amplicons))
+    arrays["orf_start"] = np.array([row[1] for row in orfs], dtype=np.int32)
+    arrays["orf_end"] = np.array([row[2] for row in orfs], dtype=np.int32)
+    arrays["orf_amplicon_offsets"] = np.array(offsets, dtype=np.int32)
+    arrays["orf_amplicon_numbers"] = np.array(orf_amplicons, dtype=np.int32)
+
+    metadata = dict(
+        name=name or os.path.basename(primer_bed),
+        periscope_version=__version__,
+        reference=chrom,
+        genome_length=length,
+        sources=scheme_sources(amplicon_bed, primer_bed, orf_bed),
+        pools=pools,
+        primer_ids=[p["Primer_ID"] for p in primers],
+        primer_directions="".join(p["direction"] for p in primers),
+        amplicon_names=[row[3] for row in amplicons],
+        orfs=[row[3] for row in orfs],
+        arrays={}
+    )
+
+    # array offsets are from the start of the data, which follows the metadata at the next multiple of 8 bytes
+    position = 0
+    layout = []
+    for key, array in arrays.items():
+        array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+        layout.append((key, array, position))
+        metadata["arrays"][key] = [position, array.dtype.str, list(array.shape)]
+        position += -(-array.nbytes // 8) * 8
+    header = json.dumps(metadata, sort_keys=True).encode()
+    data_start = -(-(len(magic) + 8 + len(header)) // 8) * 8
+
+    temp = "{}.{}.tmp".format(output, os.getpid())
+    with open(temp, "wb") as f:
+        f.write(magic + struct.pack("<II", format_version, len(header)) + header)
+        for key, array, offset in layout:
+            f.write(b"\0" * (data_start + offset - f.tell()))
+            f.write(array.tobytes())
+    os.replace(temp, output)
+    return metadata
+
+
+class Scheme():
+    """
+    a compiled scheme, memory mapped; iterating over it gives the primers as artic primer dictionaries so it can be
+    used anywhere the parsed primer bed is
+
+        scheme = Scheme("V3.pscheme")
+        distance, signed_distance, primer = scheme.find_primer(read.reference_start, "+")
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(magic)] != magic:
+            raise ValueError("{} is not a compiled periscope scheme".format(path))
+        version, header_length = struct.unpack_from("<II", self._map, len(magic))
+        if version != format_version:
+            raise ValueError("{} is scheme format {}, this periscope reads format {}, compile it again".format(path, version, format_version))
+        start = len(magic) + 8
+        self.metadata = json.loads(self._map[start:start + header_length].decode())
+        data_start = -(-(start + header_length) // 8) * 8
+        for key, (offset, dtype, shape) in self.metadata["arrays"].items():
+            count = int(np.prod(shape))
+            # a view of the mapped file, nothing is copied
+            setattr(self, key, np.frombuffer(self._map, dtype=np.dtype(dtype), count=count, offset=data_start + offset).reshape(shape))
+        self.genome_length = self.metadata["genome_length"]
+        self.pools = self.metadata["pools"]
+        self.orfs = self.metadata["orfs"]
+        self.primers = [
+            dict(chrom=self.metadata["reference"], start=int(start), end=int(end), Primer_ID=primer_id,
+                 PoolName=self.pools[pool], direction=direction)
+            for start, end, primer_id, pool, direction in zip(self.primer_start, self.primer_end, self.metadata["primer_ids"],
+                                                              self.primer_pool, self.metadata["primer_directions"])
+        ]
+        self._orf_index = {orf: i for i, orf in enumerate(self.orfs)}
+        self._amplicon_pool = {int(number): self.pools[pool] for number, pool in zip(self.amplicon_number, self.amplicon_pool)}
+
+    def __iter__(self):
+        return iter(self.primers)
+
+    def __len__(self):
+        return len(self.primers)
+
+    def __getstate__(self):
+        # pickled as its path, the other process maps the file itself
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def position(self, position):
+        return min(max(int(position), 0), self.genome_length)
+
+    def find_primer(self, position, direction):
+        """
+        the nearest primer, as artic's find_primer
+        :param position: reference position
+        :param direction: "+" for the nearest LEFT primer by start, "-" for the nearest RIGHT primer by end
+        :return: (distance, signed distance, primer dictionary)
+        """
+        if direction == "+":
+            primer = self.primers[self.nearest_left[self.position(position)]]
+            signed = primer["start"] - position
+        else:
+            primer = self.primers[self.nearest_right[self.position(position)]]
+            signed = primer["end"] - position
+        return abs(signed), signed, primer
+
+    def amplicons_at(self, position):
+        """
+        :return: tuple of the amplicon numbers covering a position
+        """
+        return tuple(int(number) for number in self.position_amplicons[self.position(position)] if number != -1)
+
+    def orf_amplicons(self, orf):
+        """
+        :return: list of the amplicon numbers covering an ORF start window
+        """
+        i = self._orf_index[orf]
+        return [int(number) for number in self.orf_amplicon_numbers[self.orf_amplicon_offsets[i]:self.orf_amplicon_offsets[i + 1]]]
+
+    def pool(self, amplicon):
+        """
+        :return: the pool label of an amplicon
+        """
+        return self._amplicon_pool[amplicon]
+
+
+def scheme_sources(amplicon_bed, primer_bed, orf_bed):
+    from periscope.indexes import file_checksum
+    return dict(amplicon_bed=file_checksum(amplicon_bed), primer_bed=file_checksum(primer_bed), orf_bed=file_checksum(orf_bed))
+
+
+def resolve_scheme(amplicon_bed, primer_bed, orf_bed, reference, cache_dir, bundled=None):
+    """
+    the compiled scheme for a set of bed files: the bundled one when it was compiled from exactly these files,
+    otherwise one compiled into the cache directory (once, later runs reuse it)
+
+    :param amplicon_bed: the amplicon bed
+    :param primer_bed: the primer bed
+    :param orf_bed: the ORF start bed
+    :param reference: the reference fasta
+    :param cache_dir: where schemes are compiled to, e.g. the aligner index cache
+    :param bundled: the shipped bundle for a bundled primer version
+    :return: path of the compiled scheme
+    """
+    import hashlib
+
+    sources = scheme_sources(amplicon_bed, primer_bed, orf_bed)
+    if bundled and os.path.exists(bundled):
+        try:
+            if Scheme(bundled).metadata["sources"] == sources:
+                return bundled
+        except ValueError:
+            pass
+
+    key = hashlib.sha256(json.dumps(sources, sort_keys=True).encode()).hexdigest()[:16]
+    compiled = os.path.join(cache_dir, "scheme.{}.f{}{}".format(key, format_version, extension))
+    if not os.path.exists(compiled):
+        os.makedirs(cache_dir, exist_ok=True)
+        compile_scheme(amplicon_bed, primer_bed, orf_bed, reference, compiled)
+    return compiled
+
+
+def bundled_scheme(version, resources):
+    """
+    :param version: a bundled primer version, e.g. V3
+    :param resources: the periscope resources directory
+    :return: path of its compiled scheme
+    """
+    return os.path.join(resources, "schemes", "artic_{}{}".format(version, extension))
+
+
+def compile_bundled(resources, versions):
+    """
+    compile the schemes shipped in the resources directory
+    :return: list of the bundles written
+    """
+    written = []
+    os.makedirs(os.path.join(resources, "schemes"), exist_ok=True)
+    for version in versions:
+        output = bundled_scheme(version, resources)
+        compile_scheme(os.path.join(resources, "artic_amplicons_{}.bed".format(version)),
+                       os.path.join(resources, "artic_primers_{}.bed".format(version)),
+                       os.path.join(resources, "orf_start.bed"),
+                       os.path.join(resources, "nCoV-2019.reference.fasta"),
+                       output, name=version)
+        written.append(output)
+    return written
+
+
+def get_parser(prog=None):
+    resources = os.path.join(os.path.dirname(__file__), "resources")
+    parser = argparse.ArgumentParser(prog=prog, description='periscope: check a primer scheme and compile it into a bundle the counting workers memory map')
+    parser.add_argument('--amplicon-bed', dest='amplicon_bed', help='the amplicon bed file')
+    parser.add_argument('--primer-bed', dest='primer_bed', help='the primer bed file')
+    parser.add_argument('--orf-bed', dest='orf_bed', help='the ORF start bed file (orf_start.bed in the resources directory)', default=os.path.join(resources, "orf_start.bed"))
+    parser.add_argument('--reference', help='the reference fasta (nCoV-2019.reference.fasta in the resources directory)', default=os.path.join(resources, "nCoV-2019.reference.fasta"))
+    parser.add_argument('--name', help='name of the scheme, defaults to the primer bed file name', default=None)
+    parser.add_argument('--output', help='the bundle to write, <NAME>.pscheme')
+    parser.add_argument('--bundled', help='compile the schemes shipped in the resources directory instead', action='store_true')
+    parser.add_argument('--resources', help='the periscope resources directory, for --bundled', default=resources)
+    return parser
+
+
+def main(args):
+    from periscope.periscope import primer_versions
+
+    if args.bundled:
+        for output in compile_bundled(args.resources, primer_versions):
+            print(output)
+        return 0
+    if not (args.amplicon_bed and args.primer_bed and args.output):
+        print("--amplicon-bed, --primer-bed and --output are required", file=sys.stderr)
+        return 1
+    try:
+        metadata = compile_scheme(args.amplicon_bed, args.primer_bed, args.orf_bed, args.reference, args.output, args.name)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print("{}: {} amplicons, {} primers in {} pools".format(args.output, len(metadata["amplicon_names"]), len(metadata["primer_ids"]), len(metadata["pools"])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(get_parser().parse_args()))
@@ -1,27 +1,51 @@
 #!/usr/bin/env python3
 from periscope import __version__
 
-from Bio import pairwise2
+# Bio.pairwise2, pybedtools, numpy and tqdm are slow to import so they are imported inside the functions that
+# use them, this keeps start-up (and time to first read) down
 import pysam
 import argparse
-from pybedtools import *
-from artic.vcftagprimersites import read_bed_file
+import collections
+import logging
+import os
+import re
 import sys
-from numpy import median
-from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor as ProcessPool, process
 import time
 
+logger = logging.getLogger(__name__)
+
+# parsed resource files, filled once per process by load_resources
+_resources = {}
+
+# per read classes reported as live progress, whether the leader was found in the soft clipped bases (the pair is
+# classified later), the 3' mates are not searched
+read_classes = ['sgRNA', 'gRNA', 'mate']
+
+# how the leader was looked for: a supplementary alignment (SA tag) to the leader, the soft clip alignment, skipped
+# because the read has fewer than 6 bases soft clipped at its 5' end, or not at all because the read is the 3' mate of
+# its pair
+leader_paths = ['supplementary', 'soft_clip', 'skipped', 'mate']
+
+# a supplementary alignment starting at or before this (1-based) reference position maps to the leader
+leader_supplementary_max_pos = 67
+
+cigar_pattern = re.compile(r"(\d+)([MIDNSHP=X])")
+
 class ClassifiedRead():
-    def __init__(self,sgRNA: bool,orf: str,read: pysam.AlignedRead):
+    # only what pairing needs is kept, there is one of these for every read until the pairs are counted
+    __slots__ = ("sgRNA", "orf", "pos", "amplicon")
+
+    def __init__(self,sgRNA: bool,orf: str,read: pysam.AlignedRead=None,pos: int=None,amplicon: int=None):
         self.sgRNA = sgRNA
         self.orf = orf
-        self.pos = read.pos
-        self.read = read.to_string()
+        self.pos = read.pos if read is not None else pos
+        self.amplicon = amplicon
 
-def get_mapped_reads(bam):
-    # find out how many mapped reads there are for bam
-    mapped_reads = int([line for line in pysam.flagstat(bam, split_lines=True) if " mapped (" in line][0].split()[0])
+def get_mapped_reads(bam, reference=None):
+    # find out how many mapped reads there are for bam (or cram)
+    from periscope.alignments import samtools_options
+    mapped_reads = int([line for line in pysam.flagstat(*samtools_options(bam, reference) + [bam], split_lines=True) if " mapped (" in line][0].split()[0])
     return mapped_reads
 
 # def check_start(bed_object,read):
@@ -57,17 +81,90 @@ def check_start(read, leader_search_result, orfBed):
     return orf
 
 
+def five_prime_mate(read):
+    """
+    whether the read is the mate its pair is classified by, process_pairs takes the mate with the leftmost position.
+    This is decided from the mate fields so the other mate needs no leader search, when both mates start at the same
+    position both are searched
+    :param read: pysam read object, a primary alignment
+    :return: False when the mate starts to the left of the read
+    """
+    if not read.is_paired or read.mate_is_unmapped or read.next_reference_id != read.reference_id:
+        return True
+    return read.reference_start <= read.next_reference_start
+
+
+def pair_span(read):
+    """
+    the outer coordinates of the read's pair, from the read's start to the end of its mate. bwa sets the template length
+    (TLEN) from the leftmost to the rightmost mapped base of the pair, so the mate is not needed
+    :param read: pysam read object, the 5' mate (a 3' mate searched without its 5' mate ends the pair itself)
+    :return: (start, end) 0-based reference positions, the read's own when its mate is not mapped alongside it
+    """
+    if read.is_paired and not read.mate_is_unmapped and read.next_reference_id == read.reference_id \
+            and read.template_length and read.reference_start <= read.next_reference_start:
+        return read.reference_start, read.reference_start + abs(read.template_length)
+    return read.reference_start, read.reference_end
+
+
+def find_amplicon(read, primer_bed_object):
+    """
+    the amplicon of the read's pair, from the RIGHT primer nearest the pair's 3' end as the ont classifier assigns reads.
+    The 5' end of an sgRNA pair is at the leader junction rather than a LEFT primer so it is not used
+
+    :param read: pysam read object, the 5' mate
+    :param primer_bed_object: the primers parsed by artic, or a compiled periscope.scheme.Scheme
+    :return: the amplicon number
+    """
+    start, end = pair_span(read)
+    if hasattr(primer_bed_object, "find_primer"):
+        # a compiled scheme looks the nearest primer up by position
+        right_primer = primer_bed_object.find_primer(end, '-')
+    else:
+        from artic.align_trim import find_primer
+        right_primer = find_primer(primer_bed_object, end, '-')
+    return int(right_primer[2]['Primer_ID'].split("_")[1])
+
+
 def supplementary_method(read):
    # we don't need the supplementary alignment
     if read.is_supplementary:
         return "supplementary"
 
-    for tag in read.get_tags():
-        if tag[0] == 'SA':
-            supp_chrom,supp_pos,supp_strand,supp_cigar,supp_quality,unknown = tag[1].split(",")
-            print(supp_pos)
-            if 67 >= int(supp_pos) >= 0:
-                return "supplementary_maps_to_leader"
+    if leader_junction(read) is not None:
+        return "supplementary_maps_to_leader"
+
+
+def leader_junction(read):
+    """
+    the leader-body junction proven by a supplementary alignment to the leader, bwa mem splits a read across the
+    junction into the body (the primary, with the leader soft clipped at its 5' end) and the leader (the supplementary,
+    listed in the SA tag)
+    :param read: pysam read object, a primary alignment
+    :return: dictionary of the last leader base ("leader_end") and the first body base after it ("body_start"), 1-based
+    reference positions, None when the read has no supplementary alignment to the leader
+    """
+    if not read.has_tag("SA") or not read.cigartuples or read.cigartuples[0][0] != 4:
+        return None
+    strand = "-" if read.is_reverse else "+"
+    for alignment in read.get_tag("SA").rstrip(";").split(";"):
+        supp_chrom, supp_pos, supp_strand, supp_cigar, supp_quality, supp_nm = alignment.split(",")
+        if supp_chrom != read.reference_name or supp_strand != strand or int(supp_pos) > leader_supplementary_max_pos:
+            continue
+        # the read bases up to the end of the leader alignment (its leading clip and aligned bases), and the
+        # reference bases it covers
+        ops = [(int(size), op) for size, op in cigar_pattern.findall(supp_cigar)]
+        query_end = sum(size for size, op in ops if op in "MI=X") + (ops[0][0] if ops[0][1] in "SH" else 0)
+        reference_length = sum(size for size, op in ops if op in "MDN=X")
+        # the body continues from the first read base after the leader, the bases both alignments cover are the
+        # homology at the junction
+        body_start = read.reference_start + 1
+        for query_position, reference_position in read.get_aligned_pairs(matches_only=True):
+            if query_position >= query_end:
+                body_start = reference_position + 1
+                break
+        return dict(leader_end=int(supp_pos) + reference_length - 1, body_start=body_start)
+    return None
 
 
 def extact_soft_clipped_bases(read):
@@ -96,7 +193,7 @@ def extact_soft_clipped_bases(read):
     :param cigar:
     :return:
     """
-
+    from Bio import pairwise2
 
     cigar = read.cigartuples
     if cigar[0][0] == 4:
@@ -153,10 +250,13 @@ def extact_soft_clipped_bases(read):
 
 
 def get_coverage(start,end,inbamfile):
+    from numpy import median
+
     coverage = []
     if start < 0:
         start=1
-    for pileupcolumn in inbamfile.pileup("MN908947.3", int(start), int(end)):
+    # a cram can't have a second iterator open on it
+    for pileupcolumn in inbamfile.pileup("MN908947.3", int(start), int(end), multiple_iterators=not inbamfile.is_cram):
             coverage.append(pileupcolumn.n)
     return median(coverage)
 
@@ -169,40 +269,226 @@ def open_bed(bed):
     :param bed:
     :return:
     """
+    from pybedtools import BedTool
+
     bed_object = BedTool(bed)
     return bed_object
 
 
+def load_resources(args):
+    """
+    parse the ORF and primer bed files once per process and keep them for every following call, this is used as the
+    process pool initializer and workers started with fork inherit the copy already loaded by the parent
+    :param args: the arguments namespace, needs orf_bed, uses the compiled scheme when args.scheme is set and otherwise
+    the primer_bed
+    :return: dictionary with the parsed "orf_bed" rows and "primer_bed" primers, None without either, the pairs are
+    then not assigned to amplicons
+    """
+    scheme = getattr(args, "scheme", None)
+    primer_bed = getattr(args, "primer_bed", None)
+    key = (args.orf_bed, primer_bed, scheme)
+    if _resources.get("key") != key:
+        _resources["orf_bed"] = list(open_bed(args.orf_bed))
+        if scheme:
+            # the compiled scheme is memory mapped, every worker shares the same pages
+            from periscope.scheme import Scheme
+            _resources["primer_bed"] = Scheme(scheme)
+        elif primer_bed:
+            from artic.vcftagprimersites import read_bed_file
+            _resources["primer_bed"] = read_bed_file(primer_bed)
+        else:
+            _resources["primer_bed"] = None
+        _resources["key"] = key
+    return _resources
+
+
+def init_worker(args, progress_state):
+    """
+    process pool initializer, parse the resources and pick up the shared progress counters
+    :param args: the arguments namespace
+    :param progress_state: the parent's periscope.progress.Progress.shared_state(), None without live progress
+    """
+    from periscope.progress import init_worker as init_progress
+
+    load_resources(args)
+    init_progress(progress_state)
+
+
 def setup_counts(primer_bed_object):
     """
     make the main counts dictionary, we populate this as we loop through the reads in teh bam file
     :param primer_bed_object: primer bed file object needed to get the pool name
-    :return:
+    :return: dictionary of amplicon to its pool, total pairs and the gRNA and sgRNA pairs of each ORF
     """
     # set up dictionary for normalisation
     # need to get all regions in bed and make into a dict
-    # { 71: { total_reads: x, genomic_reads: y, sg_reads: {orf:z,orf2:k},'normalised_sgRNA': {orf:i,orf2:t} } }
+    # { 71: { pool: p, total_reads: x, gRNA: {orf:y,None:w}, sgRNA: {orf:z,novel_123:k} } }
     total_counts = {}
     for primer in primer_bed_object:
         amplicon = int(primer["Primer_ID"].split("_")[1])
         if amplicon not in total_counts:
-            total_counts[amplicon] = {'pool': primer["PoolName"], 'total_reads': 0, 'gRNA': [], 'sgRNA_HQ': {}, 'sgRNA_LQ':{}, 'sgRNA_LLQ':{}, 'nsgRNA_HQ':{}, 'nsgRNA_LQ':{}}
+            total_counts[amplicon] = {'pool': primer["PoolName"], 'total_reads': 0, 'gRNA': {}, 'sgRNA': {}}
     return total_counts
 
+def calculate_normalised_counts(mapped_reads,total_counts,outfile_amplicon,sample):
+    """
+    calculate normalised pair counts on a per amplicon basis, as the ont classifier does without the quality classes
+
+    :param mapped_reads: total mapped reads
+    :param total_counts: the total counts dictionary filled by process_pairs
+    :param outfile_amplicon: the amplicon outfile
+    :param sample: the sample id written in the first column
+    :return: the amplicon rows written to outfile_amplicon (one dictionary per row, keyed on the header)
+    """
+    rows=[]
+    with open(outfile_amplicon, "w") as f:
+        header = ["sample", "amplicon", "mapped_reads", "orf", "gRNA_count", "gRPTH", "sgRNA_count", "sgRPHT", "sgRPTg"]
+        f.write(",".join(header)+"\n")
+        for amplicon in total_counts:
+            # total count of gRNA pairs for amplicon, whether or not they start at an ORF
+            amplicon_gRNA_count = sum(total_counts[amplicon]["gRNA"].values())
+
+            # gRNA total count per 100k mapped reads
+            amplicon_gRPTH = amplicon_gRNA_count / (mapped_reads / 100000)
+
+            for orf in total_counts[amplicon]["sgRNA"]:
+                amplicon_orf_sgRNA_count = total_counts[amplicon]["sgRNA"][orf]
+
+                # normalised per 100k total mapped reads
+                amplicon_orf_sgRPHT = amplicon_orf_sgRNA_count / (mapped_reads / 100000)
+
+                # normalised per 1000 gRNA pairs from this amplicon
+                if amplicon_gRNA_count:
+                    amplicon_orf_sgRPTg = amplicon_orf_sgRNA_count / (amplicon_gRNA_count / 1000)
+                else:
+                    amplicon_orf_sgRPTg = "NA"
+
+                line = [sample, amplicon, mapped_reads, orf, amplicon_gRNA_count, amplicon_gRPTH,
+                        amplicon_orf_sgRNA_count, amplicon_orf_sgRPHT, amplicon_orf_sgRPTg]
+                rows.append(dict(zip(header, line)))
+                f.write(",".join(str(x) for x in line)+"\n")
+    return rows
+
+def search_read(read, orf_bed_object, primer_bed_object=None, timings=None):
+    """
+    look for the leader in a read and assign it to an ORF and its pair to an amplicon
+
+    :param read: pysam read object, a primary alignment
+    :param orf_bed_object: the parsed ORF bed rows
+    :param primer_bed_object: the primers, or a compiled scheme, None to leave the amplicon unassigned
+    :param timings: optional dictionary the seconds spent in each lookup are added to
+    :return: (leader found, ORF, amplicon, leader path, the junction from leader_junction or None)
+    """
+    timer = time.time
+    timings = timings if timings is not None else dict(supplementary_lookup=0.0, alignment=0.0, amplicon_lookup=0.0,
+                                                       orf_lookup=0.0)
+    # a supplementary alignment to the leader proves the junction, the soft clip is only aligned without one
+    t = timer()
+    junction = leader_junction(read)
+    timings["supplementary_lookup"] += timer() - t
+    if junction is not None:
+        leader_search_result = True
+        path = "supplementary"
+    else:
+        t = timer()
+        leader_search_result = extact_soft_clipped_bases(read)
+        timings["alignment"] += timer() - t
+        # extact_soft_clipped_bases only aligns when there are at least 6 soft clipped bases at the 5' end
+        cigar = read.cigartuples
+        path = "soft_clip" if cigar[0][0] == 4 and cigar[0][1] >= 6 else "skipped"
+
+    t = timer()
+    orf = check_start(read, leader_search_result, orf_bed_object)
+    timings["orf_lookup"] += timer() - t
+
+    # the pair's amplicon from its outer coordinates, in the same pass
+    amplicon = None
+    if primer_bed_object is not None:
+        t = timer()
+        amplicon = find_amplicon(read, primer_bed_object)
+        timings["amplicon_lookup"] += timer() - t
+    return leader_search_result, orf, amplicon, path, junction
+
+
+class LoneMateSearch():
+    """
+    the leader search for pairs whose 5' mate never arrived (a filtered or subsetted bam), only the 5' mate is searched
+    while the reads are classified so these pairs would otherwise not be counted. The read present is fetched again by
+    its position and searched as the 5' mate would have been, the results are kept for the reads table
+
+        search = LoneMateSearch(inbamfile, load_resources(args))
+        orfs, orfs_gRNA = process_pairs(reads_dict, search_mate=search)
+    """
+    def __init__(self, inbamfile, resources):
+        self.inbamfile = inbamfile
+        self.resources = resources
+        self.searched = {}
+
+    def fetch(self, name, pos):
+        # the primary alignment of a read, by its name and start
+        for contig in self.inbamfile.references:
+            for read in self.inbamfile.fetch(contig, pos, pos + 1):
+                if read.query_name == name and read.reference_start == pos and read.seq is not None \
+                        and not (read.is_secondary or read.is_supplementary or read.is_unmapped):
+                    return read
+        return None
+
+    def __call__(self, name, classified):
+        """
+        :param name: the read name
+        :param classified: the ClassifiedRead of the mate present
+        :return: the ClassifiedRead with the leader search done, as it was when the read is not found again
+        """
+        key = (name, classified.pos)
+        if key not in self.searched:
+            read = self.fetch(name, classified.pos)
+            if read is None:
+                self.searched[key] = classified
+            else:
+                sgRNA, orf, amplicon, _, _ = search_read(read, self.resources["orf_bed"], self.resources["primer_bed"])
+                self.searched[key] = ClassifiedRead(sgRNA=sgRNA, orf=orf, pos=classified.pos, amplicon=amplicon)
+        return self.searched[key]
+
+    def pair(self, name, pair):
+        """
+        :return: the pair with its left read searched when it is a 3' mate that wasn't
+        """
+        left_read = min(pair, key=lambda x: x.pos)
+        if left_read.sgRNA is not None:
+            return pair
+        return [self(name, classified) if classified is left_read else classified for classified in pair]
+
+
 def process_reads(data):
-    bam = data[0]
-    args = data[1]
-    inbamfile = pysam.AlignmentFile(bam, "rb")
+    bam, args, task, chunk = data
+    from periscope.alignments import open_alignments
+    from periscope.chunks import chunk_reads
+    from periscope.metrics import worker_metrics
+    from periscope.progress import TaskCounter
+
+    inbamfile = open_alignments(bam, reference=getattr(args, "reference", None), threads=getattr(args, "io_threads", 1))
     #bam_header = inbamfile.header.copy().to_dict()
-    
 
-    mapped_reads = get_mapped_reads(bam)
-    logger.warning("Processing " + str(mapped_reads) + " reads")
+    # time spent in each part of the worker, reported in the run metrics
+    timer = time.time
+    timings = dict(supplementary_lookup=0.0, alignment=0.0, amplicon_lookup=0.0, orf_lookup=0.0)
+    start = timer()
+    start_cpu = time.process_time()
 
-    orf_bed_object = open_bed(args.orf_bed)
+    resources = load_resources(args)
+    orf_bed_object = resources["orf_bed"]
+    primer_bed_object = resources["primer_bed"]
+
+    # live progress counts, copied to the parent every counter.every reads
+    counter = TaskCounter(task, read_classes)
+    counts = counter.counts
 
     reads={}
-    for read in inbamfile:
+    count=0
+    # the reads taking each leader path, and the reads of every junction a supplementary alignment gave
+    paths = {path: 0 for path in leader_paths}
+    junctions = {}
+    for read in chunk_reads(inbamfile, chunk):
 
         if read.seq == None:
             # print("%s read has no sequence" %
@@ -225,36 +511,84 @@ def process_reads(data):
         # # print(read.is_read1)
         # # print(read.get_tags())
         # print(read.cigar)
-        leader_search_result = extact_soft_clipped_bases(read)
-
+        count += 1
         if read.query_name not in reads:
             reads[read.query_name] = []
 
-        orfRead = check_start(read, leader_search_result, orf_bed_object)
+        if five_prime_mate(read):
+            leader_search_result, orfRead, amplicon, path, junction = search_read(read, orf_bed_object,
+                                                                                  primer_bed_object, timings)
+            if junction is not None:
+                key = "{}:{}".format(junction["leader_end"], junction["body_start"])
+                junctions[key] = junctions.get(key, 0) + 1
+            counts["sgRNA" if leader_search_result else "gRNA"] += 1
+        else:
+            # the 3' mate, the pair is classified by the other one
+            leader_search_result = None
+            orfRead = None
+            amplicon = None
+            path = "mate"
+            counts["mate"] += 1
+        paths[path] += 1
+
         reads[read.query_name].append(
 
-            ClassifiedRead(sgRNA=leader_search_result,orf=orfRead,read=read)
+            ClassifiedRead(sgRNA=leader_search_result,orf=orfRead,read=read,amplicon=amplicon)
 
 
         )
 
-    return(reads)
+        counts["reads"] += 1
+        if path == "soft_clip":
+            counts["alignments_computed"] += 1
+        else:
+            counts["alignments_skipped"] += 1
+        if count % counter.every == 0:
+            counter.flush()
+
+    counter.flush()
+    inbamfile.close()
 
-def process_pairs(reads_dict):
+    chunk_metrics = worker_metrics(bam, count, timer() - start, time.process_time() - start_cpu, timings, chunk=task)
+    chunk_metrics["leader_paths"] = paths
+    chunk_metrics["junctions"] = junctions
+    return reads, chunk_metrics
+
+def process_pairs(reads_dict, total_counts=None, search_mate=None):
+    """
+    classify every pair by its left read
+    :param reads_dict: dictionary of read name to its ClassifiedReads, or the periscope.spill.SpilledReads
+    :param total_counts: optional per amplicon counts dictionary from setup_counts, the pairs are added to their
+    amplicon's total, gRNA (by ORF, None when they don't start at one) and sgRNA counts
+    :param search_mate: optional LoneMateSearch, a pair whose 5' mate never arrived is classified by searching the
+    mate present, without it the pair is not counted
+    :return: dictionary of ORF to its sgRNA pair count and dictionary of canonical ORF to its gRNA pair count
+    """
     # now we have all the reads classified, deal with pairs
     logger.info("dealing with read pairs")
 
+    spilled = getattr(reads_dict, "runs", None)
+    pairs = reads_dict.pairs() if hasattr(reads_dict, "pairs") else reads_dict.items()
+
     orfs={}
     orfs_gRNA={}
-    for id,pair in reads_dict.items():
+    first_pos={}
+    for id,pair in pairs:
         # get the class and orf of the left hand read, this will be the classification and ORF for the pair - sometimes right read looks like it has subgenomic evidence - there are likely false positives
+        if search_mate is not None:
+            pair = search_mate.pair(id, pair)
 
         left_read = min(pair, key=lambda x: x.pos)
 
         read_class = left_read.sgRNA
         orf = left_read.orf
 
-        left_read_object = left_read.read
+        # the pair's amplicon counts, only the 5' mate was searched and assigned to an amplicon
+        if total_counts is not None and read_class is not None and left_read.amplicon in total_counts:
+            amplicon_counts = total_counts[left_read.amplicon]
+            amplicon_counts["total_reads"] += 1
+            classes = amplicon_counts["sgRNA" if read_class else "gRNA"]
+            classes[orf] = classes.get(orf, 0) + 1
 
         if orf == None:
             continue
@@ -269,62 +603,316 @@ def process_pairs(reads_dict):
         else:
             #assign read to sgRNA
             if orf not in orfs:
-                orfs[orf] = [left_read_object]
+                orfs[orf] = 1
+                first_pos[orf] = left_read.pos
             else:
-                orfs[orf].append(left_read_object)
+                orfs[orf] += 1
+                first_pos[orf] = min(first_pos[orf], left_read.pos)
+
+    # spilled reads come back sorted by name, the ORFs are put back in the order of their first pair in the bam
+    if spilled:
+        orfs = dict(sorted(orfs.items(), key=lambda item: first_pos[item[0]]))
 
     logger.info("dealing with read pairs....DONE")
 
     return orfs, orfs_gRNA
 
-def multiprocessing(func, args, workers):
-    with ProcessPool(workers) as ex:
-        res = list(tqdm(ex.map(func, args), total=len(args)))
+def read_features(reads_dict, sample, search_mate=None):
+    """
+    the rows of the columnar reads table, one per read, with the class of its pair as process_pairs assigns it
+    :param reads_dict: the combined reads dictionary, read name to its ClassifiedReads, or the SpilledReads
+    :param sample: the sample id
+    :param search_mate: the LoneMateSearch given to process_pairs, its searches are reused
+    :return: iterator of dictionaries keyed on the reads table columns
+    """
+    pairs = reads_dict.pairs() if hasattr(reads_dict, "pairs") else reads_dict.items()
+    for name, pair in pairs:
+        if search_mate is not None:
+            pair = search_mate.pair(name, pair)
+        left_read = min(pair, key=lambda x: x.pos)
+        pair_class = None
+        if left_read.orf is not None:
+            pair_class = "sgRNA" if left_read.sgRNA else "gRNA"
+        for classified in pair:
+            yield dict(sample=sample, read_id=name, reference_start=classified.pos, orf=classified.orf,
+                       sgRNA=classified.sgRNA, pair_orf=left_read.orf, pair_class=pair_class,
+                       pair_amplicon=left_read.amplicon)
+
+class TriageProportions():
+    """
+    the binomial proportions the triage mode (--target-precision) tracks, called with the results of the chunks done so
+    far as each round finishes, two for every ORF in the ORF bed. Pairs are classified by their left read as in
+    process_pairs. Mates are counted in the same round (triage.read_round), so only the pairs of the round just finished
+    are held while it is paired up, the earlier rounds are kept as counts
+    """
+    def __init__(self, orfs):
+        self.orfs = orfs
+        self.seen = 0
+        self.pairs = 0
+        self.sgRNA = {}
+        self.gRNA = {}
+
+    @staticmethod
+    def pair_class(pair):
+        left_read = min(pair, key=lambda x: x.pos)
+        if left_read.orf is None or "novel" in left_read.orf:
+            return None
+        return left_read.orf, left_read.sgRNA
+
+    def add(self, pair_class):
+        if pair_class is not None:
+            orf, sgRNA = pair_class
+            counts = self.sgRNA if sgRNA else self.gRNA
+            counts[orf] = counts.get(orf, 0) + 1
+
+    def __call__(self, processed):
+        """
+        :param processed: list of (reads dictionary, worker metrics) returned by process_reads
+        :return: dictionary of ("orf", orf) to (sgRNA pairs, pairs) and ("orf_gRNA", orf) to (sgRNA pairs, sgRNA and
+        gRNA pairs starting in the ORF)
+        """
+        # the pairs of the new round, both mates are in it
+        pairs = {}
+        for reads, _ in processed[self.seen:]:
+            for name, classified in reads.items():
+                pairs[name] = pairs[name] + classified if name in pairs else classified
+        for pair in pairs.values():
+            self.add(self.pair_class(pair))
+        self.pairs += len(pairs)
+        self.seen = len(processed)
+
+        proportions = {}
+        for orf in self.orfs:
+            count = self.sgRNA.get(orf, 0)
+            proportions[("orf", orf)] = (count, self.pairs)
+            proportions[("orf_gRNA", orf)] = (count, count + self.gRNA.get(orf, 0))
+        return proportions
+
+def multiprocessing(func, args, workers, initializer=None, initargs=(), executor=None, consume=None):
+    """
+    :param consume: optional function every result is passed to as it arrives, what it returns is kept in its place
+    """
+    from tqdm import tqdm
+
+    consume = consume or (lambda result: result)
+    if executor is not None:
+        # a caller supplied executor, its workers load the resources on their first call. Its size isn't known so
+        # every chunk is submitted at once
+        return [consume(result) for result in tqdm(executor.map(func, args), total=len(args))]
+
+    with ProcessPool(workers, initializer=initializer, initargs=initargs) as ex:
+        res = [consume(result) for result in tqdm(in_order(ex, func, args, workers), total=len(args))]
     return res
 
-def combine(reads_dictList):
-    import collections
-    super_dict = collections.defaultdict(list)
-    for d in reads_dictList:
-        for k, v in d.items():
-            super_dict[k]=super_dict[k]+v
-    return super_dict
+def in_order(executor, func, args, workers):
+    """
+    the results of func over args in order, with a few tasks per worker in flight. executor.map submits every chunk at
+    once and holds the results that finish ahead of a slow chunk, this holds at most the window of them
+    """
+    window = max(1, int(workers)) * 2
+    pending = collections.deque()
+    for task in args:
+        if len(pending) == window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, task))
+    while pending:
+        yield pending.popleft().result()
+
+def leader_search_report(leader_search, top=20):
+    """
+    :param leader_search: dictionary of leader path to its reads, and "junctions", of "<leader end>:<body start>" to
+    its reads
+    :param top: the number of junctions reported
+    :return: the reads of every path, their fraction of the reads and the junctions with the most reads
+    """
+    reads = sum(leader_search[path] for path in leader_paths)
+    report = {path: dict(reads=leader_search[path], fraction=leader_search[path] / reads if reads else 0.0)
+              for path in leader_paths}
+    junctions = sorted(leader_search["junctions"].items(), key=lambda item: -item[1])[:top]
+    report["junctions"] = [dict(leader_end=int(junction.split(":")[0]), body_start=int(junction.split(":")[1]),
+                                reads=junction_reads) for junction, junction_reads in junctions]
+    return report
+
+def classify(args, executor=None, metrics=None):
+    """
+    classify the reads of args.bam in chunks, pair them up and write the outputs
 
-def main(args):
+    :param args: the arguments namespace
+    :param executor: optional concurrent.futures executor to run the workers on, defaults to a process pool of
+    args.threads workers
+    :param metrics: optional periscope.metrics.Metrics the classification stages and workers are recorded in
+    :return: dictionary of the tables written ("counts", "novel_counts", "amplicons") and the "mapped_reads" used
+    """
+    from periscope.alignments import open_alignments
+    from periscope.chunks import make_chunks, default_chunk_reads
+    from periscope.metrics import Metrics
+    from periscope.progress import Progress, expected_reads
+    from periscope.spill import SpilledReads, memory_plan
+
+    if metrics is None:
+        metrics = Metrics(args.output_prefix)
+    if getattr(args, "columnar", None):
+        from periscope.columnar import require_pyarrow
+        require_pyarrow()
 
     # t1=time.time()
-    inbamfile = pysam.AlignmentFile(args.bam, "rb")
+    reference = getattr(args, "reference", None)
+    io_threads = getattr(args, "io_threads", 1)
+    inbamfile = open_alignments(args.bam, reference=reference, threads=io_threads)
     # bam_header = inbamfile.header.copy().to_dict()
 
-    #get a list of bams:
-    import glob
-    files = glob.glob(args.output_prefix+"_split_*.sam")
+    # cut the bam into chunks of --chunk-reads reads, the pool hands them out one at a time as workers free up. Mates
+    # in different chunks are paired up in reads_dict
+    chunk_size = getattr(args, "chunk_reads", None) or default_chunk_reads
+    # with --max-memory the chunks are made small enough for every worker's share of it
+    plan = None
+    if getattr(args, "max_memory", None):
+        from periscope.cache import parse_size
+        plan = memory_plan(parse_size(args.max_memory), int(args.threads), chunk_size, "illumina")
+        chunk_size = plan["chunk_reads"]
+    # triage mode counts rounds of randomly sampled read pairs, the chunking pass writes each round to a bam of its own
+    target_precision = getattr(args, "target_precision", None)
+    round_bams = []
+    if target_precision:
+        from periscope import triage
+        round_bams = triage.round_bams(args.output_prefix)
+    # the same pass counts the mapped reads the counts are normalised by
+    totals = {}
+    with metrics.stage("chunking", inputs=[args.bam], outputs=round_bams) as stage:
+        if target_precision:
+            round_chunks = triage.bucket_rounds(args.bam, round_bams, chunk_size, reference, io_threads, totals)
+            chunks = [chunk for bam_chunks in round_chunks for chunk in bam_chunks]
+        else:
+            chunks = make_chunks(args.bam, chunk_size, reference, io_threads, totals)
+        stage["records"] = sum(chunk[2] for chunk in chunks)
+    logger.warning("Processing {} reads in {} chunks".format(stage["records"], len(chunks)))
 
     result=[]
-    for file in files:
-        result.append([file,args])
-
-    processed = multiprocessing(
-        process_reads,
-        args=result,
-        workers=int(args.threads)
-    )
-    reads_dict = combine(processed)
-    orfs, orfs_gRNA = process_pairs(reads_dict)
+    for task, chunk in enumerate(chunks):
+        result.append([args.bam,args,task,chunk])
+    if target_precision:
+        rounds = triage.triage_tasks(round_bams, args, round_chunks)
+        result = [task for round_tasks in rounds for task in round_tasks]
+
+    # parse the resources before the pool starts, forked workers share this copy and the initializer only has to
+    # load them when workers are spawned
+    load_resources(args)
+
+    # with --profile every worker task is profiled, the parent merges the profiles (periscope.profiling)
+    worker = process_reads
+    if getattr(args, "profile", None):
+        from periscope.profiling import Profiled
+        worker = Profiled(process_reads, args.output_prefix, args.profile)
+
+    # live progress for the node exporter, workers of a caller supplied process pool can't report to it
+    progress = None
+    if getattr(args, "progress_textfile", None):
+        progress = Progress(args.progress_textfile, len(result), read_classes,
+                            expected_reads(args.bam) or sum(chunk[2] for chunk in chunks),
+                            labels=dict(sample=args.sample, technology="illumina"), interval=args.progress_interval)
+        progress.start()
+
+    # the classified reads of the chunks by read name, spilled to disk past the parent's share of --max-memory
+    reads_dict = SpilledReads(args.output_prefix, plan["parent_bytes"] if plan else None)
+
+    # the leader paths taken and the junctions found, over every chunk
+    leader_search = dict({path: 0 for path in leader_paths}, junctions={})
+
+    def collect(result):
+        # the reads go to reads_dict as each chunk finishes, only the worker metrics are kept
+        reads, worker_metrics = result
+        reads_dict.add(reads)
+        for path, reads_taking in worker_metrics["leader_paths"].items():
+            leader_search[path] += reads_taking
+        for junction, junction_reads in worker_metrics.pop("junctions").items():
+            leader_search["junctions"][junction] = leader_search["junctions"].get(junction, 0) + junction_reads
+        return {}, worker_metrics
+
+    try:
+        with metrics.stage("classification", inputs=[args.bam]) as stage:
+            try:
+                if target_precision:
+                    # triage, rounds of random read pairs until every estimate is within the target precision
+                    processed, finished_rounds, precision_rows = triage.adaptive_map(
+                        worker,
+                        rounds,
+                        int(args.threads),
+                        TriageProportions([row.name for row in load_resources(args)["orf_bed"]]),
+                        float(target_precision),
+                        initializer=init_worker,
+                        initargs=(args, progress.shared_state() if progress else None),
+                        executor=executor,
+                        consume=collect
+                    )
+                else:
+                    processed = multiprocessing(
+                        worker,
+                        args=result,
+                        workers=int(args.threads),
+                        initializer=init_worker,
+                        initargs=(args, progress.shared_state() if progress else None),
+                        executor=executor,
+                        consume=collect
+                    )
+            finally:
+                if progress:
+                    progress.stop()
+            processed, workers = zip(*processed) if processed else ([], [])
+            metrics.add_workers(list(workers))
+            stage["records"] = sum(worker["reads"] for worker in workers)
+        metrics.extra["leader_search"] = leader_search_report(leader_search)
+        logger.warning("Leader search: {}".format(", ".join("{} {}".format(path, leader_search[path])
+                                                            for path in leader_paths)))
+
+        # in triage mode the counts are of a sample of the reads, the mapped reads and coverage they are normalised
+        # by are scaled down to it
+        fraction_processed = 1.0
+        if target_precision:
+            fraction_processed, precision_rows = triage.report(args, len(rounds), finished_rounds, stage["records"],
+                                                               precision_rows, metrics)
+
+        # the pairs are counted by amplicon as they are paired up, there is no second pass over the bam
+        primer_bed_object = load_resources(args)["primer_bed"]
+        total_counts = setup_counts(primer_bed_object) if primer_bed_object is not None else {}
+        # pairs whose 5' mate is missing from the bam are searched by the mate present
+        search_mate = LoneMateSearch(inbamfile, load_resources(args))
+        with metrics.stage("pairing") as stage:
+            orfs, orfs_gRNA = process_pairs(reads_dict, total_counts, search_mate)
+            stage["records"] = len(reads_dict)
+        metrics.extra["leader_search"]["lone_mates"] = len(search_mate.searched)
+        if plan:
+            metrics.extra["memory"] = dict(plan, **reads_dict.metrics())
+
+        # a row per read for the columnar reads table, written as the pairs are read back
+        columnar_format = getattr(args, "columnar", None)
+        if columnar_format:
+            from periscope import columnar
+            reads_table = columnar.output_path(args.output_prefix, "reads", columnar_format)
+            with metrics.stage("columnar_reads", outputs=[reads_table]) as stage:
+                stage["records"] = columnar.write_table(read_features(reads_dict, args.sample, search_mate), reads_table,
+                                                        "illumina", "reads", columnar_format)
+    finally:
+        reads_dict.cleanup()
+        if target_precision:
+            triage.remove_round_bams(round_bams)
 
     #open the orfs bed file
     orf_bed_object = open_bed(args.orf_bed)
     
-    mapped_reads = get_mapped_reads(args.bam)
+    mapped_reads = totals["mapped_reads"]
+    if fraction_processed < 1:
+        mapped_reads = max(1, int(round(mapped_reads * fraction_processed)))
 
     orf_coverage={}
     # get coverage for each orf
     logger.warning("getting coverage at canonical ORF sites")
-    for row in orf_bed_object:
+    with metrics.stage("coverage") as stage:
+        for row in orf_bed_object:
 
-        median=get_coverage(row.start,row.end,inbamfile)
+            median=get_coverage(row.start,row.end,inbamfile)
 
-        orf_coverage[row.name]=median
+            orf_coverage[row.name]=median*fraction_processed
+        stage["records"] = len(orf_coverage)
     logger.warning("getting coverage at canonical ORF sites....DONE")
 
     # outbamfile.close()
@@ -333,54 +921,105 @@ def main(args):
     # pysam.sort("-o", args.output_prefix + "_periscope_sorted.bam",  args.output_prefix + "_periscope.bam")
     # pysam.index(args.output_prefix + "_periscope_sorted.bam")
 
-    novel_count=0
-    canonical = open(args.output_prefix+"_periscope_counts.csv","w")
-    canonical.write(",".join(["sample","mapped_reads", "gRNA_count","orf","sgRNA_count","coverage", "sgRPTL","sgRPHT\n"]))
+    outfile_counts = args.output_prefix+"_periscope_counts.csv"
+    outfile_counts_novel = args.output_prefix+"_periscope_novel_counts.csv"
+    outfile_amplicons = args.output_prefix + "_periscope_amplicons.csv"
+    with metrics.stage("csv_writing", outputs=[outfile_amplicons, outfile_counts, outfile_counts_novel]) as stage:
+        amplicon_rows = calculate_normalised_counts(mapped_reads, total_counts, outfile_amplicons, args.sample)
+
+        novel_count=0
+        canonical_header = ["sample","mapped_reads", "gRNA_count","orf","sgRNA_count","coverage", "sgRPTL","sgRPHT"]
+        canonical_rows = []
+        canonical = open(outfile_counts,"w")
+        canonical.write(",".join(canonical_header)+"\n")
+
+        novel_header = ["sample","mapped_reads", "orf", "sgRNA_count", "coverage", "sgRPTL","sgRPHT"]
+        novel_rows = []
+        novel = open(outfile_counts_novel,"w")
+        novel.write(",".join(novel_header)+"\n")
+
+        logger.info("summarising results")
+
+        for orf in orfs:
+            sgRPHT = orfs[orf] / (mapped_reads / 100000)
+            if "novel" not in orf:
+                sgRPTL = orfs[orf]/(orf_coverage[orf]/1000)
+                line = [args.sample,mapped_reads,orfs_gRNA[orf],orf,orfs[orf],orf_coverage[orf],sgRPTL,sgRPHT]
+                canonical_rows.append(dict(zip(canonical_header, line)))
+                canonical.write(",".join(str(x) for x in line)+"\n")
+            else:
+                position = int(orf.split("_")[1])
+                coverage=get_coverage(position-20,position+20,inbamfile)*fraction_processed
+                sgRPTL = orfs[orf]/(coverage/1000)
+                line = [args.sample,mapped_reads,orf,orfs[orf],coverage,sgRPTL,sgRPHT]
+                novel_rows.append(dict(zip(novel_header, line)))
+                novel.write(",".join(str(x) for x in line)+"\n")
+                novel_count+=orfs[orf]
+
+        canonical.close()
+        novel.close()
+        stage["records"] = len(amplicon_rows) + len(canonical_rows) + len(novel_rows)
 
-    novel = open(args.output_prefix+"_periscope_novel_counts.csv","w")
-    novel.write(",".join(["sample","mapped_reads", "orf", "sgRNA_count", "coverage", "sgRPTL","sgRPHT\n"]))
+    logger.info("summarising results....DONE")
 
-    logger.info("summarising results")
 
-    for orf in orfs:
-        sgRPHT = len(orfs[orf]) / (mapped_reads / 100000)
-        if "novel" not in orf:
-            sgRPTL = len(orfs[orf])/(orf_coverage[orf]/1000)
-            canonical.write(args.sample+","+str(mapped_reads)+","+str(orfs_gRNA[orf])+","+orf+","+str(len(orfs[orf]))+","+str(orf_coverage[orf])+","+str(sgRPTL)+","+str(sgRPHT)+"\n")
-        else:
-            position = int(orf.split("_")[1])
-            coverage=get_coverage(position-20,position+20,inbamfile)
-            sgRPTL = len(orfs[orf])/(coverage/1000)
-            novel.write(args.sample+","+str(mapped_reads)+","+orf+","+str(len(orfs[orf]))+","+str(coverage)+","+str(sgRPTL)+","+str(sgRPHT)+"\n")
-            novel_count+=len(orfs[orf])
+    # t2=time.time()
+    # print("periscope.py time:", t2-t1)
 
-    canonical.close()
-    novel.close()
+    tables = dict(counts=canonical_rows,novel_counts=novel_rows,amplicons=amplicon_rows,mapped_reads=mapped_reads)
+    if target_precision:
+        tables["precision"] = precision_rows
 
-    logger.info("summarising results....DONE")
+    # columnar copies of the tables, the reads table is written above
+    if columnar_format:
+        columnar.write_outputs(args.output_prefix, "illumina",
+                               dict(counts=canonical_rows, novel_counts=novel_rows, amplicons=amplicon_rows),
+                               columnar_format, metrics)
+    return tables
 
-    amplicons = open(args.output_prefix + "_periscope_amplicons.csv", "w")
-    amplicons.write("not used yet")
-    amplicons.close()
+def main(args):
+    from periscope.metrics import Metrics
+    from periscope.profiling import profile_run
 
-    # t2=time.time()
-    # print("periscope.py time:", t2-t1)
+    # stages run by snakemake before us are in the stage log
+    metrics = Metrics(args.output_prefix)
+    stage_log = args.output_prefix + "_periscope_stages.jsonl"
+    metrics.read_log(stage_log)
+
+    with profile_run(args.profile, args.output_prefix, metrics):
+        tables = classify(args, metrics=metrics)
+    metrics.extra["mapped_reads"] = tables["mapped_reads"]
+    metrics.write(args.output_prefix + "_periscope_metrics.json")
+    if os.path.exists(stage_log):
+        os.remove(stage_log)
+
+    return tables
 
 if __name__ == '__main__':
 
 
 
     parser = argparse.ArgumentParser(description='periscopre: Search for sgRNA reads in artic network SARS-CoV-2 sequencing data')
-    parser.add_argument('--bam', help='bam file',default="The bam file of full artic reads")
+    parser.add_argument('--bam', help='bam (or cram) file',default="The bam file of full artic reads")
+    parser.add_argument('--reference', help='the reference fasta crams are read with (the bundled nCoV-2019.reference.fasta)', default=None)
+    parser.add_argument('--io-threads', dest='io_threads', help='pysam threads decompressing each bam or cram (1)', type=int, default=1)
     parser.add_argument('--output-prefix',dest='output_prefix',help="Path to the output, e.g. <DIR>/<SAMPLE_NAME>")
     parser.add_argument('--score-cutoff',dest='score_cutoff', help='Cut-off for alignment score of leader (50) we recommend you leave this at 50',default=50)
     parser.add_argument('--orf-bed', dest='orf_bed', help='The bed file with ORF start positions')
     parser.add_argument('--primer-bed', dest='primer_bed', help='The bed file with artic primer positions')
     parser.add_argument('--amplicon-bed', dest='amplicon_bed', help='A bed file of artic amplicons')
+    parser.add_argument('--scheme', help='the compiled primer scheme (periscope compile-scheme), used in place of --primer-bed', default=None)
     parser.add_argument('--sample', help='sample id',default="SAMPLE")
     parser.add_argument('--tmp',help="pybedtools likes to write to /tmp if you want to write somewhere else define it here",default="/tmp")
     parser.add_argument('--progress', help='display progress bar', default="")
     parser.add_argument('--threads', help='display progress bar', default=1)
+    parser.add_argument('--chunk-reads', dest='chunk_reads', help='reads per chunk of work handed to a worker (50000)', type=int, default=50000)
+    parser.add_argument('--progress-textfile', dest='progress_textfile', help='write live progress to this prometheus textfile (e.g. in the node exporter textfile directory)', default=None)
+    parser.add_argument('--progress-interval', dest='progress_interval', help='seconds between progress textfile updates (15)', type=float, default=15)
+    parser.add_argument('--target-precision', dest='target_precision', help='triage: count random chunks until every ORF ratio is known to this relative precision (e.g. 0.05), writes <OUTPUT_PREFIX>_periscope_precision.csv', type=float, default=None)
+    parser.add_argument('--max-memory', dest='max_memory', help='memory budget shared by the workers and the parent (e.g. 16G), the chunks are cut to fit it and the classified reads are spilled to disk past it', default=None)
+    parser.add_argument('--columnar', help='also write the counts, novel counts and per read tables as parquet or arrow files with a declared schema (needs pyarrow)', choices=['parquet', 'arrow'], default=None)
+    parser.add_argument('--profile', help='profile the parent and every worker, all (sampling and cProfile), sample or cprofile; writes <OUTPUT_PREFIX>_periscope_profile.collapsed and .pstats', nargs='?', const='all', choices=['all', 'sample', 'cprofile'], default=None)
 
     logger = logging
     logger.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
@@ -389,6 +1028,7 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    from pybedtools import set_tempdir
     set_tempdir(args.tmp)
 
     periscope = main(args)
@@ -1,29 +1,37 @@
 #!/usr/bin/env python3
 from periscope import __version__
 
-from Bio import pairwise2
+# Bio.pairwise2, pybedtools, artic and tqdm are slow to import so they are imported inside the functions that
+# use them, this keeps start-up (and time to first read) down
 import pysam
 import argparse
-from pybedtools import *
-import datetime
-from artic.align_trim import find_primer
-from artic.vcftagprimersites import read_bed_file
 import sys
 import os
-import pprint as pp
-import snakemake
-from collections import namedtuple
 from concurrent.futures import ProcessPoolExecutor as ProcessPool
 class PeriscopeRead(object):
     def __init__(self, read):
         self.read = read
 
 import time
-from tqdm import tqdm
+import zlib
 
-def get_mapped_reads(bam):
-    # find out how many mapped reads there are for bam
-    mapped_reads = int([line for line in pysam.flagstat(bam, split_lines=True) if " mapped (" in line][0].split()[0])
+# parsed resource files, filled once per process by load_resources
+_resources = {}
+
+# bases after the leading soft clip the leader search covers, a leader junction is only ever at the 5' end
+default_leader_margin = 40
+
+# tagged bam policies (--tagged-bam): no tagged bam, only the sgRNA and nsgRNA reads (and a sample of the gRNA
+# reads), or every read
+tagged_bam_policies = ["none", "sgrna", "full"]
+
+# the classes classify_read assigns
+read_classes = ['gRNA', 'sgRNA_HQ', 'sgRNA_LQ', 'sgRNA_LLQ', 'nsgRNA_HQ', 'nsgRNA_LQ']
+
+def get_mapped_reads(bam, reference=None):
+    # find out how many mapped reads there are for bam (or cram)
+    from periscope.alignments import samtools_options
+    mapped_reads = int([line for line in pysam.flagstat(*samtools_options(bam, reference) + [bam], split_lines=True) if " mapped (" in line][0].split()[0])
     return mapped_reads
 
 def check_start(bed_object,read):
@@ -54,14 +62,31 @@ def check_start(bed_object,read):
     # cleanup()
     return orf
 
-def search_reads(read,search):
+def leader_window(read,margin):
+    """
+    the bases a leader junction can be in, the leading soft clip and margin bases after it, so the search doesn't
+    depend on the read length
+    :param read: pysam read object
+    :param margin: bases after the soft clip to include
+    :return: the start of read.seq
+    """
+    cigar = read.cigartuples
+    clipped = cigar[0][1] if cigar and cigar[0][0] == 4 else 0
+    return read.seq[:clipped + margin]
+
+def search_reads(read,search,margin=None):
     """
     given a pysam read object and a search string perform a localms alignment
     :param read: pysam read object
     :param search: DNA search string e.g. ATGTGCTTGATGC
+    :param margin: only search the leading soft clip and this many bases after it (leader_window), the whole read when
+    None
     :return: dictionary containing the read_id, alignment score and the position of the read
     """
-    align_score = pairwise2.align.localms(search, read.seq, 2, -2, -10, -.1,score_only=True)
+    from Bio import pairwise2
+
+    sequence = read.seq if margin is None else leader_window(read, margin)
+    align_score = pairwise2.align.localms(search, sequence, 2, -2, -10, -.1,score_only=True)
 
     return {
         "read_id":  read.query_name,
@@ -79,19 +104,24 @@ def find_amplicon(read,primer_bed_object):
     this read is an sgRNA
 
     :param read:
-    :param primer_bed_object:
+    :param primer_bed_object: the primers parsed by artic, or a compiled periscope.scheme.Scheme
     :return: the amplicon of the read
     """
+    if hasattr(primer_bed_object, "find_primer"):
+        # a compiled scheme looks the nearest primers up by position
+        find_primer = primer_bed_object.find_primer
+        left_primer = find_primer(read.reference_start, '+')
+        right_primer = find_primer(read.reference_end, '-')
+    else:
+        from artic.align_trim import find_primer
 
+        # get the left primer
 
-
-    # get the left primer
-
-    left_primer = find_primer(primer_bed_object, read.reference_start, '+')
+        left_primer = find_primer(primer_bed_object, read.reference_start, '+')
 
 
-    # get the right primer
-    right_primer = find_primer(primer_bed_object, read.reference_end, '-')
+        # get the right primer
+        right_primer = find_primer(primer_bed_object, read.reference_end, '-')
 
 
     # get the left primer amplicon (we don't actually use this)
@@ -103,10 +133,37 @@ def find_amplicon(read,primer_bed_object):
 
     return dict(left_amplicon=left_amplicon,left_primer=left_primer,right_amplicon=right_amplicon,right_primer=right_primer)
 
+def at_left_primer(read,amplicons):
+    """
+    :return: whether the read starts within 5 bases of its left primer, where we see a lot of false positive leader
+    matches at read ends
+    """
+    primer_start = amplicons["left_primer"][2]["start"]-5
+    primer_end = amplicons["left_primer"][2]["end"]+5
+    return primer_start <= read.pos <= primer_end
+
+def leader_score_needed(read,orf,amplicons):
+    """
+    whether the leader alignment score can change the class classify_read gives the read, the cheap checks are done
+    first so the alignment is only run when it matters
+    :param read: pysam read object
+    :param orf: the orf from check_start
+    :param amplicons: the amplicons from find_amplicon
+    :return: False when the read is gRNA whatever the score
+    """
+    # reads starting at ORF1a/ORF1b are always gRNA
+    if orf == "ORF1a" or orf == "ORF1b":
+        return False
+    # reads away from an ORF start are nsgRNA or gRNA on the score, but at the left primer an nsgRNA call is
+    # overridden to gRNA
+    if orf is None and at_left_primer(read, amplicons):
+        return False
+    return True
+
 def classify_read(read,score,score_cutoff,orf,amplicons):
     """
     classify read based on leader alignment score and other metrics
-    :param score: the score
+    :param score: the score, None when the leader search was skipped because leader_score_needed is False
     :param score_cutoff: the user provided cut-off
     :return:
     """
@@ -116,7 +173,9 @@ def classify_read(read,score,score_cutoff,orf,amplicons):
     # print(amplicons)
 
     # assign quality
-    if score > int(score_cutoff):
+    if score is None:
+        quality = None
+    elif score > int(score_cutoff):
         quality = "HQ"
     elif score > 30:
         quality = "LQ"
@@ -140,9 +199,7 @@ def classify_read(read,score,score_cutoff,orf,amplicons):
     # we see a lot of false positives at read ends
 
     if read_class == "nsgRNA":
-        primer_start = amplicons["left_primer"][2]["start"]-5
-        primer_end = amplicons["left_primer"][2]["end"]+5
-        if primer_start <= read.pos <= primer_end:
+        if at_left_primer(read, amplicons):
             quality=None
             read_class="gRNA"
 
@@ -152,16 +209,90 @@ def classify_read(read,score,score_cutoff,orf,amplicons):
         return read_class
 
 
+def keep_tagged(read, read_class, policy, grna_subsample=0.0):
+    """
+    whether a read goes into the tagged bam
+    :param read: pysam read object
+    :param read_class: the class from classify_read
+    :param policy: none, sgrna or full
+    :param grna_subsample: with sgrna, the fraction of the gRNA reads kept, picked by a hash of the read name so a
+    run keeps the same reads every time
+    :return: True to write the read
+    """
+    if policy == "full":
+        return True
+    if policy == "none":
+        return False
+    if "sgRNA" in read_class:
+        return True
+    return grna_subsample > 0 and zlib.crc32(read.query_name.encode()) < grna_subsample * 2 ** 32
+
+
+def tag_read(read, score, amplicon, read_class, orf, unscored=None):
+    """
+    store the attributes we have calculated with the read as tags, these are written to the periscope bam
+    :param read: pysam read object
+    :param score: leader alignment score (XS), None when the leader search was skipped
+    :param amplicon: the right amplicon number (XA)
+    :param read_class: the read class (XC)
+    :param orf: the orf assigned (XO)
+    :param unscored: XS value for reads whose leader search was skipped, no XS tag when None
+    """
+    if score is not None:
+        read.set_tag('XS', score)
+    elif unscored is not None:
+        read.set_tag('XS', unscored)
+    read.set_tag('XA', amplicon)
+    read.set_tag('XC', read_class)
+    read.set_tag('XO', orf)
+
+
 def open_bed(bed):
     """
     open bed file and return a bedtools object
     :param bed:
     :return:
     """
+    from pybedtools import BedTool
+
     bed_object = BedTool(bed)
     return bed_object
 
 
+def load_resources(args):
+    """
+    parse the ORF and primer bed files once per process and keep them for every following call, this is used as the
+    process pool initializer and workers started with fork inherit the copy already loaded by the parent
+    :param args: the arguments namespace, needs orf_bed and primer_bed, and uses the compiled scheme when args.scheme is set
+    :return: dictionary with the parsed "orf_bed" rows and "primer_bed" primers
+    """
+    scheme = getattr(args, "scheme", None)
+    key = (args.orf_bed, args.primer_bed, scheme)
+    if _resources.get("key") != key:
+        _resources["orf_bed"] = list(open_bed(args.orf_bed))
+        if scheme:
+            # the compiled scheme is memory mapped, every worker shares the same pages
+            from periscope.scheme import Scheme
+            _resources["primer_bed"] = Scheme(scheme)
+        else:
+            from artic.vcftagprimersites import read_bed_file
+            _resources["primer_bed"] = read_bed_file(args.primer_bed)
+        _resources["key"] = key
+    return _resources
+
+
+def init_worker(args, progress_state):
+    """
+    process pool initializer, parse the resources and pick up the shared progress counters
+    :param args: the arguments namespace
+    :param progress_state: the parent's periscope.progress.Progress.shared_state(), None without live progress
+    """
+    from periscope.progress import init_worker as init_progress
+
+    load_resources(args)
+    init_progress(progress_state)
+
+
 def setup_counts(primer_bed_object):
     """
     make the main counts dictionary, we populate this as we loop through the reads in teh bam file
@@ -171,6 +302,7 @@ def setup_counts(primer_bed_object):
     # set up dictionary for normalisation
     # need to get all regions in bed and make into a dict
     # { 71: { total_reads: x, genomic_reads: y, sg_reads: {orf:z,orf2:k},'normalised_sgRNA': {orf:i,orf2:t} } }
+    # every class holds the number of reads per orf, the reads themselves are only kept in the tagged bam
     total_counts = {}
     for primer in primer_bed_object:
         amplicon = int(primer["Primer_ID"].split("_")[1])
@@ -179,7 +311,7 @@ def setup_counts(primer_bed_object):
     return total_counts
 
 
-def calculate_normalised_counts(mapped_reads,total_counts,outfile_amplicon,orf_bed_object):
+def calculate_normalised_counts(mapped_reads,total_counts,outfile_amplicon,orf_bed_object,sample):
     """
     calculate normalised read counts on a per amplicon bases
 
@@ -187,9 +319,14 @@ def calculate_normalised_counts(mapped_reads,total_counts,outfile_amplicon,orf_b
     :param total_counts: the total counts dictionary
     :param outfile_amplicon: the amplicon outfile
     :param orf_bed_object: the orf bed file object
-    :return: the total counts dictionary with normalisation added
+    :param sample: the sample id written in the first column
+    :return: the total counts dictionary with normalisation added, the orf bed object with novel orfs added and the
+    amplicon rows written to outfile_amplicon (one dictionary per row, keyed on the header)
     """
+    from pybedtools import BedTool
+
     done=[]
+    rows=[]
     with open(outfile_amplicon, "w") as f:
         header = ["sample", "amplicon", "mapped_reads", "orf", "quality", "gRNA_count", "gRPTH", "sgRNA_count", "sgRPHT",
               "sgRPTg"]
@@ -199,7 +336,7 @@ def calculate_normalised_counts(mapped_reads,total_counts,outfile_amplicon,orf_b
             amplicon_gRNA_count = 0
 
             for orf in total_counts[amplicon]["gRNA"]:
-                amplicon_gRNA_count += len(total_counts[amplicon]["gRNA"][orf])
+                amplicon_gRNA_count += total_counts[amplicon]["gRNA"][orf]
             
             total_counts[amplicon]["gRNA_count"] = amplicon_gRNA_count
 
@@ -218,7 +355,7 @@ def calculate_normalised_counts(mapped_reads,total_counts,outfile_amplicon,orf_b
                 for orf in total_counts[amplicon]["sgRNA_" + quality]:
                     total_counts[amplicon]["gRPHT"][orf] = amplicon_gRPTH
 
-                    amplicon_orf_sgRNA_count = len(total_counts[amplicon]["sgRNA_" + quality][orf])
+                    amplicon_orf_sgRNA_count = total_counts[amplicon]["sgRNA_" + quality][orf]
 
                     # normalised per 100k total mapped reads
                     amplicon_orf_sgRPHT = amplicon_orf_sgRNA_count / (mapped_reads / 100000)
@@ -235,17 +372,18 @@ def calculate_normalised_counts(mapped_reads,total_counts,outfile_amplicon,orf_b
                     total_counts[amplicon]["sgRPTg_" + quality][orf] = amplicon_orf_sgRPTg
 
                     line = []
-                    line.append(args.sample)
-                    line.append(str(amplicon))
-                    line.append(str(mapped_reads))
-                    line.append(str(orf))
-                    line.append(str(quality))
-                    line.append(str(amplicon_gRNA_count))
-                    line.append(str(amplicon_gRPTH))
-                    line.append(str(amplicon_orf_sgRNA_count))
-                    line.append(str(amplicon_orf_sgRPHT))
-                    line.append(str(amplicon_orf_sgRPTg))
-                    f.write(",".join(line)+"\n")
+                    line.append(sample)
+                    line.append(amplicon)
+                    line.append(mapped_reads)
+                    line.append(orf)
+                    line.append(quality)
+                    line.append(amplicon_gRNA_count)
+                    line.append(amplicon_gRPTH)
+                    line.append(amplicon_orf_sgRNA_count)
+                    line.append(amplicon_orf_sgRPHT)
+                    line.append(amplicon_orf_sgRPTg)
+                    rows.append(dict(zip(header, line)))
+                    f.write(",".join(str(x) for x in line)+"\n")
 
             for quality in ["HQ", "LQ"]:
                 total_counts[amplicon]["nsgRPHT_" + quality] = {}
@@ -253,7 +391,7 @@ def calculate_normalised_counts(mapped_reads,total_counts,outfile_amplicon,orf_b
                 for orf in total_counts[amplicon]["nsgRNA_" + quality]:
                     total_counts[amplicon]["gRPHT"][orf] = amplicon_gRPTH
 
-                    amplicon_orf_sgRNA_count = len(total_counts[amplicon]["nsgRNA_" + quality][orf])
+                    amplicon_orf_sgRNA_count = total_counts[amplicon]["nsgRNA_" + quality][orf]
 
                     # normalised per 100k total mapped reads
                     amplicon_orf_sgRPHT = amplicon_orf_sgRNA_count / (mapped_reads / 100000)
@@ -266,17 +404,18 @@ def calculate_normalised_counts(mapped_reads,total_counts,outfile_amplicon,orf_b
                     total_counts[amplicon]["nsgRPTg_" + quality][orf] = amplicon_orf_sgRPTg
 
                     line = []
-                    line.append(args.sample)
-                    line.append(str(amplicon))
-                    line.append(str(mapped_reads))
-                    line.append(str(orf))
-                    line.append(str(quality))
-                    line.append(str(amplicon_gRNA_count))
-                    line.append(str(amplicon_gRPTH))
-                    line.append(str(amplicon_orf_sgRNA_count))
-                    line.append(str(amplicon_orf_sgRPHT))
-                    line.append(str(amplicon_orf_sgRPTg))
-                    f.write(",".join(line)+"\n")
+                    line.append(sample)
+                    line.append(amplicon)
+                    line.append(mapped_reads)
+                    line.append(orf)
+                    line.append(quality)
+                    line.append(amplicon_gRNA_count)
+                    line.append(amplicon_gRPTH)
+                    line.append(amplicon_orf_sgRNA_count)
+                    line.append(amplicon_orf_sgRPHT)
+                    line.append(amplicon_orf_sgRPTg)
+                    rows.append(dict(zip(header, line)))
+                    f.write(",".join(str(x) for x in line)+"\n")
 
                     # read_feature = BedTool("MN908947.3" + "\t" + str(int(orf.split("_")[1])-1) + "\t" + str(orf.split("_")[1]) + "\t" + str(orf),
                     #                        from_string=True)
@@ -293,7 +432,7 @@ def calculate_normalised_counts(mapped_reads,total_counts,outfile_amplicon,orf_b
 
     f.close()
     # orf_bed_object=orf_bed_object.sort().merge(c=4,o="distinct")
-    return total_counts,orf_bed_object
+    return total_counts,orf_bed_object,rows
 
 
 def summarised_counts_per_orf(total_counts,orf_bed_object):
@@ -327,8 +466,7 @@ def summarised_counts_per_orf(total_counts,orf_bed_object):
             if "novel" in orf.name:
                 for quality in ["LQ", "HQ"]:
                     if orf.name in total_counts[amplicon]["nsgRNA_" + quality]:
-                        result[orf.name]["nsgRNA_" + quality + "_count"] += len(
-                            total_counts[amplicon]["nsgRNA_" + quality][orf.name])
+                        result[orf.name]["nsgRNA_" + quality + "_count"] += total_counts[amplicon]["nsgRNA_" + quality][orf.name]
 
                     for metric in ["nsgRPHT", "nsgRPTg"]:
                         qmetric = metric + "_" + quality
@@ -340,7 +478,7 @@ def summarised_counts_per_orf(total_counts,orf_bed_object):
             else:
                 for quality in ["LLQ", "LQ", "HQ"]:
                     if orf.name in total_counts[amplicon]["sgRNA_" + quality]:
-                        result[orf.name]["sgRNA_" + quality + "_count"] += len(total_counts[amplicon]["sgRNA_" + quality][orf.name])
+                        result[orf.name]["sgRNA_" + quality + "_count"] += total_counts[amplicon]["sgRNA_" + quality][orf.name]
 
                     for metric in ["sgRPHT", "sgRPTg"]:
                         qmetric = metric + "_" + quality
@@ -353,7 +491,7 @@ def summarised_counts_per_orf(total_counts,orf_bed_object):
                                 result[orf.name][qmetric] = "NA"
     return result
 
-def output_summarised_counts(mapped_reads,result,outfile_counts,outfile_counts_novel):
+def output_summarised_counts(mapped_reads,result,outfile_counts,outfile_counts_novel,sample):
     """
     output the summarised counts from summarised_counts_per_orf
 
@@ -361,7 +499,11 @@ def output_summarised_counts(mapped_reads,result,outfile_counts,outfile_counts_n
     :param result: the result dictionary created by summarised_counts_per_orf
     :param outfile_counts: the outfile for the counts
     :param outfile_counts_novel: the outfile for the novel counts
+    :param sample: the sample id written in the first column
+    :return: the rows written to the counts and novel counts files (one dictionary per row, keyed on the header)
     """
+    rows=[]
+    novel_rows=[]
     with open(outfile_counts,"w") as f:
         header = ["sample", "orf", "mapped_reads", "amplicons","gRNA_count", "sgRNA_HQ_count", "sgRNA_LQ_count", "sgRNA_LLQ_count", "gRHPT", "sgRPTg_HQ", "sgRPTg_LQ", "sgRPTg_LLQ",
                   "sgRPTg_ALL", "sgRPHT_HQ", "sgRPHT_LQ", "sgRPHT_LLQ", "sgRPHT_ALL"]
@@ -370,33 +512,34 @@ def output_summarised_counts(mapped_reads,result,outfile_counts,outfile_counts_n
             if "novel" not in orf:
                 # construct output line
                 line = []
-                line.append(args.sample)
+                line.append(sample)
                 line.append(orf)
-                line.append(str(mapped_reads))
+                line.append(mapped_reads)
                 line.append("|".join(result[orf]["amplicons"]))
-                line.append(str(result[orf]["gRNA_count"]))
-                line.append(str(result[orf]["sgRNA_HQ_count"]))
-                line.append(str(result[orf]["sgRNA_LQ_count"]))
-                line.append(str(result[orf]["sgRNA_LLQ_count"]))
-                line.append(str(result[orf]["gRPHT"]))
-                line.append(str(result[orf]["sgRPTg_HQ"]))
-                line.append(str(result[orf]["sgRPTg_LQ"]))
-                line.append(str(result[orf]["sgRPTg_LLQ"]))
+                line.append(result[orf]["gRNA_count"])
+                line.append(result[orf]["sgRNA_HQ_count"])
+                line.append(result[orf]["sgRNA_LQ_count"])
+                line.append(result[orf]["sgRNA_LLQ_count"])
+                line.append(result[orf]["gRPHT"])
+                line.append(result[orf]["sgRPTg_HQ"])
+                line.append(result[orf]["sgRPTg_LQ"])
+                line.append(result[orf]["sgRPTg_LLQ"])
                 try:
                     sgRPTg_all = sum([result[orf]["sgRPTg_HQ"], result[orf]["sgRPTg_LQ"], result[orf]["sgRPTg_LLQ"]])
                 except:
                     sgRPTg_all = "NA"
-                line.append(str(sgRPTg_all))
-                line.append(str(result[orf]["sgRPHT_HQ"]))
-                line.append(str(result[orf]["sgRPHT_LQ"]))
-                line.append(str(result[orf]["sgRPHT_LLQ"]))
+                line.append(sgRPTg_all)
+                line.append(result[orf]["sgRPHT_HQ"])
+                line.append(result[orf]["sgRPHT_LQ"])
+                line.append(result[orf]["sgRPHT_LLQ"])
                 try:
                     sgRPHT_all = sum([result[orf]["sgRPHT_HQ"], result[orf]["sgRPHT_LQ"], result[orf]["sgRPHT_LLQ"]])
                 except:
                     sgRPHT_all = "NA"
-                line.append(str(sgRPHT_all))
+                line.append(sgRPHT_all)
 
-                f.write(",".join(line) + "\n")
+                rows.append(dict(zip(header, line)))
+                f.write(",".join(str(x) for x in line) + "\n")
         f.close()
     # deal with novel sgRNA seperatley
     with open(outfile_counts_novel, "w") as f:
@@ -407,52 +550,88 @@ def output_summarised_counts(mapped_reads,result,outfile_counts,outfile_counts_n
             if "novel" in orf:
                 # construct output line
                 line = []
-                line.append(args.sample)
+                line.append(sample)
                 line.append(orf)
-                line.append(str(mapped_reads))
+                line.append(mapped_reads)
                 line.append("|".join(result[orf]["amplicons"]))
-                line.append(str(result[orf]["gRNA_count"]))
-                line.append(str(result[orf]["nsgRNA_HQ_count"]))
-                line.append(str(result[orf]["nsgRNA_LQ_count"]))
-                line.append(str(result[orf]["gRPHT"]))
-                line.append(str(result[orf]["nsgRPTg_HQ"]))
-                line.append(str(result[orf]["nsgRPTg_LQ"]))
+                line.append(result[orf]["gRNA_count"])
+                line.append(result[orf]["nsgRNA_HQ_count"])
+                line.append(result[orf]["nsgRNA_LQ_count"])
+                line.append(result[orf]["gRPHT"])
+                line.append(result[orf]["nsgRPTg_HQ"])
+                line.append(result[orf]["nsgRPTg_LQ"])
                 try:
                     nsgRPTg_all = sum([result[orf]["nsgRPTg_HQ"], result[orf]["nsgRPTg_LQ"]])
                 except:
                     nsgRPTg_all = "NA"
-                line.append(str(nsgRPTg_all))
-                line.append(str(result[orf]["nsgRPHT_HQ"]))
-                line.append(str(result[orf]["nsgRPHT_LQ"]))
+                line.append(nsgRPTg_all)
+                line.append(result[orf]["nsgRPHT_HQ"])
+                line.append(result[orf]["nsgRPHT_LQ"])
                 try:
                     nsgRPHT_all = sum([result[orf]["nsgRPHT_HQ"], result[orf]["nsgRPHT_LQ"]])
                 except:
                     nsgRPTg_all = "NA"
-                line.append(str(nsgRPHT_all))
+                line.append(nsgRPHT_all)
 
-                f.write(",".join(line) + "\n")
+                novel_rows.append(dict(zip(novel_header, line)))
+                f.write(",".join(str(x) for x in line) + "\n")
         f.close()
+    return rows,novel_rows
 
 def process_reads(data):
-    bam = data[0]
-    args = data[1]
+    bam, args, task, chunk = data
+    from periscope.alignments import open_alignments
+    from periscope.chunks import chunk_reads
+    from periscope.metrics import worker_metrics
+    from periscope.progress import TaskCounter
+
     # print("processing bam:" + bam)
-    # read input bam file
-    inbamfile = pysam.AlignmentFile(bam, "rb")
+    # read input bam (or cram) file
+    reference = getattr(args, "reference", None)
+    io_threads = getattr(args, "io_threads", 1)
+    inbamfile = open_alignments(bam, reference=reference, threads=io_threads)
     # get bam header so that we can use it for writing later
     bam_header = inbamfile.header.copy().to_dict()
-    # open output bam with the header we just got
+    # open output bam with the header we just got, a cram when the tagged reads are written as cram
+
+    # the tagged reads of this chunk, --tagged-bam none writes no bam at all
+    tagged_bam = getattr(args, "tagged_bam", "full")
+    grna_subsample = getattr(args, "grna_subsample", 0.0) or 0.0
+    outbam = chunk_bam(args.output_prefix, task, getattr(args, "output_format", "bam"))
+    outbamfile = None
+    if tagged_bam != "none":
+        outbamfile = open_alignments(outbam, "w", reference=reference, threads=io_threads, header=bam_header,
+                                     compression=getattr(args, "bam_compression", None))
+
+    # live progress counts, copied to the parent every counter.every reads
+    counter = TaskCounter(task, read_classes)
+    counts = counter.counts
+
+    # parsed orfs and artic primer bed files, only read from disk once per worker
+    resources = load_resources(args)
+    orf_bed_object = resources["orf_bed"]
+    primer_bed_object = resources["primer_bed"]
+
+    total_counts = setup_counts(primer_bed_object)
 
-    outbamfile = pysam.AlignmentFile(bam + "_periscope_temp.bam", "wb", header=bam_header)
+    # the leader search covers the leading soft clip and this many bases, a negative margin searches the whole read
+    leader_margin = getattr(args, "leader_margin", default_leader_margin)
+    if leader_margin is not None and leader_margin < 0:
+        leader_margin = None
 
-    # open the orfs bed file
-    orf_bed_object = open_bed(args.orf_bed)
-    # open the artic primer bed file
-    primer_bed_object=read_bed_file(args.primer_bed)
+    # a row per read for the columnar reads table, with --columnar
+    read_features = [] if getattr(args, "columnar", None) else None
+    tagged_reads = 0
 
-    total_counts = setup_counts(primer_bed_object)
-    # for every read let's decide if it's sgRNA or not
-    for read in inbamfile:
+    # time spent in each part of the loop, reported in the run metrics
+    timer = time.time
+    timings = dict(alignment=0.0, amplicon_lookup=0.0, orf_lookup=0.0, bam_writing=0.0)
+    reads = 0
+    start = timer()
+    start_cpu = time.process_time()
+
+    # for every read in this chunk let's decide if it's sgRNA or not
+    for read in chunk_reads(inbamfile, chunk):
         if read.seq == None:
             # print("%s read has no sequence" %
             #       (read.query_name), file=sys.stderr)
@@ -466,30 +645,42 @@ def process_reads(data):
             #       (read.query_name), file=sys.stderr)
             continue
 
-        # find the amplicon for the read
+        reads += 1
 
+        # find the amplicon for the read
+        t = timer()
         amplicons = find_amplicon(read, primer_bed_object)
+        timings["amplicon_lookup"] += timer() - t
 
         total_counts[amplicons["right_amplicon"]]["total_reads"] += 1
 
+        # the orf location is cheap to find, it decides whether the leader search can change the class
+        t = timer()
+        read_orf = check_start(orf_bed_object, read)
+        timings["orf_lookup"] += timer() - t
 
-        # we are searching for the leader sequence
-        search = 'AACCAACTTTCGATCTCTTGTAGATCTGTTCT'
-
-        # search for the sequence
-        result = search_reads(read,search)
+        if leader_score_needed(read, read_orf, amplicons):
+            # we are searching for the leader sequence
+            search = 'AACCAACTTTCGATCTCTTGTAGATCTGTTCT'
 
-        # add orf location to result
-        result["read_orf"] = check_start(orf_bed_object, read)
+            # search for the sequence near the 5' end of the read
+            t = timer()
+            result = search_reads(read,search,leader_margin)
+            timings["alignment"] += timer() - t
+            counts["alignments_computed"] += 1
+        else:
+            result = {"align_score": None}
+            counts["alignments_skipped"] += 1
+        result["read_orf"] = read_orf
 
         # classify read based on prior information
         read_class = classify_read(read,result["align_score"],args.score_cutoff,result["read_orf"],amplicons)
 
-        # store the attributes we have calculated with the read as tags
-        read.set_tag('XS', result["align_score"])
-        read.set_tag('XA', amplicons["right_amplicon"])
-        read.set_tag('XC', read_class)
-        read.set_tag('XO', result["read_orf"])
+        # store the attributes we have calculated with the read as tags, for the reads the tagged bam keeps
+        write = outbamfile is not None and keep_tagged(read, read_class, tagged_bam, grna_subsample)
+        if write:
+            tag_read(read, result["align_score"], amplicons["right_amplicon"], read_class, result["read_orf"],
+                     getattr(args, "xs_sentinel", None))
 
 
         # ok now add this info to a dictionary for later processing
@@ -497,17 +688,51 @@ def process_reads(data):
             if result["read_orf"] is None:
                 result["read_orf"] = "novel_"+str(read.pos)
 
-        if result["read_orf"] not in total_counts[amplicons["right_amplicon"]][read_class]:
-            total_counts[amplicons["right_amplicon"]][read_class][result["read_orf"]] = []
+        orf_counts = total_counts[amplicons["right_amplicon"]][read_class]
+        orf_counts[result["read_orf"]] = orf_counts.get(result["read_orf"], 0) + 1
 
-        total_counts[amplicons["right_amplicon"]][read_class][result["read_orf"]].append(read.to_string())
+        # the read's row of the columnar reads table
+        if read_features is not None:
+            read_features.append(dict(sample=args.sample, read_id=read.query_name, reference_start=read.reference_start,
+                                      reference_end=read.reference_end, is_reverse=read.is_reverse,
+                                      amplicon=amplicons["right_amplicon"], orf=result["read_orf"],
+                                      read_class=read_class, leader_score=result["align_score"]))
 
         # write the annotated read to a bam file
-        outbamfile.write(read)
-
-    outbamfile.close()
-
-    return total_counts
+        if write:
+            t = timer()
+            outbamfile.write(read)
+            timings["bam_writing"] += timer() - t
+            tagged_reads += 1
+
+        counts["reads"] += 1
+        counts[read_class] += 1
+        if reads % counter.every == 0:
+            counter.flush(bytes_written=os.path.getsize(outbam) if outbamfile is not None else 0)
+
+    if outbamfile is not None:
+        t = timer()
+        outbamfile.close()
+        timings["bam_writing"] += timer() - t
+    counter.flush(bytes_written=os.path.getsize(outbam) if outbamfile is not None else 0)
+    inbamfile.close()
+
+    if read_features is not None:
+        from periscope.columnar import write_part
+        write_part(read_features, chunk_features(args.output_prefix, task), "ont", "reads")
+
+    chunk_metrics = worker_metrics(bam, reads, timer() - start, time.process_time() - start_cpu, timings, chunk=task)
+    chunk_metrics["tagged_reads"] = tagged_reads
+    return total_counts, chunk_metrics
+
+def chunk_bam(output_prefix, task, output_format="bam"):
+    # the annotated reads of one chunk, concatenated in chunk order into <OUTPUT_PREFIX>_periscope.bam (or .cram)
+    from periscope.alignments import extension
+    return "{}_chunk_{:05}_periscope_temp{}".format(output_prefix, task, extension(output_format))
+
+def chunk_features(output_prefix, task):
+    # the columnar read features of one chunk, copied in chunk order into <OUTPUT_PREFIX>_periscope_reads.parquet
+    return "{}_chunk_{:05}_periscope_reads_temp.arrow".format(output_prefix, task)
 
 def combine(processed_counts, primer_bed_object):
 
@@ -523,14 +748,68 @@ def combine(processed_counts, primer_bed_object):
                 for orf in counts[amplicon][sgclass]:
                     # print(orf)
                     # print(counts[amplicon][sgclass][orf])
-                    #inside each orf is a list
+                    #inside each orf is a read count
                     if orf in total_counts[amplicon][sgclass]:
                         total_counts[amplicon][sgclass][orf] = total_counts[amplicon][sgclass][orf] + counts[amplicon][sgclass][orf]
                     else:
                         total_counts[amplicon][sgclass][orf] = counts[amplicon][sgclass][orf]
     return total_counts
 
-def finalise(args,total_counts):
+class TriageProportions():
+    """
+    the binomial proportions the triage mode (--target-precision) tracks, called with the results of the chunks done so
+    far, every ORF in the ORF bed has one per ORF and one per amplicon at its start
+    """
+    def __init__(self, orfs, primer_bed_object):
+        self.orfs = orfs
+        self.primer_bed_object = primer_bed_object
+        self.seen = 0
+        self.reads = 0
+        self.gRNA = {}
+        self.sgRNA = {}
+
+    def orf_amplicons(self, orf):
+        # the amplicons covering the ORF start, from the compiled scheme, otherwise those its sgRNA reads were found in
+        if hasattr(self.primer_bed_object, "orf_amplicons"):
+            return self.primer_bed_object.orf_amplicons(orf)
+        return sorted(amplicon for amplicon, sgRNA_orf in self.sgRNA if sgRNA_orf == orf)
+
+    def __call__(self, processed):
+        """
+        :param processed: list of (total counts, worker metrics) returned by process_reads
+        :return: dictionary of ("orf", orf) to (HQ sgRNA reads, reads) and ("amplicon", "<amplicon>:<orf>") to (HQ
+        sgRNA reads, HQ sgRNA and gRNA reads of the amplicon)
+        """
+        for counts, _ in processed[self.seen:]:
+            for amplicon in counts:
+                self.reads += counts[amplicon]["total_reads"]
+                self.gRNA[amplicon] = self.gRNA.get(amplicon, 0) + sum(counts[amplicon]["gRNA"].values())
+                for orf, sgRNA in counts[amplicon]["sgRNA_HQ"].items():
+                    self.sgRNA[(amplicon, orf)] = self.sgRNA.get((amplicon, orf), 0) + sgRNA
+        self.seen = len(processed)
+
+        proportions = {}
+        for orf in self.orfs:
+            orf_sgRNA = sum(count for (_, sgRNA_orf), count in self.sgRNA.items() if sgRNA_orf == orf)
+            proportions[("orf", orf)] = (orf_sgRNA, self.reads)
+            for amplicon in self.orf_amplicons(orf):
+                count = self.sgRNA.get((amplicon, orf), 0)
+                proportions[("amplicon", "{}:{}".format(amplicon, orf))] = (count, count + self.gRNA.get(amplicon, 0))
+        return proportions
+
+def finalise(args,total_counts,metrics,fraction_processed=1.0,mapped_reads=None):
+    """
+    normalise the combined counts and write the amplicon, counts and novel counts CSVs
+
+    :param args: the arguments namespace
+    :param total_counts: the combined total counts dictionary
+    :param metrics: the run metrics, the CSV writing stage (and the flagstat stage) are added to it
+    :param fraction_processed: fraction of the reads counted, below 1 in triage mode where the mapped reads are scaled
+    down to the sample
+    :param mapped_reads: the mapped reads of the whole bam, counted while it was cut into chunks, otherwise they are
+    counted with samtools flagstat
+    :return: dictionary of the tables written ("counts", "novel_counts", "amplicons") and the "mapped_reads" used
+    """
 
     # define ORF bed object because we cleared our session
     orf_bed_object = open_bed(args.orf_bed)
@@ -538,76 +817,261 @@ def finalise(args,total_counts):
     # go through each amplicon and do normalisations
     outfile_amplicons = args.output_prefix + "_periscope_amplicons.csv"
     # print(outfile_amplicons)
-    mapped_reads = get_mapped_reads(args.bam)
-    total_counts,orf_bed_object = calculate_normalised_counts(mapped_reads,total_counts,outfile_amplicons,orf_bed_object)
-    # summarise result into ORFs
-    result = summarised_counts_per_orf(total_counts,orf_bed_object)
-    # output summarised counts
+    if mapped_reads is None:
+        with metrics.stage("flagstat", inputs=[args.bam]) as stage:
+            mapped_reads = get_mapped_reads(args.bam, getattr(args, "reference", None))
+            stage["records"] = mapped_reads
+    if fraction_processed < 1:
+        mapped_reads = max(1, int(round(mapped_reads * fraction_processed)))
+
     outfile_counts = args.output_prefix + "_periscope_counts.csv"
     outfile_counts_novel = args.output_prefix + "_periscope_novel_counts.csv"
-    output_summarised_counts(mapped_reads,result,outfile_counts,outfile_counts_novel)
+    with metrics.stage("csv_writing", outputs=[outfile_amplicons, outfile_counts, outfile_counts_novel]) as stage:
+        total_counts,orf_bed_object,amplicon_rows = calculate_normalised_counts(mapped_reads,total_counts,outfile_amplicons,orf_bed_object,args.sample)
+        # summarise result into ORFs
+        result = summarised_counts_per_orf(total_counts,orf_bed_object)
+        # output summarised counts
+        counts_rows,novel_rows = output_summarised_counts(mapped_reads,result,outfile_counts,outfile_counts_novel,args.sample)
+        stage["records"] = len(amplicon_rows) + len(counts_rows) + len(novel_rows)
+
+    return dict(counts=counts_rows,novel_counts=novel_rows,amplicons=amplicon_rows,mapped_reads=mapped_reads)
+
+def multiprocessing(func, args, workers, initializer=None, initargs=(), executor=None):
+    from tqdm import tqdm
 
-def multiprocessing(func, args, workers):
-    with ProcessPool(workers) as ex:
+    if executor is not None:
+        # a caller supplied executor, its workers load the resources on their first call
+        return list(tqdm(executor.map(func, args),total=len(args)))
+
+    # map submits every chunk as its own task (chunksize 1), a worker takes the next chunk as soon as it is free
+    with ProcessPool(workers, initializer=initializer, initargs=initargs) as ex:
         res = list(tqdm(ex.map(func, args),total=len(args)))
     return list(res)
 
-def main(args):
-    # get a list of bams:
-    import glob
-    files = glob.glob(args.output_prefix+"_split_*.sam")
+def classify(args, executor=None, metrics=None):
+    """
+    classify the reads of args.bam in chunks, combine the counts and write the outputs
 
-    result=[]
-    for file in files:
-        result.append([file,args])
-    output_bams = [file+"_periscope_temp.bam" for file in files]
-    output_bams_merged = args.output_prefix + "_periscope.bam"
+    :param args: the arguments namespace
+    :param executor: optional concurrent.futures executor to run the workers on, defaults to a process pool of
+    args.threads workers
+    :param metrics: optional periscope.metrics.Metrics the classification stages and workers are recorded in
+    :return: dictionary of the tables written by finalise
+    """
+    from periscope.alignments import extension, samtools_options
+    from periscope.chunks import make_chunks, default_chunk_reads
+    from periscope.metrics import Metrics
+    from periscope.progress import Progress, expected_reads
+
+    if metrics is None:
+        metrics = Metrics(args.output_prefix)
+    if getattr(args, "columnar", None):
+        from periscope.columnar import require_pyarrow
+        require_pyarrow()
+
+    # cut the bam into chunks of --chunk-reads reads, the pool hands them out one at a time as workers free up
+    chunk_size = getattr(args, "chunk_reads", None) or default_chunk_reads
+    # with --max-memory the chunks are made small enough for every worker's share of it, the counts kept per
+    # amplicon don't grow with the reads so nothing is spilled
+    if getattr(args, "max_memory", None):
+        from periscope.cache import parse_size
+        from periscope.spill import memory_plan
+        plan = memory_plan(parse_size(args.max_memory), int(args.threads), chunk_size, "ont",
+                           getattr(args, "columnar", None))
+        chunk_size = plan["chunk_reads"]
+        metrics.extra["memory"] = dict(plan, spilled_reads=0, spilled_bytes=0, spill_runs=0)
+    # triage mode counts rounds of randomly sampled reads, the chunking pass writes each round to a bam of its own
+    target_precision = getattr(args, "target_precision", None)
+    round_bams = []
+    if target_precision:
+        from periscope import triage
+        round_bams = triage.round_bams(args.output_prefix)
+    # the same pass counts the mapped reads the counts are normalised by
+    totals = {}
+    with metrics.stage("chunking", inputs=[args.bam], outputs=round_bams) as stage:
+        if target_precision:
+            round_chunks = triage.bucket_rounds(args.bam, round_bams, chunk_size, getattr(args, "reference", None),
+                                                getattr(args, "io_threads", 1), totals)
+            chunks = [chunk for bam_chunks in round_chunks for chunk in bam_chunks]
+        else:
+            chunks = make_chunks(args.bam, chunk_size, getattr(args, "reference", None),
+                                 getattr(args, "io_threads", 1), totals)
+        stage["records"] = sum(chunk[2] for chunk in chunks)
 
+    result=[]
+    for task, chunk in enumerate(chunks):
+        result.append([args.bam,args,task,chunk])
+    if target_precision:
+        rounds = triage.triage_tasks(round_bams, args, round_chunks)
+        result = [task for round_tasks in rounds for task in round_tasks]
+    output_format = getattr(args, "output_format", "bam")
+    tagged_bam = getattr(args, "tagged_bam", "full")
+    output_bams = []
+    if tagged_bam != "none":
+        output_bams = [chunk_bam(args.output_prefix, task, output_format) for task in range(len(result))]
+    output_bams_merged = args.output_prefix + "_periscope" + extension(output_format)
+
+    finished = False
     try:
+        # parse the resources before the pool starts, forked workers share this copy and the initializer only has
+        # to load them when workers are spawned
+        resources = load_resources(args)
+
+        # with --profile every worker task is profiled, the parent merges the profiles (periscope.profiling)
+        worker = process_reads
+        if getattr(args, "profile", None):
+            from periscope.profiling import Profiled
+            worker = Profiled(process_reads, args.output_prefix, args.profile)
+
+        # live progress for the node exporter, workers of a caller supplied process pool can't report to it
+        progress = None
+        if getattr(args, "progress_textfile", None):
+            progress = Progress(args.progress_textfile, len(result), read_classes, expected_reads(args.bam) or sum(chunk[2] for chunk in chunks),
+                                labels=dict(sample=args.sample, technology="ont"), interval=args.progress_interval)
+            progress.start()
+
         # initiate parallel processing of reads
-        processed = multiprocessing(
-            process_reads,
-            args=result,
-            workers=int(args.threads)
-        )
+        with metrics.stage("classification", inputs=[args.bam], outputs=output_bams) as stage:
+            try:
+                if target_precision:
+                    # triage, rounds of random reads until every estimate is within the target precision
+                    processed, finished_rounds, precision_rows = triage.adaptive_map(
+                        worker,
+                        rounds,
+                        int(args.threads),
+                        TriageProportions([row.name for row in resources["orf_bed"]], resources["primer_bed"]),
+                        float(target_precision),
+                        initializer=init_worker,
+                        initargs=(args, progress.shared_state() if progress else None),
+                        executor=executor
+                    )
+                    tasks_done = list(range(sum(len(round_tasks) for round_tasks in rounds[:finished_rounds])))
+                else:
+                    processed = multiprocessing(
+                        worker,
+                        args=result,
+                        workers=int(args.threads),
+                        initializer=init_worker,
+                        initargs=(args, progress.shared_state() if progress else None),
+                        executor=executor
+                    )
+                    tasks_done = list(range(len(chunks)))
+            finally:
+                if progress:
+                    progress.stop()
+            processed, workers = zip(*processed) if processed else ([], [])
+            metrics.add_workers(list(workers))
+            stage["records"] = sum(worker["reads"] for worker in workers)
+
+        fraction_processed = 1.0
+        if target_precision:
+            fraction_processed, precision_rows = triage.report(args, len(rounds), finished_rounds, stage["records"],
+                                                               precision_rows, metrics)
 
         # combine total counts from multiprocessing
-        primer_bed_object = read_bed_file(args.primer_bed)
+        primer_bed_object = resources["primer_bed"]
         total_counts = combine(processed, primer_bed_object)
 
         # finalise counts and write CSVs
-        finalise(args, total_counts)
-
-        # merge periscope temp bams into final output
-        pysam.merge(*["-f", output_bams_merged] + output_bams)
+        tables = finalise(args, total_counts, metrics, fraction_processed, totals["mapped_reads"])
+        if target_precision:
+            tables["precision"] = precision_rows
+
+        # columnar copies of the tables, and the read features the workers wrote for each chunk
+        columnar_format = getattr(args, "columnar", None)
+        if columnar_format:
+            from periscope import columnar
+            columnar.write_outputs(args.output_prefix, "ont", tables, columnar_format, metrics)
+            parts = [chunk_features(args.output_prefix, task) for task in tasks_done]
+            reads_table = columnar.output_path(args.output_prefix, "reads", columnar_format)
+            with metrics.stage("columnar_reads", inputs=parts, outputs=[reads_table]) as stage:
+                stage["records"] = columnar.combine_parts(parts, reads_table, "ont", "reads", columnar_format)
+
+        # the chunks are contiguous ranges of the sorted bam so concatenating them in order keeps it sorted, no
+        # need to merge. Each triage round is sorted on its own, they are merged
+        if tagged_bam != "none":
+            merged_bams = [output_bams[task] for task in tasks_done]
+            with metrics.stage("bam_merge", inputs=merged_bams, outputs=[output_bams_merged]) as stage:
+                if target_precision:
+                    compression = getattr(args, "bam_compression", None)
+                    pysam.merge(*["-f", "-@", str(getattr(args, "io_threads", 1))] +
+                                (["-l", str(compression)] if compression is not None else []) +
+                                samtools_options(output_bams_merged, getattr(args, "reference", None), output=True) +
+                                [output_bams_merged] + merged_bams)
+                else:
+                    pysam.cat(*["-o", output_bams_merged] + merged_bams)
+                stage["records"] = sum(worker["tagged_reads"] for worker in workers)
+            metrics.extra["tagged_bam"] = dict(policy=tagged_bam, file=output_bams_merged, reads=stage["records"],
+                                               grna_subsample=getattr(args, "grna_subsample", 0.0),
+                                               compression=getattr(args, "bam_compression", None))
+        else:
+            metrics.extra["tagged_bam"] = dict(policy=tagged_bam, file=None, reads=0)
+        finished = True
 
     finally:
-        # clean up temp BAMs regardless of success/failure
-        for temp_bam in output_bams:
+        # clean up temp BAMs regardless of success/failure, the tagged bam is only kept when the run finished
+        for temp_bam in output_bams + [chunk_features(args.output_prefix, task) for task in range(len(result))] + round_bams:
             if os.path.exists(temp_bam):
                 os.remove(temp_bam)
-        if os.path.exists(output_bams_merged):
+        if not finished and os.path.exists(output_bams_merged):
             os.remove(output_bams_merged)
-    
+
+    return tables
+
+def main(args):
+    from periscope.metrics import Metrics
+    from periscope.profiling import profile_run
+
+    # stages run by snakemake before us are in the stage log
+    metrics = Metrics(args.output_prefix)
+    stage_log = args.output_prefix + "_periscope_stages.jsonl"
+    metrics.read_log(stage_log)
+
+    with profile_run(args.profile, args.output_prefix, metrics):
+        tables = classify(args, metrics=metrics)
+    metrics.extra["mapped_reads"] = tables["mapped_reads"]
+    metrics.write(args.output_prefix + "_periscope_metrics.json")
+    if os.path.exists(stage_log):
+        os.remove(stage_log)
+
+    return tables
+
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='periscopre: Search for sgRNA reads in artic network SARS-CoV-2 sequencing data')
-    parser.add_argument('--bam', help='bam file',default="The bam file of full artic reads")
+    parser.add_argument('--bam', help='bam (or cram) file',default="The bam file of full artic reads")
+    parser.add_argument('--reference', help='the reference fasta crams are read and written with (the bundled nCoV-2019.reference.fasta)', default=None)
+    parser.add_argument('--output-format', dest='output_format', help='format of the tagged reads, <OUTPUT_PREFIX>_periscope.bam or .cram (bam)', choices=['bam', 'cram'], default='bam')
+    parser.add_argument('--io-threads', dest='io_threads', help='pysam threads compressing and decompressing each bam or cram (1)', type=int, default=1)
     parser.add_argument('--output-prefix',dest='output_prefix',help="Path to the output, e.g. <DIR>/<SAMPLE_NAME>")
     parser.add_argument('--score-cutoff',dest='score_cutoff', help='Cut-off for alignment score of leader (50) we recommend you leave this at 50',default=50)
     parser.add_argument('--orf-bed', dest='orf_bed', help='The bed file with ORF start positions')
     parser.add_argument('--primer-bed', dest='primer_bed', help='The bed file with artic primer positions')
     parser.add_argument('--amplicon-bed', dest='amplicon_bed', help='A bed file of artic amplicons')
+    parser.add_argument('--scheme', help='the compiled primer scheme (periscope compile-scheme), used in place of --primer-bed', default=None)
     parser.add_argument('--sample', help='sample id',default="SAMPLE")
     parser.add_argument('--tmp',help="pybedtools likes to write to /tmp if you want to write somewhere else define it here",default="/tmp")
     parser.add_argument('--progress', help='display progress bar', default="")
     parser.add_argument('--threads', help='threads used for multi-processing', default=1)
+    parser.add_argument('--chunk-reads', dest='chunk_reads', help='reads per chunk of work handed to a worker (50000)', type=int, default=50000)
+    parser.add_argument('--progress-textfile', dest='progress_textfile', help='write live progress to this prometheus textfile (e.g. in the node exporter textfile directory)', default=None)
+    parser.add_argument('--progress-interval', dest='progress_interval', help='seconds between progress textfile updates (15)', type=float, default=15)
+    parser.add_argument('--target-precision', dest='target_precision', help='triage: count random chunks until every ORF and amplicon ratio is known to this relative precision (e.g. 0.05), writes <OUTPUT_PREFIX>_periscope_precision.csv', type=float, default=None)
+    parser.add_argument('--xs-sentinel', dest='xs_sentinel', help='XS tag written on reads whose leader search was skipped because it could not change their class (e.g. -1), by default they get no XS tag', type=float, default=None)
+    parser.add_argument('--leader-margin', dest='leader_margin', help='search for the leader in the leading soft clip and this many bases after it (40), -1 searches the whole read', type=int, default=default_leader_margin)
+    parser.add_argument('--tagged-bam', dest='tagged_bam', help='which reads are written to <OUTPUT_PREFIX>_periscope.bam: none (no tagged bam), sgrna (the sgRNA and nsgRNA reads and --grna-subsample of the gRNA reads) or full (every read, the default)', choices=tagged_bam_policies, default='full')
+    parser.add_argument('--grna-subsample', dest='grna_subsample', help='with --tagged-bam sgrna, the fraction of the gRNA reads also written (0)', type=float, default=0.0)
+    parser.add_argument('--bam-compression', dest='bam_compression', help='compression level of the tagged bam, 0 (fastest) to 9 (smallest), the htslib default when not given', type=int, choices=range(10), default=None)
+    parser.add_argument('--max-memory', dest='max_memory', help='memory budget shared by the workers and the parent (e.g. 16G), the chunks are cut to fit it', default=None)
+    parser.add_argument('--columnar', help='also write the counts, novel counts, amplicons and per read tables as parquet or arrow files with a declared schema (needs pyarrow)', choices=['parquet', 'arrow'], default=None)
+    parser.add_argument('--profile', help='profile the parent and every worker, all (sampling and cProfile), sample or cprofile; writes <OUTPUT_PREFIX>_periscope_profile.collapsed and .pstats', nargs='?', const='all', choices=['all', 'sample', 'cprofile'], default=None)
 
 
     args = parser.parse_args()
 
+    from pybedtools import set_tempdir
     set_tempdir(args.tmp)
 
     periscope = main(args)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# deterministic synthetic amplicon reads with a known truth, for benchmarking and checking the classifiers
+#
+# reads are made from the bundled reference and the primer scheme: gRNA reads are whole amplicons, sgRNA reads are the
+# leader (from the first left primer to the leader TRS) joined to the body of an ORF just after its TRS and run to the
+# right primer of an amplicon covering the junction, nsgRNA reads are the same at a non-canonical position. Alongside
+# the fastqs we write the alignment the reads were made from (leader soft clipped, as minimap2/bwa report it), so the
+# counting stage can be run without a mapper, and the truth per read and in total.
+from periscope import __version__
+
+import argparse
+import json
+import os
+import random
+import sys
+
+import pysam
+
+# the 3' end of the leader is the TRS core, the body junction follows the same core in front of each ORF
+trs_core = "ACGAAC"
+complement = str.maketrans("ACGTN", "TGCAN")
+
+# constant base qualities, ONT Q20 and illumina Q37
+qualities = {"ont": "5", "illumina": "F"}
+
+
+def reverse_complement(seq):
+    return seq.translate(complement)[::-1]
+
+
+def read_orfs(orf_bed):
+    """
+    :param orf_bed: the orf start bed file
+    :return: list of (name, start, end) for each ORF window
+    """
+    orfs = []
+    with open(orf_bed) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            chrom, start, end, name = line.split()[:4]
+            orfs.append((name, int(start), int(end)))
+    return orfs
+
+
+def read_amplicons(primer_bed):
+    """
+    make the amplicons from the primers, alts widen the primer they are an alternative for
+    :param primer_bed: artic primer bed file
+    :return: list of amplicon dictionaries (number, start, end, right_start, pool, left_primers) in amplicon order
+    """
+    amplicons = {}
+    with open(primer_bed) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            fields = line.split()
+            start, end, primer_id, pool = int(fields[1]), int(fields[2]), fields[3], fields[4]
+            number = int(primer_id.split("_")[1])
+            amplicon = amplicons.setdefault(number, dict(number=number, start=None, end=None, right_start=None, pool=pool, left_primers=[]))
+            if "LEFT" in primer_id:
+                amplicon["start"] = start if amplicon["start"] is None else min(start, amplicon["start"])
+                amplicon["left_primers"].append((start, end))
+            else:
+                amplicon["end"] = end if amplicon["end"] is None else max(end, amplicon["end"])
+                amplicon["right_start"] = start if amplicon["right_start"] is None else min(start, amplicon["right_start"])
+    return [amplicons[number] for number in sorted(amplicons)]
+
+
+def find_orf(orfs, position):
+    # the ORF window a read starting here falls in, the same test the classifiers make
+    for name, start, end in orfs:
+        if end >= position >= start:
+            return name
+    return None
+
+
+class Simulator():
+    """
+    makes the reads, every random choice comes from one seeded generator so the same arguments give the same reads
+    """
+    def __init__(self, reference, primer_bed, orf_bed, technology="ont", seed=1, read_length=150, error_rate=0.0,
+                 sgrna_fraction=0.1, novel_fraction=0.01, novel_sites=5):
+        fasta = pysam.FastaFile(reference)
+        self.chrom = fasta.references[0]
+        self.reference = fasta.fetch(self.chrom).upper()
+        self.length = len(self.reference)
+        fasta.close()
+
+        self.technology = technology
+        self.rng = random.Random(seed)
+        self.read_length = read_length
+        self.error_rate = error_rate
+        self.sgrna_fraction = sgrna_fraction
+        self.novel_fraction = novel_fraction
+
+        self.amplicons = read_amplicons(primer_bed)
+        self.orfs = read_orfs(orf_bed)
+
+        # leader from the first left primer to the end of the leader TRS
+        self.leader_start = self.amplicons[0]["start"]
+        self.leader_end = self.reference.index(trs_core) + len(trs_core)
+
+        # the shortest body we make, illumina needs a whole mate after the junction
+        self.min_body = read_length if technology == "illumina" else 100
+
+        # sgRNA junctions, ORF1a is genomic so has no sgRNA
+        self.junctions = []
+        for name, start, end in self.orfs:
+            if name == "ORF1a":
+                continue
+            window = self.reference[start:end]
+            if trs_core in window:
+                position = start + window.index(trs_core) + len(trs_core)
+            else:
+                position = (start + end) // 2
+            if self.candidate_amplicons(position):
+                self.junctions.append((name, position))
+
+        self.novel_junctions = self.choose_novel_junctions(novel_sites)
+
+    def candidate_amplicons(self, position):
+        # amplicons covering a junction, with enough body before the right primer
+        candidates = [amplicon for amplicon in self.amplicons
+                      if amplicon["start"] <= position and amplicon["right_start"] - position >= self.min_body]
+        if not candidates:
+            candidates = [amplicon for amplicon in self.amplicons if amplicon["right_start"] - position >= self.min_body][:1]
+        return candidates
+
+    def choose_novel_junctions(self, sites):
+        # away from the ORF windows and from the left primers (the ONT classifier calls those gRNA)
+        excluded = [(start - 50, end + 50) for name, start, end in self.orfs]
+        for amplicon in self.amplicons:
+            excluded += [(start - 10, end + 10) for start, end in amplicon["left_primers"]]
+        junctions = []
+        while len(junctions) < sites:
+            position = self.rng.randrange(1000, self.length - 1000)
+            if any(start <= position <= end for start, end in excluded) or not self.candidate_amplicons(position):
+                continue
+            junctions.append(("novel_" + str(position), position))
+        return sorted(junctions, key=lambda junction: junction[1])
+
+    def mutate(self, seq, start=0):
+        # substitutions at error_rate from start onwards, the gap to the next error is drawn rather than a draw per base
+        if not self.error_rate:
+            return seq
+        seq = list(seq)
+        i = start + int(self.rng.expovariate(self.error_rate))
+        while i < len(seq):
+            seq[i] = self.rng.choice([base for base in "ACGT" if base != seq[i]])
+            i += 1 + int(self.rng.expovariate(self.error_rate))
+        return "".join(seq)
+
+    def fragment(self):
+        """
+        one molecule
+
+        :return: dictionary of the read class, orf, amplicon, leader length (soft clipped), body start and sequence
+        """
+        draw = self.rng.random()
+        if draw < self.sgrna_fraction and self.junctions:
+            read_class = "sgRNA"
+            orf, position = self.rng.choice(self.junctions)
+        elif draw < self.sgrna_fraction + self.novel_fraction and self.novel_junctions:
+            read_class = "nsgRNA"
+            orf, position = self.rng.choice(self.novel_junctions)
+        else:
+            amplicon = self.rng.choice(self.amplicons)
+            seq = self.mutate(self.reference[amplicon["start"]:amplicon["end"]])
+            return dict(read_class="gRNA", orf=find_orf(self.orfs, amplicon["start"]), amplicon=amplicon["number"],
+                        leader=0, start=amplicon["start"], seq=seq)
+
+        amplicon = self.rng.choice(self.candidate_amplicons(position))
+        leader = self.reference[self.leader_start:self.leader_end]
+        # the leader is kept exact so the leader search truth is exact, errors go in the body
+        seq = leader + self.mutate(self.reference[position:amplicon["end"]])
+        return dict(read_class=read_class, orf=orf, amplicon=amplicon["number"], leader=len(leader), start=position,
+                    seq=seq)
+
+    def reads(self, n):
+        """
+        generate n molecules as aligned records
+
+        :param n: number of reads (ONT) or read pairs (illumina)
+        :return: generator of (truth, [records]), each record is a dictionary of the name, flag, pos, cigar, seq and
+        (for pairs) the mate fields
+        """
+        for i in range(n):
+            name = "sim_{:09d}".format(i)
+            fragment = self.fragment()
+            seq, leader, start = fragment["seq"], fragment["leader"], fragment["start"]
+            body = len(seq) - leader
+            truth = dict(read_id=name, read_class=fragment["read_class"], orf=fragment["orf"], amplicon=fragment["amplicon"])
+
+            if self.technology == "ont":
+                cigar = ([(4, leader)] if leader else []) + [(0, body)]
+                flag = 16 if self.rng.random() < 0.5 else 0
+                yield truth, [dict(name=name, flag=flag, pos=start, cigar=cigar, seq=seq, end=start + body)]
+                continue
+
+            # illumina, R1 from the 5' end of the fragment, R2 from the 3' end on the reverse strand
+            length = min(self.read_length, len(seq))
+            r1_clip = min(leader, length)
+            r1 = dict(name=name, flag=99, pos=start, cigar=([(4, r1_clip)] if r1_clip else []) + [(0, length - r1_clip)],
+                      seq=seq[:length])
+            r1["end"] = start + length - r1_clip
+            r2_length = min(length, body)
+            r2_pos = start + body - r2_length
+            r2 = dict(name=name, flag=147, pos=r2_pos, cigar=[(0, r2_length)], seq=seq[len(seq) - r2_length:],
+                      end=start + body)
+            # mate fields as bwa sets them, MC is the mate's cigar
+            for read, mate in [(r1, r2), (r2, r1)]:
+                read["mate_pos"] = mate["pos"]
+                read["mate_cigar"] = "".join("{}{}".format(size, "MIDNSHP=X"[op]) for op, size in mate["cigar"])
+                tlen = r2["end"] - r1["pos"]
+                read["tlen"] = tlen if read is r1 else -tlen
+            yield truth, [r1, r2]
+
+
+def write_records(records, bamfile, header, fastqs, quality):
+    for record in records:
+        segment = pysam.AlignedSegment(header)
+        segment.query_name = record["name"]
+        segment.flag = record["flag"]
+        segment.reference_id = 0
+        segment.reference_start = record["pos"]
+        segment.mapping_quality = 60
+        segment.cigartuples = record["cigar"]
+        segment.query_sequence = record["seq"]
+        segment.query_qualities = pysam.qualitystring_to_array(quality * len(record["seq"]))
+        if "mate_pos" in record:
+            segment.next_reference_id = 0
+            segment.next_reference_start = record["mate_pos"]
+            segment.template_length = record["tlen"]
+            segment.set_tag("MC", record["mate_cigar"])
+        bamfile.write(segment)
+
+        # the fastq has the read as sequenced
+        seq = reverse_complement(record["seq"]) if record["flag"] & 16 else record["seq"]
+        fastq = fastqs[0] if record["flag"] & 64 or len(fastqs) == 1 else fastqs[1]
+        fastq.write("@{}\n{}\n+\n{}\n".format(record["name"], seq, quality * len(seq)))
+
+
+def simulate(output_prefix, reads, technology="ont", primer_bed=None, artic_primers="V3", resources=None, seed=1,
+             read_length=150, error_rate=0.0, sgrna_fraction=0.1, novel_fraction=0.01, novel_sites=5, threads=1):
+    """
+    simulate a run and write <OUTPUT_PREFIX>.bam (coordinate sorted and indexed), the fastq(s), the per read truth
+    <OUTPUT_PREFIX>_truth.tsv and the summary <OUTPUT_PREFIX>_truth.json
+
+    :param output_prefix: prefix of the output files
+    :param reads: number of reads (ONT) or read pairs (illumina)
+    :param technology: ont or illumina
+    :param primer_bed: artic primer bed file, defaults to the bundled one for artic_primers
+    :param artic_primers: bundled primer scheme to use when primer_bed is not given
+    :param resources: the periscope resources directory, defaults to the one installed with periscope
+    :param seed: random seed
+    :param read_length: illumina read length
+    :param error_rate: substitution rate applied outside the leader
+    :param sgrna_fraction: fraction of reads that are canonical sgRNA, spread evenly over the ORFs
+    :param novel_fraction: fraction of reads that are sgRNA at non-canonical junctions
+    :param novel_sites: number of non-canonical junctions
+    :param threads: threads used to sort the bam
+    :return: the truth summary
+    """
+    if technology not in ["ont", "illumina"]:
+        raise ValueError("{} is not a supported technology, use ont or illumina".format(technology))
+    if resources is None:
+        resources = os.path.join(os.path.dirname(__file__), "resources")
+    if primer_bed is None:
+        primer_bed = os.path.join(resources, "artic_primers_{}.bed".format(artic_primers))
+
+    simulator = Simulator(os.path.join(resources, "nCoV-2019.reference.fasta"), primer_bed,
+                          os.path.join(resources, "orf_start.bed"), technology=technology, seed=seed,
+                          read_length=read_length, error_rate=error_rate, sgrna_fraction=sgrna_fraction,
+                          novel_fraction=novel_fraction, novel_sites=novel_sites)
+
+    header = pysam.AlignmentHeader.from_dict({
+        "HD": {"VN": "1.6", "SO": "unsorted"},
+        "SQ": [{"SN": simulator.chrom, "LN": simulator.length}],
+        "PG": [{"ID": "periscope-simulate", "PN": "periscope-simulate", "VN": __version__}]
+    })
+
+    if technology == "ont":
+        fastq_files = [output_prefix + ".fastq"]
+    else:
+        fastq_files = [output_prefix + "_R1.fastq", output_prefix + "_R2.fastq"]
+
+    summary = dict(periscope_version=__version__, technology=technology, primer_bed=os.path.basename(primer_bed),
+                   seed=seed, reads=reads, records=0, gRNA={}, sgRNA={}, nsgRNA={})
+    unsorted_bam = output_prefix + "_unsorted.bam"
+    fastqs = [open(file, "w") for file in fastq_files]
+    try:
+        with pysam.AlignmentFile(unsorted_bam, "wb", header=header) as bamfile, \
+                open(output_prefix + "_truth.tsv", "w") as truth_file:
+            truth_file.write("read_id\tread_class\torf\tamplicon\n")
+            for truth, records in simulator.reads(reads):
+                write_records(records, bamfile, header, fastqs, qualities[technology])
+                truth_file.write("{read_id}\t{read_class}\t{orf}\t{amplicon}\n".format(**truth))
+                summary["records"] += len(records)
+                counts = summary[truth["read_class"]]
+                key = str(truth["orf"] if truth["read_class"] != "gRNA" else truth["amplicon"])
+                counts[key] = counts.get(key, 0) + 1
+    finally:
+        for fastq in fastqs:
+            fastq.close()
+
+    pysam.sort("-@", str(threads), "-o", output_prefix + ".bam", unsorted_bam)
+    pysam.index(output_prefix + ".bam")
+    os.remove(unsorted_bam)
+
+    with open(output_prefix + "_truth.json", "w") as f:
+        json.dump(summary, f, indent=2)
+        f.write("\n")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='periscope: simulate amplicon reads with a known sgRNA truth')
+    parser.add_argument('--output-prefix', dest='output_prefix', help='prefix of the output files', required=True)
+    parser.add_argument('--reads', help='number of reads (ONT) or read pairs (illumina)', type=int, default=10000)
+    parser.add_argument('--technology', help='the sequencing technology to simulate', choices=['ont', 'illumina'], default='ont')
+    parser.add_argument('--artic-primers', dest='artic_primers', help='bundled artic primer scheme', default='V3')
+    parser.add_argument('--primer-bed', dest='primer_bed', help='custom primer bed file, overrides --artic-primers', default=None)
+    parser.add_argument('--resources', help='the periscope resources directory', default=None)
+    parser.add_argument('--seed', help='random seed', type=int, default=1)
+    parser.add_argument('--read-length', dest='read_length', help='illumina read length', type=int, default=150)
+    parser.add_argument('--error-rate', dest='error_rate', help='substitution rate outside the leader', type=float, default=0.0)
+    parser.add_argument('--sgrna-fraction', dest='sgrna_fraction', help='fraction of canonical sgRNA reads', type=float, default=0.1)
+    parser.add_argument('--novel-fraction', dest='novel_fraction', help='fraction of non-canonical sgRNA reads', type=float, default=0.01)
+    parser.add_argument('--novel-sites', dest='novel_sites', help='number of non-canonical junctions', type=int, default=5)
+    parser.add_argument('--threads', help='threads used to sort the bam', type=int, default=1)
+
+    args = parser.parse_args()
+    summary = simulate(args.output_prefix, args.reads, technology=args.technology, primer_bed=args.primer_bed,
+                       artic_primers=args.artic_primers, resources=args.resources, seed=args.seed,
+                       read_length=args.read_length, error_rate=args.error_rate, sgrna_fraction=args.sgrna_fraction,
+                       novel_fraction=args.novel_fraction, novel_sites=args.novel_sites, threads=args.threads)
+    print("{} records written to {}.bam".format(summary["records"], args.output_prefix), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
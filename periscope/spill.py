@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# bounded memory (--max-memory) for very deep samples
+#
+# the budget is shared between the workers and the parent. Every process is given an equal share, less the memory a
+# python process with pysam loaded takes, and the chunks are made small enough that a worker's per-read state fits in
+# its share. The ont classifier only keeps counts per amplicon and ORF, its memory does not grow with the reads. The
+# illumina classifier pairs mates by read name, the parent collects the classified reads of every chunk in
+# SpilledReads, which writes them to disk as a sorted, gzip compressed run whenever they exceed the parent's share:
+#
+#   <OUTPUT_PREFIX>_spill_00000_temp.tsv.gz   read name, position, leader found, ORF and amplicon, sorted by read name
+#
+# the runs are merged by read name at the end, so the pairs are read back one at a time. How much was spilled is
+# reported in the run metrics ("memory").
+import gzip
+import heapq
+import itertools
+import os
+
+# rough bytes of per-read state held while classifying, measured with tracemalloc on python 3.11, the ont workers
+# only keep counts
+read_bytes = dict(ont=0, illumina=500)
+# bytes of a row of the columnar reads table, held per chunk by the ont workers with --columnar
+feature_bytes = 600
+# resident memory of a worker or the parent before it holds any reads (python, pysam and the parsed resources)
+process_bytes = 100 * 2 ** 20
+# the smallest chunk the budget is allowed to make
+min_chunk_reads = 1000
+
+
+def memory_plan(max_memory, workers, chunk_reads, technology, columnar=None):
+    """
+    share a memory budget between the workers and the parent
+
+    :param max_memory: the budget in bytes, for the whole run
+    :param workers: number of worker processes
+    :param chunk_reads: the reads per chunk asked for
+    :param technology: ont or illumina
+    :param columnar: the ont workers also hold their chunk's read features with --columnar
+    :return: dictionary with the "chunk_reads" to use and the "parent_bytes" of reads the parent may hold before
+    spilling
+    """
+    share = max_memory // (int(workers) + 1) - process_bytes
+    if share <= 0:
+        raise ValueError("--max-memory {} is too small for {} workers, give at least {} bytes".format(
+            max_memory, workers, (int(workers) + 1) * (process_bytes + min_chunk_reads * feature_bytes)))
+    per_read = read_bytes[technology] + (feature_bytes if columnar and technology == "ont" else 0)
+    if per_read:
+        chunk_reads = min(chunk_reads, max(min_chunk_reads, share // per_read))
+    return dict(max_memory=max_memory, chunk_reads=chunk_reads, parent_bytes=share)
+
+
+class SpilledReads():
+    """
+    the classified illumina reads of every chunk by read name, spilled to sorted runs on disk past a budget
+
+        reads = SpilledReads(output_prefix, budget)
+        for chunk_reads in processed:
+            reads.add(chunk_reads)
+        for name, pair in reads.pairs():
+            ...
+        reads.cleanup()
+
+    pairs() gives the reads of a name in the order they were added. Without spilling the names come in the order they
+    were first added, after a spill they come sorted by name.
+    """
+    def __init__(self, output_prefix, max_bytes=None, bytes_per_read=read_bytes["illumina"]):
+        self.output_prefix = output_prefix
+        self.max_bytes = max_bytes
+        self.bytes_per_read = bytes_per_read
+        self.reads = {}
+        self.held = 0
+        self.runs = []
+        self.spilled_reads = 0
+        self.spilled_bytes = 0
+        self.names = None
+
+    def add(self, reads):
+        """
+        :param reads: dictionary of read name to the list of its ClassifiedReads, from one chunk
+        """
+        for name, classified in reads.items():
+            if name in self.reads:
+                self.reads[name] = self.reads[name] + classified
+            else:
+                self.reads[name] = classified
+            self.held += len(classified)
+        if self.max_bytes is not None and self.held * self.bytes_per_read > self.max_bytes:
+            self.spill()
+
+    def spill(self):
+        # the reads held so far as a sorted run, stable so the reads of a name keep their order
+        run = "{}_spill_{:05}_temp.tsv.gz".format(self.output_prefix, len(self.runs))
+        with gzip.open(run, "wt", compresslevel=1) as f:
+            for name in sorted(self.reads):
+                for classified in self.reads[name]:
+                    # the 3' mates were not searched, their leader, ORF and amplicon are empty
+                    f.write("{}\t{}\t{}\t{}\t{}\n".format(name, classified.pos,
+                                                          "" if classified.sgRNA is None else int(bool(classified.sgRNA)),
+                                                          "" if classified.orf is None else classified.orf,
+                                                          "" if classified.amplicon is None else classified.amplicon))
+        self.runs.append(run)
+        self.spilled_reads += self.held
+        self.spilled_bytes += os.path.getsize(run)
+        self.reads = {}
+        self.held = 0
+        self.names = None
+
+    def __len__(self):
+        # the number of read names, after a spill counted by the last full merge (or by merging)
+        if not self.runs:
+            return len(self.reads)
+        if self.names is None:
+            for _ in self.merged():
+                pass
+        return self.names
+
+    def pairs(self):
+        """
+        :return: iterator of (read name, list of its ClassifiedReads), every name once
+        """
+        if not self.runs:
+            return iter(self.reads.items())
+        return self.merged()
+
+    def merged(self):
+        from periscope.scripts.search_for_sgRNA_illumina import ClassifiedRead
+
+        def read_run(run):
+            with gzip.open(run, "rt") as f:
+                for line in f:
+                    name, pos, sgRNA, orf, amplicon = line.rstrip("\n").split("\t")
+                    yield name, ClassifiedRead(sgRNA=sgRNA == "1" if sgRNA else None, orf=orf or None, pos=int(pos),
+                                               amplicon=int(amplicon) if amplicon else None)
+
+        def held():
+            for name in sorted(self.reads):
+                for classified in self.reads[name]:
+                    yield name, classified
+
+        # heapq.merge takes equal names from the earlier runs first, the reads of a name stay in the order added
+        merged = heapq.merge(*[read_run(run) for run in self.runs] + [held()], key=lambda item: item[0])
+        names = 0
+        for name, group in itertools.groupby(merged, key=lambda item: item[0]):
+            names += 1
+            yield name, [classified for _, classified in group]
+        self.names = names
+
+    def metrics(self):
+        return dict(spilled_reads=self.spilled_reads, spilled_bytes=self.spilled_bytes, spill_runs=len(self.runs))
+
+    def cleanup(self):
+        for run in self.runs:
+            if os.path.exists(run):
+                os.remove(run)
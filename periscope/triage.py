@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# triage mode (--target-precision): count a random sample of the reads, stopping once the estimates are precise enough
+#
+# the bam is sorted, so a chunk of it (a virtual offset range, periscope.chunks) holds the reads of a few hundred bases
+# of the genome and the sgRNA reads of an ORF, which all start at the same place, sit in one or two chunks. Counting a
+# random set of chunks would sample the ORFs in clumps. Instead the reads are split into rounds, random subsamples
+# picked by a hash of the read name (so mates stay together), and the rounds are counted one after the other. The
+# chunking pass writes the reads of every round to a bam of its own as it reads the input (bucket_rounds), so every
+# region of the input is decompressed once rather than once per round, and each round is chunked while it is written.
+# After each round the reads counted so far are a uniform random sample of the bam.
+#
+# at the end of every round the parent turns the counts into binomial proportions for every canonical ORF, sgRNA reads
+# out of the reads counted (what sgRPHT scales) and sgRNA reads out of the sgRNA and gRNA reads of the amplicons at the
+# ORF (what sgRPTg scales), and works out their Wilson score intervals. The run stops once every estimate is settled, or
+# the rounds run out. The same rule settles an estimate whatever its number of successes: its interval is within
+# --target-precision of the estimate (0.05 is +/-5%), or the whole interval is below default_floor, a proportion too
+# rare to need a precise ratio. An ORF with no sgRNA reads or one with a handful is settled by the floor, while the
+# amplicons at an ORF have no reads it isn't settled.
+#
+# the counts CSVs then describe the sample, the ratios (sgRPTg, sgRPHT) estimate those of the whole bam. The achieved
+# intervals and the fraction of reads counted are written to <OUTPUT_PREFIX>_periscope_precision.csv and to the
+# "triage" section of the metrics.
+import concurrent.futures
+import math
+import os
+import zlib
+
+# the sample grows in steps of 1/default_rounds of the reads
+default_rounds = 20
+
+# 95% intervals
+default_z = 1.96
+
+# an estimate whose whole interval is below this proportion is settled however wide the interval is relative to it
+default_floor = 0.05
+
+precision_header = ["sample", "kind", "name", "successes", "trials", "ratio", "lower", "upper", "precision",
+                    "converged", "fraction_processed"]
+
+
+def read_round(query_name, rounds):
+    """
+    :param query_name: the read name
+    :param rounds: number of rounds
+    :return: the round the read (and its mate) is counted in
+    """
+    return zlib.crc32(query_name.encode()) % rounds
+
+
+def wilson_interval(successes, trials, z=default_z):
+    """
+    :param successes: number of reads with the property
+    :param trials: number of reads
+    :param z: normal quantile of the interval
+    :return: (lower, upper) Wilson score interval of the proportion, (0, 1) with no reads
+    """
+    if trials == 0:
+        return 0.0, 1.0
+    p = successes / trials
+    denominator = 1 + z * z / trials
+    centre = (p + z * z / (2 * trials)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / denominator
+    return max(0.0, centre - half_width), min(1.0, centre + half_width)
+
+
+def precision(successes, trials, z=default_z):
+    """
+    :return: half the width of the interval relative to the estimate, infinite until there is a success
+    """
+    if successes == 0:
+        return math.inf
+    lower, upper = wilson_interval(successes, trials, z)
+    return (upper - lower) / 2 / (successes / trials)
+
+
+def converged(successes, trials, target, z=default_z, floor=default_floor):
+    """
+    :param target: the relative precision the estimate needs
+    :param floor: the proportion the whole interval can be below instead
+    :return: whether the interval is within the target precision of the estimate or entirely below the floor, never
+    with no reads
+    """
+    if trials == 0:
+        return False
+    return precision(successes, trials, z) <= target or wilson_interval(successes, trials, z)[1] < floor
+
+
+def intervals(proportions, target, z=default_z, floor=default_floor):
+    """
+    :param proportions: dictionary of (kind, name) to (successes, trials)
+    :param target: the relative precision every estimate needs
+    :param floor: the proportion an estimate's whole interval can be below instead
+    :return: list of dictionaries, one per estimate, keyed as precision_header
+    """
+    rows = []
+    for (kind, name), (successes, trials) in sorted(proportions.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+        lower, upper = wilson_interval(successes, trials, z)
+        rows.append(dict(kind=kind, name=name, successes=successes, trials=trials,
+                         ratio=successes / trials if trials else 0.0, lower=lower, upper=upper,
+                         precision=precision(successes, trials, z),
+                         converged=converged(successes, trials, target, z, floor)))
+    return rows
+
+
+def round_bams(output_prefix, rounds=default_rounds):
+    # the reads of every round, written by bucket_rounds and removed once the run is done
+    return ["{}_round_{:02}_periscope_temp.bam".format(output_prefix, round_number) for round_number in range(rounds)]
+
+
+def bucket_rounds(bam, bams, chunk_reads, reference=None, threads=1, totals=None):
+    """
+    the chunking pass of triage mode, one pass over the bam writes every read to the bam of its round and records the
+    chunk boundaries of each round bam as it is written. The round bams are compressed at level 1, they are only read
+    once
+
+    :param bam: the input bam (or cram)
+    :param bams: the round bams to write, from round_bams
+    :param chunk_reads: number of reads per chunk
+    :param reference: the reference fasta, for a cram
+    :param threads: pysam decompression threads
+    :param totals: optional dictionary, "mapped_reads" is set to the mapped reads of the whole file as in
+    periscope.chunks.make_chunks
+    :return: list of rounds, each a list of (start, end, reads) chunks of its bam, every round has a chunk even if it
+    has no reads
+    """
+    from periscope.alignments import open_alignments
+    from periscope.chunks import unmapped_flags
+
+    chunk_reads = max(1, int(chunk_reads))
+    rounds = len(bams)
+    chunks = [[] for _ in bams]
+    mapped = 0
+    with open_alignments(bam, reference=reference, threads=threads) as inbamfile:
+        outputs = [open_alignments(path, "w", header=inbamfile.header, compression=1) for path in bams]
+        finished = False
+        try:
+            starts = [output.tell() for output in outputs]
+            reads = [0] * rounds
+            for read in inbamfile:
+                if inbamfile.is_cram and read.reference_id < 0:
+                    # the unplaced reads at the end of a cram, left out of its chunks as in make_chunks
+                    break
+                if not read.flag & unmapped_flags:
+                    mapped += 1
+                round_number = read_round(read.query_name, rounds)
+                output = outputs[round_number]
+                # the boundary is taken before the next read is written, where a worker seeks to
+                if reads[round_number] == chunk_reads:
+                    end = output.tell()
+                    chunks[round_number].append((starts[round_number], end, reads[round_number]))
+                    starts[round_number] = end
+                    reads[round_number] = 0
+                output.write(read)
+                reads[round_number] += 1
+            for round_number in range(rounds):
+                if reads[round_number] or not chunks[round_number]:
+                    chunks[round_number].append((starts[round_number], None, reads[round_number]))
+            finished = True
+        finally:
+            for output in outputs:
+                output.close()
+            if not finished:
+                remove_round_bams(bams)
+    if totals is not None:
+        totals["mapped_reads"] = mapped
+    return chunks
+
+
+def remove_round_bams(bams):
+    for path in bams:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def triage_tasks(bams, args, chunks):
+    """
+    the worker tasks of every round, numbered across the rounds
+
+    :param bams: the round bams
+    :param args: the arguments namespace handed to the workers
+    :param chunks: the chunks of every round bam from bucket_rounds
+    :return: list of rounds, each a list of [bam, args, task, chunk] worker tasks
+    """
+    rounds = []
+    task = 0
+    for bam, round_chunks in zip(bams, chunks):
+        rounds.append([])
+        for chunk in round_chunks:
+            rounds[-1].append([bam, args, task, chunk])
+            task += 1
+    return rounds
+
+
+def adaptive_map(func, rounds, workers, estimate, target, initializer=None, initargs=(), executor=None, z=default_z,
+                 consume=None):
+    """
+    run func over the tasks round by round until the estimates reach the target precision
+
+    the next round is started while the last tasks of a round are still running so no worker waits, when the estimates
+    converge the tasks of the unfinished round are dropped, part of a round is not a random sample
+
+    :param func: the worker, called with one task
+    :param rounds: list of rounds, each a list of tasks
+    :param workers: number of worker processes, when no executor is given
+    :param estimate: called with the results of the finished rounds as each round finishes, returns a dictionary of
+    (kind, name) to (successes, trials)
+    :param target: relative precision every estimate needs, e.g. 0.05
+    :param initializer: process pool initializer
+    :param initargs: initializer arguments
+    :param executor: optional concurrent.futures executor
+    :param z: normal quantile of the intervals
+    :param consume: optional function the results of a round are passed to once it is finished and estimated, what it
+    returns is kept in their place, so only the rounds still running are held
+    :return: (list of the results of the finished rounds in task order, number of finished rounds, the interval rows)
+    """
+    consume = consume or (lambda result: result)
+    tasks = [(round_number, index, task) for round_number, round_tasks in enumerate(rounds)
+             for index, task in enumerate(round_tasks)]
+    remaining = [len(round_tasks) for round_tasks in rounds]
+    results = [[None] * len(round_tasks) for round_tasks in rounds]
+    # enough tasks in flight to keep every worker busy
+    in_flight = max(1, int(workers)) * 2
+
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor(int(workers), initializer=initializer, initargs=initargs)
+
+    finished_rounds = 0
+    rows = intervals(estimate([]), target, z)
+    try:
+        pending = {}
+        position = 0
+        stop = False
+        while pending or (position < len(tasks) and not stop):
+            while position < len(tasks) and len(pending) < in_flight and not stop:
+                round_number, index, task = tasks[position]
+                pending[executor.submit(func, task)] = (round_number, index)
+                position += 1
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                round_number, index = pending.pop(future)
+                results[round_number][index] = future.result()
+                remaining[round_number] -= 1
+            # check the estimates once per finished round, in round order
+            while not stop and finished_rounds < len(rounds) and remaining[finished_rounds] == 0:
+                finished_rounds += 1
+                finished = [result for round_results in results[:finished_rounds] for result in round_results]
+                rows = intervals(estimate(finished), target, z)
+                results[finished_rounds - 1] = [consume(result) for result in results[finished_rounds - 1]]
+                stop = bool(rows) and all(row["converged"] for row in rows)
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return [result for round_results in results[:finished_rounds] for result in round_results], finished_rounds, rows
+
+
+def write_precision(outfile, rows, sample, fraction_processed):
+    """
+    write the achieved intervals
+    :param outfile: <OUTPUT_PREFIX>_periscope_precision.csv
+    :param rows: the interval rows from adaptive_map
+    :param sample: the sample id written in the first column
+    :param fraction_processed: fraction of the reads that were counted
+    :return: the rows written (one dictionary per row, keyed on the header)
+    """
+    written = []
+    with open(outfile, "w") as f:
+        f.write(",".join(precision_header) + "\n")
+        for row in rows:
+            row = dict(row, sample=sample, fraction_processed=fraction_processed)
+            written.append(row)
+            f.write(",".join(str(row[column]) for column in precision_header) + "\n")
+    return written
+
+
+def report(args, rounds, finished_rounds, reads_processed, rows, metrics):
+    """
+    write the achieved intervals and add the triage section to the metrics
+
+    :param args: the arguments namespace, uses output_prefix, sample and target_precision
+    :param rounds: number of rounds
+    :param finished_rounds: number of rounds counted
+    :param reads_processed: reads classified in the finished rounds
+    :param rows: the interval rows from adaptive_map
+    :param metrics: the run metrics
+    :return: the fraction of the reads counted and the rows written
+    """
+    fraction = finished_rounds / rounds if rounds else 1.0
+
+    outfile = args.output_prefix + "_periscope_precision.csv"
+    with metrics.stage("precision_writing", outputs=[outfile]) as stage:
+        written = write_precision(outfile, rows, args.sample, fraction)
+        stage["records"] = len(written)
+    metrics.extra["triage"] = dict(target_precision=float(args.target_precision), fraction_processed=fraction,
+                                   reads_processed=reads_processed, rounds=rounds, rounds_processed=finished_rounds,
+                                   estimates=len(rows), converged=sum(1 for row in rows if row["converged"]),
+                                   precision=outfile)
+    return fraction, written
@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+# a work queue on shared storage, for plates bigger than one node, no network service needed
+#
+# the coordinator writes each task as a file in a queue directory every node can see, `periscope worker` processes
+# on any number of nodes claim a task by creating its lease file, run it and publish the result as another file:
+#
+#   <QUEUE>/tasks/<TASK>.task            the pickled function and its arguments
+#   <QUEUE>/leases/<TASK>.<ATTEMPT>      created exclusively by the worker that claims the attempt, its modification
+#                                        time is the worker's heartbeat
+#   <QUEUE>/results/<TASK>.result        the pickled return value, or the exception raised
+#   <QUEUE>/stop                         workers exit once this exists
+#
+# files are written under a temporary name and renamed into place, so a reader never sees half a file. A lease whose
+# heartbeat is older than the lease time has expired (its worker died or lost the storage), the next worker claims the
+# task again as the next attempt, exclusive creation of the attempt's lease means only one of them gets it. A task
+# whose workers keep dying is failed after max_attempts. The nodes' clocks must agree to well within the lease time.
+#
+# two ways to use it, both with periscope.run:
+#
+#   shards    QueueExecutor is a concurrent.futures executor, given as run(executor=...) the chunks of a sample are
+#             classified by the workers and the classifier merges their partial counts in the coordinator as it does
+#             with a local process pool. The output prefix (the per-chunk temporary files) must be on the shared storage
+#   samples   distribute() runs every sample of a sample sheet as one task, reduce_samples() merges the tables of the
+#             samples into the plate's
+#
+# the tasks are pickles, only share the queue directory with people you trust.
+import argparse
+import concurrent.futures
+import csv
+import glob
+import os
+import pickle
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+# seconds without a heartbeat before a lease expires, the heartbeat is sent four times in that
+default_lease_seconds = 120
+# attempts at a task before it is failed
+default_max_attempts = 3
+# seconds between scans of the queue directory, by the workers and the coordinator
+default_poll_seconds = 0.5
+
+
+class TaskFailed(Exception):
+    """
+    a task raised an exception that could not be sent back, or was abandoned by max_attempts workers
+    """
+
+
+def write_atomic(path, data):
+    # write under a temporary name in the same directory and rename it into place
+    temp = "{}.{}.{}.tmp".format(path, socket.gethostname(), os.getpid())
+    with open(temp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class Lease():
+    """
+    a claimed attempt at a task, heartbeat() keeps it from expiring
+    """
+    def __init__(self, queue, task_id, attempt):
+        self.queue = queue
+        self.task_id = task_id
+        self.attempt = attempt
+        self.path = queue.lease_path(task_id, attempt)
+
+    def heartbeat(self):
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            pass
+
+    def lost(self):
+        # another worker took the task over after this lease expired
+        return self.queue.attempts(self.task_id) > self.attempt + 1
+
+
+class WorkQueue():
+    """
+    the task, lease and result files of a queue directory
+
+    :param directory: the queue directory, on storage shared by the coordinator and every worker
+    :param lease_seconds: seconds without a heartbeat before a lease expires
+    :param max_attempts: attempts at a task before it is failed
+    """
+    def __init__(self, directory, lease_seconds=default_lease_seconds, max_attempts=default_max_attempts):
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        for name in ["tasks", "leases", "results"]:
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def task_path(self, task_id):
+        return os.path.join(self.directory, "tasks", task_id + ".task")
+
+    def lease_path(self, task_id, attempt):
+        return os.path.join(self.directory, "leases", "{}.{}".format(task_id, attempt))
+
+    def result_path(self, task_id):
+        return os.path.join(self.directory, "results", task_id + ".result")
+
+    def submit(self, func, args=(), kwargs=None):
+        """
+        :return: the task id, tasks are claimed in the order of their ids
+        """
+        task_id = "{:013d}-{}".format(int(time.time() * 1000), uuid.uuid4().hex[:12])
+        write_atomic(self.task_path(task_id), pickle.dumps((func, tuple(args), kwargs or {})))
+        return task_id
+
+    def attempts(self, task_id):
+        return len(glob.glob(glob.escape(self.lease_path(task_id, "")) + "*"))
+
+    def claim(self):
+        """
+        claim the oldest task nobody holds a live lease on
+
+        :return: (Lease, function, args, kwargs), None when there is nothing to do
+        """
+        tasks = sorted(name[:-len(".task")] for name in os.listdir(os.path.join(self.directory, "tasks"))
+                       if name.endswith(".task"))
+        if not tasks:
+            return None
+        leases = {}
+        for name in os.listdir(os.path.join(self.directory, "leases")):
+            task_id, _, attempt = name.rpartition(".")
+            if attempt.isdigit():
+                leases[task_id] = max(leases.get(task_id, -1), int(attempt))
+        for task_id in tasks:
+            if os.path.exists(self.result_path(task_id)):
+                continue
+            attempt = leases.get(task_id, -1) + 1
+            if attempt:
+                try:
+                    heartbeat = os.path.getmtime(self.lease_path(task_id, attempt - 1))
+                except FileNotFoundError:
+                    continue
+                if time.time() - heartbeat < self.lease_seconds:
+                    continue
+                if attempt >= self.max_attempts:
+                    self.publish(task_id, TaskFailed("task {} was abandoned by {} workers, the last heartbeat was at {}"
+                                                     .format(task_id, attempt, time.ctime(heartbeat))), failed=True)
+                    continue
+            try:
+                fd = os.open(self.lease_path(task_id, attempt), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                # another worker claimed it first
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write("{} {}\n".format(socket.gethostname(), os.getpid()))
+            try:
+                with open(self.task_path(task_id), "rb") as f:
+                    func, args, kwargs = pickle.load(f)
+            except FileNotFoundError:
+                # cancelled by the coordinator
+                remove(self.lease_path(task_id, attempt))
+                continue
+            except Exception as e:
+                # e.g. its function is not importable here
+                self.publish(task_id, TaskFailed("task {} can't be read: {}".format(task_id, e)), failed=True)
+                continue
+            return Lease(self, task_id, attempt), func, args, kwargs
+        return None
+
+    def publish(self, task_id, value, failed=False):
+        """
+        :param value: what the task returned, or the exception it raised when failed
+        """
+        if not os.path.exists(self.task_path(task_id)):
+            # cancelled, nobody is waiting for it
+            return
+        try:
+            data = pickle.dumps((failed, value))
+        except Exception:
+            data = pickle.dumps((True, TaskFailed("".join(traceback.format_exception_only(type(value), value))
+                                                  if failed else "the result of task {} can't be pickled".format(task_id))))
+        write_atomic(self.result_path(task_id), data)
+
+    def result(self, task_id):
+        """
+        :return: (failed, value) once the task is done, otherwise None
+        """
+        try:
+            with open(self.result_path(task_id), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def remove(self, task_id):
+        # the task, its leases and its result
+        remove(self.task_path(task_id))
+        for lease in glob.glob(glob.escape(self.lease_path(task_id, "")) + "*"):
+            remove(lease)
+        remove(self.result_path(task_id))
+
+    def stop(self):
+        # ask the workers to exit once they are done with their task
+        write_atomic(os.path.join(self.directory, "stop"), b"")
+
+    def stopped(self):
+        return os.path.exists(os.path.join(self.directory, "stop"))
+
+
+class QueueExecutor(concurrent.futures.Executor):
+    """
+    a concurrent.futures executor whose tasks are run by `periscope worker` processes on any node that sees the queue
+    directory
+
+        with QueueExecutor("/shared/queue") as executor:
+            result = periscope.run(bam=bam, output_prefix="/shared/out/sample", executor=executor)
+
+    :param directory: the queue directory
+    :param poll_seconds: seconds between checks for finished tasks
+    :param lease_seconds: seconds without a heartbeat before a lease expires
+    :param max_attempts: attempts at a task before it is failed
+    """
+    def __init__(self, directory, poll_seconds=default_poll_seconds, lease_seconds=default_lease_seconds,
+                 max_attempts=default_max_attempts):
+        self.queue = WorkQueue(directory, lease_seconds, max_attempts)
+        self.poll_seconds = poll_seconds
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.poller = None
+
+    def submit(self, fn, *args, **kwargs):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("cannot submit to a QueueExecutor after shutdown")
+            future = concurrent.futures.Future()
+            self.pending[self.queue.submit(fn, args, kwargs)] = future
+            if self.poller is None:
+                self.poller = threading.Thread(target=self.poll, daemon=True)
+                self.poller.start()
+        return future
+
+    def poll(self):
+        while True:
+            with self.lock:
+                if self.closed and not self.pending:
+                    return
+                pending = list(self.pending.items())
+            for task_id, future in pending:
+                if future.cancelled():
+                    outcome = None
+                else:
+                    outcome = self.queue.result(task_id)
+                    if outcome is None:
+                        continue
+                with self.lock:
+                    del self.pending[task_id]
+                self.queue.remove(task_id)
+                if outcome is not None and future.set_running_or_notify_cancel():
+                    failed, value = outcome
+                    if failed:
+                        future.set_exception(value)
+                    else:
+                        future.set_result(value)
+            time.sleep(self.poll_seconds)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        with self.lock:
+            self.closed = True
+            if cancel_futures:
+                for future in self.pending.values():
+                    future.cancel()
+            poller = self.poller
+        if wait and poller is not None:
+            poller.join()
+
+
+def work(directory, lease_seconds=default_lease_seconds, max_attempts=default_max_attempts, idle_exit=None,
+         max_tasks=None, poll_seconds=default_poll_seconds):
+    """
+    claim and run tasks until the queue is stopped
+
+    :param directory: the queue directory
+    :param lease_seconds: seconds without a heartbeat before a lease expires
+    :param max_attempts: attempts at a task before it is failed
+    :param idle_exit: exit after this many seconds without a task, never when None
+    :param max_tasks: exit after running this many tasks, never when None
+    :param poll_seconds: seconds between scans of the queue directory when it is empty
+    :return: the number of tasks run
+    """
+    queue = WorkQueue(directory, lease_seconds, max_attempts)
+    worker = "{}:{}".format(socket.gethostname(), os.getpid())
+    done = 0
+    idle_since = time.time()
+    while not queue.stopped() and (max_tasks is None or done < max_tasks):
+        claimed = queue.claim()
+        if claimed is None:
+            if idle_exit is not None and time.time() - idle_since > idle_exit:
+                break
+            time.sleep(poll_seconds)
+            continue
+        lease, func, args, kwargs = claimed
+
+        # the heartbeat is sent from a thread, so a long task keeps its lease
+        finished = threading.Event()
+
+        def heartbeat():
+            while not finished.wait(lease_seconds / 4):
+                lease.heartbeat()
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+
+        print("{}: running task {} (attempt {})".format(worker, lease.task_id, lease.attempt + 1), file=sys.stderr, flush=True)
+        start = time.time()
+        try:
+            value, failed = func(*args, **kwargs), False
+        except Exception as e:
+            value, failed = e, True
+            traceback.print_exc()
+        finally:
+            finished.set()
+            beat.join()
+        if lease.lost():
+            print("{}: the lease of task {} expired while it ran, its result is dropped".format(worker, lease.task_id),
+                  file=sys.stderr, flush=True)
+        else:
+            queue.publish(lease.task_id, value, failed)
+        if not os.path.exists(queue.task_path(lease.task_id)):
+            # cancelled while it ran
+            remove(lease.path)
+        print("{}: task {} {} in {:.1f}s".format(worker, lease.task_id, "failed" if failed else "done",
+                                                time.time() - start), file=sys.stderr, flush=True)
+        done += 1
+        idle_since = time.time()
+    return done
+
+
+def run_sample(options):
+    # a sample task, periscope.run in the worker with its own process pool
+    from periscope.runner import run
+    return run(**options)
+
+
+def read_sample_sheet(sample_sheet):
+    """
+    the samples of a plate, a CSV with a header of periscope.run arguments, e.g.
+
+        sample,bam,technology,artic_primers
+        S1,/shared/S1.bam,ont,V3
+
+    fastq takes several files separated by spaces, empty cells are left out
+
+    :param sample_sheet: the CSV
+    :return: list of dictionaries of the run arguments of each sample
+    """
+    samples = []
+    with open(sample_sheet, newline="") as f:
+        for row in csv.DictReader(f):
+            options = {key: value for key, value in row.items() if value not in (None, "")}
+            if "fastq" in options:
+                options["fastq"] = options["fastq"].split()
+            if "artic_primers" in options and " " in options["artic_primers"]:
+                options["artic_primers"] = options["artic_primers"].split()
+            samples.append(options)
+    return samples
+
+
+def reduce_samples(results, output_prefix):
+    """
+    merge the tables of the samples of a plate into <OUTPUT_PREFIX>_periscope_counts.csv, _novel_counts.csv and
+    _amplicons.csv
+
+    :param results: the PeriscopeResults of the samples
+    :param output_prefix: prefix of the plate's tables
+    :return: dictionary of the paths written
+    """
+    outputs = {}
+    for table in ["counts", "novel_counts", "amplicons"]:
+        rows = [row for result in results for row in getattr(result, table)]
+        header = []
+        for row in rows:
+            header += [column for column in row if column not in header]
+        outputs[table] = "{}_periscope_{}.csv".format(output_prefix, table)
+        with open(outputs[table], "w", newline="") as f:
+            writer = csv.DictWriter(f, header, restval="NA")
+            writer.writeheader()
+            writer.writerows(rows)
+    return outputs
+
+
+def distribute(samples, directory, output_prefix, shards=False, lease_seconds=default_lease_seconds,
+               max_attempts=default_max_attempts, **options):
+    """
+    run the samples of a plate on the workers of a queue and merge their tables
+
+    :param samples: list of dictionaries of periscope.run arguments, one per sample (read_sample_sheet)
+    :param directory: the queue directory
+    :param output_prefix: prefix of the plate's tables, the samples are written to <OUTPUT_PREFIX>_<SAMPLE> unless
+    they give their own output_prefix
+    :param shards: run the samples one at a time here and hand their chunks to the workers, rather than a sample per
+    task
+    :param lease_seconds: seconds without a heartbeat before a lease expires
+    :param max_attempts: attempts at a task before it is failed
+    :param options: periscope.run arguments for every sample, the sample sheet takes precedence
+    :return: (list of PeriscopeResults in sample order, dictionary of the plate's tables)
+    """
+    # a stop left by the last plate
+    remove(os.path.join(directory, "stop"))
+    runs = []
+    for sample in samples:
+        run_options = dict(options, **sample)
+        run_options.setdefault("output_prefix", "{}_{}".format(output_prefix, run_options.get("sample", len(runs))))
+        runs.append(run_options)
+
+    with QueueExecutor(directory, lease_seconds=lease_seconds, max_attempts=max_attempts) as executor:
+        if shards:
+            from periscope.runner import run
+            results = [run(executor=executor, **run_options) for run_options in runs]
+        else:
+            results = list(executor.map(run_sample, runs))
+    return results, reduce_samples(results, output_prefix)
+
+
+def get_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='periscope: claim and run the tasks of a work queue on shared storage')
+    parser.add_argument('--queue', help='the queue directory, shared with the coordinator', required=True)
+    parser.add_argument('--processes', help='worker processes to start (1)', type=int, default=1)
+    parser.add_argument('--lease-seconds', dest='lease_seconds', help='seconds without a heartbeat before a lease expires ({})'.format(default_lease_seconds), type=float, default=default_lease_seconds)
+    parser.add_argument('--max-attempts', dest='max_attempts', help='attempts at a task before it is failed ({})'.format(default_max_attempts), type=int, default=default_max_attempts)
+    parser.add_argument('--idle-exit', dest='idle_exit', help='exit after this many seconds without a task (never)', type=float, default=None)
+    parser.add_argument('--max-tasks', dest='max_tasks', help='exit after this many tasks (never)', type=int, default=None)
+    return parser
+
+
+def get_distribute_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='periscope: run the samples of a plate on the workers of a work queue and merge their tables')
+    parser.add_argument('--queue', help='the queue directory, shared with the workers', required=True)
+    parser.add_argument('--samples', help='sample sheet, a CSV with a header of run options (sample, bam or fastq or fastq_dir, technology, artic_primers...)', required=True)
+    parser.add_argument('--output-prefix', dest='output_prefix', help='prefix of the merged tables, and of the samples without an output_prefix', required=True)
+    parser.add_argument('--shards', help='run the samples here one at a time and hand their chunks to the workers', action='store_true')
+    parser.add_argument('--technology', help='technology of the samples without one (ont)', default='ont')
+    parser.add_argument('--artic-primers', dest='artic_primers', help='artic primer version of the samples without one (V1)', default='V1')
+    parser.add_argument('-t', '--threads', dest='threads', help='sgRNA counting processes of each sample task (1)', type=int, default=1)
+    parser.add_argument('--chunk-reads', dest='chunk_reads', help='reads per chunk (50000)', type=int, default=50000)
+    parser.add_argument('--lease-seconds', dest='lease_seconds', help='seconds without a heartbeat before a lease expires ({})'.format(default_lease_seconds), type=float, default=default_lease_seconds)
+    parser.add_argument('--max-attempts', dest='max_attempts', help='attempts at a task before it is failed ({})'.format(default_max_attempts), type=int, default=default_max_attempts)
+    parser.add_argument('--stop-workers', dest='stop_workers', help='ask the workers to exit once the plate is done', action='store_true')
+    return parser
+
+
+def main(args):
+    options = (args.queue, args.lease_seconds, args.max_attempts, args.idle_exit, args.max_tasks)
+    if args.processes <= 1:
+        work(*options)
+        return 0
+    import multiprocessing
+    processes = [multiprocessing.Process(target=work, args=options) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return 0 if all(process.exitcode == 0 for process in processes) else 1
+
+
+def distribute_main(args):
+    samples = read_sample_sheet(args.samples)
+    try:
+        _, outputs = distribute(samples, args.queue, args.output_prefix, args.shards, args.lease_seconds,
+                                      args.max_attempts, technology=args.technology, artic_primers=args.artic_primers,
+                                      threads=args.threads, chunk_reads=args.chunk_reads)
+    finally:
+        if args.stop_workers:
+            WorkQueue(args.queue).stop()
+    for path in outputs.values():
+        print(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(get_parser().parse_args()))
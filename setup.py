@@ -4,14 +4,14 @@ from periscope import __version__, _program
 setup(
     name='periscope',
     version=__version__,
-    packages=['periscope'],
+    packages=['periscope', 'periscope.scripts'],
     scripts=['periscope/scripts/Snakefile',
              'periscope/scripts/search_for_sgRNA_ont.py',
              'periscope/scripts/search_for_sgRNA_illumina.py',
              'periscope/scripts/variant_expression.py'
              ],
     package_dir={'periscope': 'periscope'},
-    package_data={'periscope':['resources/*']},
+    package_data={'periscope':['resources/*', 'resources/schemes/*'], 'periscope.scripts':['Snakefile']},
     url='',
     license='',
     author='Matthew Parker',
@@ -0,0 +1,43 @@
+# the simulated sample most tests count, and the run arguments they share
+
+import pytest
+
+import periscope
+from periscope.simulate import simulate
+
+
+class Simulated():
+    """
+    a simulated sample, <prefix>.bam and the truth simulate returned for it
+    """
+    def __init__(self, prefix, technology, truth):
+        self.prefix = prefix
+        self.bam = prefix + ".bam"
+        self.technology = technology
+        self.truth = truth
+
+    def run(self, name, **options):
+        """
+        count the sample with the V3 primers on two threads
+        :param name: appended to the prefix for the output prefix
+        :param options: periscope.run arguments, override the shared ones
+        :return: the PeriscopeResult
+        """
+        arguments = dict(bam=self.bam, technology=self.technology, output_prefix=self.prefix + "_" + name,
+                         artic_primers="V3", threads=2)
+        arguments.update(options)
+        return periscope.run(**arguments)
+
+
+@pytest.fixture
+def simulated(tmp_path):
+    """
+    :return: a function simulating a sample in tmp_path, called with the number of reads, the technology and any other
+    simulate options (seed 1 and an sgRNA fraction of 0.2 unless given), name is the file prefix in tmp_path. It returns
+    a Simulated
+    """
+    def simulated_sample(reads, technology, name="sim", seed=1, sgrna_fraction=0.2, **options):
+        prefix = str(tmp_path / name)
+        truth = simulate(prefix, reads, technology=technology, seed=seed, sgrna_fraction=sgrna_fraction, **options)
+        return Simulated(prefix, technology, truth)
+    return simulated_sample
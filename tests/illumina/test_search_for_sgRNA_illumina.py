@@ -15,7 +15,7 @@
 # TODO - I need some reads supporting 7a
 
 # Import all the methods we need
-from periscope.scripts.search_for_sgRNA_illumina import get_mapped_reads, check_start, open_bed, supplementary_method, extact_soft_clipped_bases
+from periscope.scripts.search_for_sgRNA_illumina import get_mapped_reads, check_start, open_bed, supplementary_method, extact_soft_clipped_bases, leader_junction
 
 # this is the truth for these reads
 
@@ -205,6 +205,26 @@ def test_supplementary_method():
         # print(read.get_tags())
         print(supplementary_method(read))
 
+def test_leader_junction():
+    # bwa split these reads into the leader and the body, the junction is the same whatever the split
+    junctions = {
+        'NB500959:197:H75W3AFX2:1:21312:23610:4695': dict(leader_end=75, body_start=27394),
+        'NB500959:197:H75W3AFX2:4:11403:13826:18844': dict(leader_end=75, body_start=27394),
+        'NB500959:197:H75W3AFX2:4:11507:13616:10003': dict(leader_end=75, body_start=27394),
+        'NB500959:197:H75W3AFX2:2:11204:7045:4512': dict(leader_end=75, body_start=28266),
+        'NB500959:197:H75W3AFX2:4:11602:22252:8721': dict(leader_end=75, body_start=28266)
+    }
+    inbamfile = pysam.AlignmentFile(reads_file, "rb")
+    for read in inbamfile:
+        if read.is_supplementary or read.is_secondary:
+            continue
+        junction = leader_junction(read)
+        if junction is not None:
+            assert junction == junctions.pop(read.query_name)
+            # the supplementary alignment agrees with the soft clip alignment
+            assert extact_soft_clipped_bases(read)
+    assert junctions == {}
+
 def test_extact_soft_clipped_bases():
     inbamfile = pysam.AlignmentFile(reads_file, "rb")
     result = {}
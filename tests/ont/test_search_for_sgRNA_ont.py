@@ -30,7 +30,7 @@
 # TODO - I need some reads supporting 7a
 
 # Import all the methods we need
-from periscope.scripts.search_for_sgRNA_ont import search_reads, classify_read, find_amplicon, get_mapped_reads, check_start, open_bed, calculate_normalised_counts, setup_counts
+from periscope.scripts.search_for_sgRNA_ont import search_reads, classify_read, find_amplicon, get_mapped_reads, check_start, open_bed, calculate_normalised_counts, setup_counts, leader_score_needed
 
 # this is the truth for these reads
 
@@ -261,6 +261,46 @@ def test_classify_read():
         assert result == truth[read.query_name]["class"]
 
 
+def test_leader_score_skipped():
+    # reads whose class can't depend on the leader score are classified without searching for it
+    inbamfile = pysam.AlignmentFile(reads_file, "rb")
+
+    filename = os.path.join(dirname, "../../periscope/resources/artic_primers_V3.bed")
+    primer_bed_object = read_bed_file(filename)
+
+    filename = os.path.join(dirname, "../../periscope/resources/orf_start.bed")
+    bed_object = open_bed(filename)
+
+    skipped = []
+    for read in inbamfile:
+        amplicons = find_amplicon(read, primer_bed_object)
+        orf = check_start(bed_object, read)
+        if not leader_score_needed(read, orf, amplicons):
+            skipped.append(read.query_name)
+            assert classify_read(read, None, 50, orf, amplicons) == truth[read.query_name]["class"]
+    assert "53619614-d945-4c47-88f0-119852dc80fe" in skipped
+    assert "76aaf579-4754-4bbe-b001-4ac2d6f76533" in skipped
+
+
+def test_leader_window():
+    # the leader junction is at the 5' end, searching the leading soft clip and 40 bases after it classifies every
+    # read as the whole read search does
+    inbamfile = pysam.AlignmentFile(reads_file, "rb")
+
+    filename = os.path.join(dirname, "../../periscope/resources/artic_primers_V3.bed")
+    primer_bed_object = read_bed_file(filename)
+
+    filename = os.path.join(dirname, "../../periscope/resources/orf_start.bed")
+    bed_object = open_bed(filename)
+
+    search = 'AACCAACTTTCGATCTCTTGTAGATCTGTTCT'
+    for read in inbamfile:
+        amplicons = find_amplicon(read, primer_bed_object)
+        orf = check_start(bed_object, read)
+        result = search_reads(read, search, 40)
+        assert classify_read(read, result["align_score"], 50, orf, amplicons) == truth[read.query_name]["class"]
+
+
 def test_pybedtools():
     import pybedtools
     read_feature = pybedtools.BedTool("MN908947.3" + "\t" + str(0) + "\t" + str(0),from_string=True)
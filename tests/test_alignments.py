@@ -0,0 +1,69 @@
+
+# crams are read through coordinate chunks and count the same as the bam they were made from, the chunking pass
+# counts the mapped reads as flagstat does
+
+import pysam
+
+from periscope.alignments import default_reference, open_alignments
+from periscope.chunks import chunk_reads, make_chunks
+from periscope.scripts.search_for_sgRNA_ont import get_mapped_reads
+from periscope.simulate import simulate
+
+
+def to_cram(bam):
+    cram = bam[:-len(".bam")] + ".cram"
+    pysam.view("-C", "-T", default_reference(), "-o", cram, bam, catch_stdout=False)
+    pysam.index(cram)
+    return cram
+
+
+def chunked_names(bam, size):
+    names = []
+    with open_alignments(bam) as f:
+        for chunk in make_chunks(bam, size):
+            names.append([read.query_name for read in chunk_reads(f, chunk)])
+    return names
+
+
+def test_cram_chunks(tmp_path):
+    prefix = str(tmp_path / "sim")
+    simulate(prefix, 1000, technology="illumina", seed=3)
+    cram = to_cram(prefix + ".bam")
+
+    expected = [name for chunk in chunked_names(prefix + ".bam", 10 ** 6) for name in chunk]
+    chunks = chunked_names(cram, 97)
+    assert len(chunks) > 10
+    assert [name for chunk in chunks for name in chunk] == expected
+
+
+def test_cram_counts(simulated):
+    for technology in ["ont", "illumina"]:
+        sample = simulated(1000, technology, name=technology)
+        cram = to_cram(sample.bam)
+
+        from_bam = sample.run("bam", chunk_reads=200)
+        from_cram = sample.run("cram", bam=cram, chunk_reads=200, output_format="cram", io_threads=2)
+
+        assert from_cram.counts == from_bam.counts
+        assert from_cram.novel_counts == from_bam.novel_counts
+        assert from_cram.metrics["mapped_reads"] == from_bam.metrics["mapped_reads"]
+
+
+def test_chunking_mapped_reads(tmp_path):
+    prefix = str(tmp_path / "sim")
+    simulate(prefix, 1000, technology="ont", seed=5)
+    # secondary, supplementary, QC failed and unmapped records, which flagstat counts differently
+    flagged = str(tmp_path / "flagged.bam")
+    with pysam.AlignmentFile(prefix + ".bam") as f, pysam.AlignmentFile(flagged, "wb", template=f) as out:
+        for i, read in enumerate(f):
+            read.flag |= [0, 0x100, 0x800, 0x200, 0][i % 5]
+            if i % 50 == 0:
+                read.flag |= 0x4
+            out.write(read)
+    pysam.index(flagged)
+
+    for bam in [flagged, to_cram(flagged)]:
+        totals = {}
+        make_chunks(bam, 97, totals=totals)
+        assert totals["mapped_reads"] == get_mapped_reads(bam)
+        assert 600 < totals["mapped_reads"] < 1000
@@ -0,0 +1,87 @@
+
+# a run with the same inputs and settings is served from the result cache, the least recently used entries are evicted
+
+import os
+import pysam
+
+import periscope
+from periscope.cache import ResultCache, parse_size
+
+dirname = os.path.dirname(__file__)
+reads_file = os.path.join(dirname, "illumina", "reads.sam")
+
+
+def test_run_cache(tmp_path):
+    bam = str(tmp_path / "reads.bam")
+    pysam.sort("-o", bam, reads_file)
+    pysam.index(bam)
+    cache_dir = str(tmp_path / "cache")
+
+    first = periscope.run(bam=bam, technology="illumina", output_prefix=str(tmp_path / "first"), sample="TEST", cache_dir=cache_dir)
+    second = periscope.run(bam=bam, technology="illumina", output_prefix=str(tmp_path / "second"), sample="TEST", cache_dir=cache_dir)
+    assert first.metrics["cache"]["hit"] is None
+    assert second.metrics["cache"]["hit"] == "results"
+    assert second.counts == first.counts
+    assert second.metrics["mapped_reads"] == first.metrics["mapped_reads"]
+    assert not [stage for stage in second.metrics["stages"] if stage["name"] == "classification"]
+    with open(first.outputs["counts"]) as f, open(second.outputs["counts"]) as g:
+        assert f.read() == g.read()
+
+    # the sample id is in every row, the same bam under another sample is counted again
+    renamed = periscope.run(bam=bam, technology="illumina", output_prefix=str(tmp_path / "renamed"), sample="OTHER", cache_dir=cache_dir)
+    assert renamed.metrics["cache"]["hit"] is None
+    assert {row["sample"] for row in renamed.counts} == {"OTHER"}
+    with open(renamed.outputs["counts"]) as f:
+        assert all(line.startswith("OTHER,") for line in f.readlines()[1:])
+    assert periscope.run(bam=bam, technology="illumina", output_prefix=str(tmp_path / "again"), sample="TEST",
+                         cache_dir=cache_dir).metrics["cache"]["hit"] == "results"
+
+    # a different score cutoff is a different result
+    other = periscope.run(bam=bam, technology="illumina", output_prefix=str(tmp_path / "other"), sample="TEST", score_cutoff=40, cache_dir=cache_dir)
+    assert other.metrics["cache"]["hit"] is None
+
+
+def test_cache_tagged_bam(tmp_path, simulated):
+    sample = simulated(1000, "ont")
+    cache_dir = str(tmp_path / "cache")
+
+    def run(name, **options):
+        return sample.run(name, chunk_reads=300, cache_dir=cache_dir, **options)
+
+    first = run("first")
+    second = run("second")
+    # the tagged bam is restored with the tables
+    assert second.metrics["cache"]["hit"] == "results"
+    assert second.outputs["tagged_bam"] == sample.prefix + "_second_periscope.bam"
+    with open(first.outputs["tagged_bam"], "rb") as f, open(second.outputs["tagged_bam"], "rb") as g:
+        assert f.read() == g.read()
+
+    # another policy writes another tagged bam
+    none = run("none", tagged_bam="none")
+    assert none.metrics["cache"]["hit"] is None and "tagged_bam" not in none.outputs
+
+    # the settings of the tagged bam are part of the key, a change is not ignored
+    sgrna = run("sgrna", tagged_bam="sgrna", grna_subsample=0.1)
+    assert sgrna.metrics["cache"]["hit"] is None
+    assert run("subsample", tagged_bam="sgrna", grna_subsample=0.5).metrics["cache"]["hit"] is None
+    assert run("compression", tagged_bam="sgrna", grna_subsample=0.1, bam_compression=1).metrics["cache"]["hit"] is None
+    assert run("sgrna_again", tagged_bam="sgrna", grna_subsample=0.1).metrics["cache"]["hit"] == "results"
+
+
+def test_cache_eviction(tmp_path):
+    outputs = {}
+    for name in ["a", "b", "c"]:
+        outputs[name] = str(tmp_path / (name + "_periscope_counts.csv"))
+        with open(outputs[name], "w") as f:
+            f.write("x" * 1000)
+
+    cache = ResultCache(str(tmp_path / "cache"), parse_size("2.5K"))
+    cache.put("results", "a", str(tmp_path / "a"), dict(counts=outputs["a"]))
+    cache.put("results", "b", str(tmp_path / "b"), dict(counts=outputs["b"]))
+    # b was last used long ago, a is used again
+    os.utime(os.path.join(cache.path("results", "b"), "entry.json"), (0, 0))
+    assert cache.restore("results", "a", str(tmp_path / "restored"))
+    cache.put("results", "c", str(tmp_path / "c"), dict(counts=outputs["c"]))
+
+    assert cache.get("results", "b") is None
+    assert cache.get("results", "a") and cache.get("results", "c")
@@ -0,0 +1,59 @@
+
+# the cohort store: ingesting a sample twice replaces its rows, the queries give the matrix and the recurrence
+
+import csv
+
+from periscope import cohort
+
+counts_header = ["sample", "mapped_reads", "gRNA_count", "orf", "sgRNA_count", "coverage", "sgRPTL", "sgRPHT"]
+novel_header = ["sample", "mapped_reads", "orf", "sgRNA_count", "coverage", "sgRPTL", "sgRPHT"]
+
+
+def write_sample(prefix, sample, sgrna, novel):
+    # illumina style counts, sgrna is the sgRNA_count of each ORF and novel of each novel junction
+    with open(prefix + "_periscope_counts.csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(counts_header)
+        for orf, count in sgrna.items():
+            writer.writerow([sample, 100000, 10, orf, count, 1000, count, count])
+    with open(prefix + "_periscope_novel_counts.csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(novel_header)
+        for orf, count in novel.items():
+            writer.writerow([sample, 100000, orf, count, 1000, "NA", count])
+
+
+def test_cohort(tmp_path):
+    database = str(tmp_path / "cohort.sqlite")
+    a = str(tmp_path / "a")
+    b = str(tmp_path / "b")
+    write_sample(a, "A", {"S": 5, "N": 50}, {"novel_100": 3, "novel_200": 1})
+    write_sample(b, "B", {"S": 7, "N": 70, "M": 1}, {"novel_100": 2})
+
+    connection = cohort.connect(database)
+    cohort.ingest(connection, a, run_date="2021-01-02")
+    cohort.ingest(connection, b, run_date="2021-01-01")
+    rows = connection.execute("select count(*) from counts").fetchone()[0]
+    # the same sample again replaces its rows
+    cohort.ingest(connection, a, run_date="2021-01-02")
+    assert connection.execute("select count(*) from counts").fetchone()[0] == rows
+    connection.close()
+
+    connection = cohort.connect(database)
+    orfs, samples, values = cohort.orf_matrix(connection, "sgRPHT")
+    assert orfs == ["S", "N", "M"]
+    assert samples == ["B", "A"]
+    assert values[("N", "A")] == 50 and values[("M", "B")] == 1 and ("M", "A") not in values
+    orfs, samples, values = cohort.orf_matrix(connection, "sgRPTL", novel=True, since="2021-01-02")
+    assert samples == ["A"] and orfs == ["novel_100", "novel_200"] and values[("novel_100", "A")] is None
+
+    recurrence = cohort.novel_recurrence(connection)
+    assert [(row["orf"], row["samples"], row["reads"]) for row in recurrence] == [("novel_100", 2, 5), ("novel_200", 1, 1)]
+    assert [row["orf"] for row in cohort.novel_recurrence(connection, min_samples=2)] == ["novel_100"]
+
+    # a rerun of A that lost a junction
+    write_sample(a, "A", {"S": 5, "N": 50}, {"novel_100": 3})
+    cohort.ingest(connection, a, run_date="2021-01-03")
+    assert [row["orf"] for row in cohort.novel_recurrence(connection)] == ["novel_100"]
+    assert connection.execute("select run_date from samples where sample = 'A'").fetchone()[0] == "2021-01-03"
+    connection.close()
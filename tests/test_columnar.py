@@ -0,0 +1,43 @@
+
+# the columnar tables follow their declared schema, with nulls for NA and the rows of the CSVs
+
+import pytest
+
+from periscope.columnar import schema_version, schemas, typed_columns
+
+
+def test_typed_columns():
+    rows = [dict(sample="S", amplicon="71", mapped_reads=1000, orf="N", quality="HQ", gRNA_count=0, gRPTH=0,
+                 sgRNA_count=3, sgRPHT=300.0, sgRPTg="NA")]
+    columns = typed_columns(rows, "ont", "amplicons")
+    assert list(columns) == [column for column, _ in schemas[("ont", "amplicons")]]
+    assert columns["amplicon"] == [71]
+    assert columns["gRPTH"] == [0.0] and isinstance(columns["gRPTH"][0], float)
+    assert columns["sgRPTg"] == [None]
+
+
+@pytest.mark.parametrize("technology,columnar", [("ont", "parquet"), ("illumina", "arrow")])
+def test_columnar_outputs(simulated, technology, columnar):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    result = simulated(1000, technology).run("out", chunk_reads=300, columnar=columnar)
+
+    def read(file):
+        if columnar == "parquet":
+            return pyarrow.parquet.read_table(file)
+        with pyarrow.memory_map(file) as source:
+            return pyarrow.ipc.open_file(source).read_all()
+
+    for table, rows in [("counts", result.counts), ("novel_counts", result.novel_counts)]:
+        written = read(result.outputs["columnar_" + table])
+        assert written.schema.metadata[b"periscope.schema_version"] == str(schema_version).encode()
+        assert written.column_names == [column for column, _ in schemas[(technology, table)]]
+        assert written.to_pylist() == [dict(zip(written.column_names, values))
+                                       for values in zip(*typed_columns(rows, technology, table).values())]
+
+    reads = read(result.outputs["columnar_reads"])
+    classified = sum(stage["records"] for stage in result.metrics["stages"] if stage["name"] == "classification")
+    assert reads.num_rows == classified
+    assert reads.column("sample").to_pylist() == ["SAMPLE"] * reads.num_rows
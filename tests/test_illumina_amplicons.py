@@ -0,0 +1,31 @@
+
+# the illumina pairs are assigned to an amplicon in the classification pass, by their outer coordinates
+
+import csv
+
+import pytest
+
+
+def test_illumina_amplicons(simulated):
+    sample = simulated(3000, "illumina", seed=3)
+    result = sample.run("out", chunk_reads=500, columnar="parquet")
+
+    pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+    reads = pyarrow.parquet.read_table(result.outputs["columnar_reads"]).to_pydict()
+    assigned = dict(zip(reads["read_id"], reads["pair_amplicon"]))
+    with open(sample.prefix + "_truth.tsv") as f:
+        truth = {row["read_id"]: int(row["amplicon"]) for row in csv.DictReader(f, delimiter="\t")}
+    correct = sum(assigned[read_id] == amplicon for read_id, amplicon in truth.items() if read_id in assigned)
+    assert correct / len(assigned) > 0.99
+
+    # the sgRNA pairs of every ORF are split between its amplicons
+    per_orf = {}
+    for row in result.amplicons:
+        per_orf[row["orf"]] = per_orf.get(row["orf"], 0) + row["sgRNA_count"]
+        assert row["sgRPTg"] == row["sgRNA_count"] / (row["gRNA_count"] / 1000)
+    assert {row["orf"]: row["sgRNA_count"] for row in result.counts + result.novel_counts} == per_orf
+
+    with open(result.outputs["amplicons"]) as f:
+        assert len(list(csv.DictReader(f))) == len(result.amplicons)
+    assert pyarrow.parquet.read_table(result.outputs["columnar_amplicons"]).num_rows == len(result.amplicons)
@@ -0,0 +1,94 @@
+
+# the cached aligner indexes are keyed on the reference and settings, the shipped bwa index is only used when it matches
+
+import os
+import shutil
+
+import pytest
+
+from periscope import indexes
+from periscope.indexes import bwa_extensions, bwa_index, file_checksum, minimap2_index, write_manifest
+
+dirname = os.path.dirname(__file__)
+resources = os.path.join(dirname, "..", "periscope", "resources")
+reference = os.path.join(resources, "nCoV-2019.reference.fasta")
+
+
+def test_shipped_bwa_index(tmp_path):
+    assert bwa_index(reference, str(tmp_path), build=False) == reference
+
+    # a reference that no longer matches its index files gets one in the cache
+    edited = str(tmp_path / "nCoV-2019.reference.fasta")
+    for extension in ["", ".amb", ".ann", ".bwt", ".pac", ".sa"]:
+        shutil.copy(reference + extension, edited + extension)
+    with open(edited, "a") as f:
+        f.write("ACGT\n")
+    assert bwa_index(edited, str(tmp_path / "cache"), build=False).startswith(str(tmp_path / "cache"))
+
+
+def copy_reference(reference, copy, extensions):
+    for extension in [""] + ["." + extension for extension in extensions]:
+        shutil.copy(reference + extension, copy + extension)
+
+
+def edit_base(fasta, position):
+    # change one base of a single sequence fasta, the names and lengths stay the same
+    with open(fasta) as f:
+        lines = f.readlines()
+    sequence = list("".join(line.strip() for line in lines[1:]))
+    sequence[position] = "C" if sequence[position] != "C" else "G"
+    with open(fasta, "w") as f:
+        f.write(lines[0] + "".join(sequence) + "\n")
+
+
+def test_bwa_index_same_length_edit(tmp_path):
+    edited = str(tmp_path / "nCoV-2019.reference.fasta")
+    copy_reference(reference, edited, bwa_extensions)
+    assert bwa_index(edited, str(tmp_path / "cache"), build=False) == edited
+    edit_base(edited, 1000)
+    assert bwa_index(edited, str(tmp_path / "cache"), build=False).startswith(str(tmp_path / "cache"))
+
+
+class Rebuilt(Exception):
+    pass
+
+
+def test_bwa_cached_index(tmp_path, monkeypatch):
+    def rebuild(*args, **kwargs):
+        raise Rebuilt()
+    monkeypatch.setattr(indexes.subprocess, "run", rebuild)
+
+    # a copy of the reference without its index, the cached index with a matching manifest is used
+    cache = str(tmp_path / "cache")
+    copy = str(tmp_path / "copy.fasta")
+    shutil.copy(reference, copy)
+    prefix = bwa_index(copy, cache, build=False)
+    os.makedirs(cache)
+    for extension in bwa_extensions:
+        shutil.copy(reference + "." + extension, prefix + "." + extension)
+    write_manifest(prefix + ".json", dict(reference="copy.fasta", reference_sha256=file_checksum(copy)))
+    assert bwa_index(copy, cache) == prefix
+
+    # a cached index whose sequence isn't the reference's is built again, even with a matching manifest
+    edited = str(tmp_path / "edited.fasta")
+    shutil.copy(reference, edited)
+    edit_base(edited, 1000)
+    stale = bwa_index(edited, cache, build=False)
+    for extension in bwa_extensions:
+        shutil.copy(reference + "." + extension, stale + "." + extension)
+    write_manifest(stale + ".json", dict(reference="edited.fasta", reference_sha256=file_checksum(edited)))
+    with pytest.raises(Rebuilt):
+        bwa_index(edited, cache)
+
+
+def test_minimap2_index_key(tmp_path):
+    cache = str(tmp_path / "cache")
+    index = minimap2_index(reference, cache, build=False)
+    assert index.endswith(".k15.mmi")
+    assert minimap2_index(reference, cache, kmer=19, build=False).endswith(".k19.mmi")
+
+    edited = str(tmp_path / "nCoV-2019.reference.fasta")
+    shutil.copy(reference, edited)
+    with open(edited, "a") as f:
+        f.write("ACGT\n")
+    assert minimap2_index(edited, cache, build=False) != index
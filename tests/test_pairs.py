@@ -0,0 +1,94 @@
+
+# the illumina workers only search the 5' mate of a pair for the leader, the pairs are classified as if both were
+
+import os
+
+import pysam
+import pytest
+
+from periscope.chunks import make_chunks
+from periscope.scripts import search_for_sgRNA_illumina as illumina
+from periscope.simulate import simulate
+
+dirname = os.path.dirname(__file__)
+resources = os.path.join(dirname, "..", "periscope", "resources")
+
+
+class Args():
+    orf_bed = os.path.join(resources, "orf_start.bed")
+
+
+def both_mates(bam, orf_bed):
+    # every mate searched and assigned an ORF, as the workers used to
+    reads = {}
+    with pysam.AlignmentFile(bam) as f:
+        for read in f:
+            if read.seq is None or read.is_unmapped or read.is_supplementary or read.is_secondary:
+                continue
+            sgRNA = illumina.extact_soft_clipped_bases(read)
+            orf = illumina.check_start(read, sgRNA, orf_bed)
+            reads.setdefault(read.query_name, []).append(illumina.ClassifiedRead(sgRNA=sgRNA, orf=orf, read=read))
+    return reads
+
+
+def pair_classes(reads):
+    classes = {}
+    for name, pair in reads.items():
+        left_read = min(pair, key=lambda x: x.pos)
+        classes[name] = (left_read.orf, left_read.sgRNA)
+    return classes
+
+
+@pytest.mark.parametrize("source", ["simulated", "real"])
+def test_pair_classes_unchanged(tmp_path, source):
+    bam = str(tmp_path / "reads.bam")
+    if source == "simulated":
+        simulate(str(tmp_path / "reads"), 2000, technology="illumina", seed=4, error_rate=0.01, sgrna_fraction=0.3)
+    else:
+        pysam.sort("-o", bam, os.path.join(dirname, "illumina", "reads.sam"))
+        pysam.index(bam)
+
+    orf_bed = illumina.load_resources(Args)["orf_bed"]
+    reads = {}
+    worker_paths = {}
+    for task, chunk in enumerate(make_chunks(bam, 300)):
+        chunk_reads, worker = illumina.process_reads([bam, Args, task, chunk])
+        for name, classified in chunk_reads.items():
+            reads[name] = reads.get(name, []) + classified
+        for path, count in worker["leader_paths"].items():
+            worker_paths[path] = worker_paths.get(path, 0) + count
+
+    expected = both_mates(bam, orf_bed)
+    assert pair_classes(reads) == pair_classes(expected)
+    assert illumina.process_pairs(reads) == illumina.process_pairs(expected)
+    # about half the reads were not searched
+    assert worker_paths["mate"] > 0.4 * sum(worker_paths.values())
+
+
+def test_lone_mates(tmp_path):
+    # a subsetted bam, every fifth pair has lost its 5' mate
+    simulate(str(tmp_path / "reads"), 1000, technology="illumina", seed=5, sgrna_fraction=0.3)
+    bam = str(tmp_path / "lone.bam")
+    dropped = set()
+    with pysam.AlignmentFile(str(tmp_path / "reads.bam")) as f, pysam.AlignmentFile(bam, "wb", template=f) as out:
+        for read in f:
+            if int(read.query_name.split("_")[1]) % 5 == 0 and illumina.five_prime_mate(read):
+                dropped.add(read.query_name)
+                continue
+            out.write(read)
+    pysam.index(bam)
+
+    reads = {}
+    for task, chunk in enumerate(make_chunks(bam, 300)):
+        for name, classified in illumina.process_reads([bam, Args, task, chunk])[0].items():
+            reads[name] = reads.get(name, []) + classified
+    assert all(reads[name][0].sgRNA is None for name in dropped)
+
+    # the pairs are classified by the mate present, as when every read was searched
+    expected = both_mates(bam, illumina.load_resources(Args)["orf_bed"])
+    with pysam.AlignmentFile(bam) as inbamfile:
+        search = illumina.LoneMateSearch(inbamfile, illumina.load_resources(Args))
+        assert illumina.process_pairs(reads, search_mate=search) == illumina.process_pairs(expected)
+        assert {name for name, _ in search.searched} == dropped
+        searched = {name: search.pair(name, pair) for name, pair in reads.items()}
+    assert pair_classes(searched) == pair_classes(expected)
@@ -0,0 +1,48 @@
+
+# the plan samples the input and splits the cores and the memory budget between the stages
+
+import pytest
+
+from periscope.plan import plan
+from periscope.simulate import simulate
+from periscope.spill import process_bytes
+
+
+def test_plan_bam(tmp_path):
+    prefix = str(tmp_path / "sim")
+    simulate(prefix, 2000, technology="ont", seed=1, sgrna_fraction=0.2)
+
+    planned = plan("ont", bam=prefix + ".bam", cores=4, chunk_reads=300, artic_primers="V3", sample_reads=500)
+    assert planned["input"]["reads"] == 2000 and 500 <= planned["input"]["sampled_reads"] < 1000
+    assert planned["input"]["classify_seconds"] > 0
+    assert 0.1 < planned["input"]["leader_hit_rate"] < 0.4
+    assert planned["allocation"]["threads"] == 4 and planned["allocation"]["mapping_threads"] is None
+    assert [stage["name"] for stage in planned["stages"]] == ["chunking", "classification"]
+
+    # no more workers than chunks
+    assert plan("ont", bam=prefix + ".bam", cores=4, chunk_reads=1000, artic_primers="V3")["allocation"]["threads"] == 2
+    # and as many as the memory budget gives a share
+    budget = 3 * (process_bytes + 10 ** 6)
+    assert plan("ont", bam=prefix + ".bam", cores=4, chunk_reads=300, max_memory=budget,
+                artic_primers="V3")["allocation"]["threads"] == 2
+    with pytest.raises(ValueError):
+        plan("ont", bam=prefix + ".bam", cores=4, max_memory=process_bytes, artic_primers="V3")
+
+
+def test_plan_fastq(tmp_path):
+    prefix = str(tmp_path / "sim")
+    simulate(prefix, 3000, technology="illumina", seed=1)
+
+    planned = plan("illumina", fastq=[prefix + "_R1.fastq", prefix + "_R2.fastq"], cores=8, sample_reads=200)
+    assert 5400 < planned["input"]["reads"] < 6600
+    assert planned["input"]["mean_read_length"] == 150
+    assert planned["allocation"]["mapping_threads"] == 7
+    assert planned["peak_memory_bytes"] == max(stage["peak_memory_bytes"] for stage in planned["stages"])
+
+
+def test_run_cores(simulated):
+    sample = simulated(1000, "ont", seed=2)
+    threads = sample.run("threads", chunk_reads=200)
+    cores = sample.run("cores", chunk_reads=200, cores=3)
+    assert cores.metrics["plan"]["allocation"]["threads"] == 3
+    assert cores.counts == threads.counts
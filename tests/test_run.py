@@ -0,0 +1,145 @@
+
+# the in-process api, run on the illumina test reads with a caller supplied executor
+
+import json
+import os
+import pstats
+import pytest
+import pysam
+from concurrent.futures import ThreadPoolExecutor
+
+import periscope
+from periscope.simulate import simulate
+
+dirname = os.path.dirname(__file__)
+reads_file = os.path.join(dirname, "illumina", "reads.sam")
+
+truth = {
+    "ORF7a": 4,
+    "N": 2
+}
+
+
+def test_run_illumina(tmp_path):
+    bam = str(tmp_path / "reads.bam")
+    pysam.sort("-o", bam, reads_file)
+    pysam.index(bam)
+
+    output_prefix = str(tmp_path / "test")
+    with ThreadPoolExecutor(2) as executor:
+        result = periscope.run(bam=bam, technology="illumina", output_prefix=output_prefix, sample="TEST", threads=3, executor=executor)
+
+    assert result.metrics["mapped_reads"] == 35
+    assert {row["orf"]: row["sgRNA_count"] for row in result.counts} == truth
+
+    # the structured result matches what was written to disk
+    for table in ["counts", "novel_counts", "amplicons"]:
+        assert os.path.exists(result.outputs[table])
+    with open(result.outputs["counts"]) as f:
+        assert len(f.readlines()) == len(result.counts) + 1
+
+
+def test_run_chunks(tmp_path):
+    bam = str(tmp_path / "reads.bam")
+    pysam.sort("-o", bam, reads_file)
+    pysam.index(bam)
+
+    # with tiny chunks mates land in different chunks, they are still paired up and the counts don't change
+    for chunk_reads in [1, 7, 50000]:
+        result = periscope.run(bam=bam, technology="illumina", output_prefix=str(tmp_path / "test_{}".format(chunk_reads)), sample="TEST", threads=3, chunk_reads=chunk_reads)
+        assert {row["orf"]: row["sgRNA_count"] for row in result.counts} == truth
+        assert [row["sgRNA_count"] for row in result.novel_counts] == []
+
+
+def test_run_metrics(tmp_path):
+    bam = str(tmp_path / "reads.bam")
+    pysam.sort("-o", bam, reads_file)
+    pysam.index(bam)
+
+    output_prefix = str(tmp_path / "test")
+    with ThreadPoolExecutor(2) as executor:
+        result = periscope.run(bam=bam, technology="illumina", output_prefix=output_prefix, sample="TEST", threads=2, executor=executor, chunk_reads=10)
+
+    with open(result.outputs["metrics"]) as f:
+        metrics = json.load(f)
+
+    stages = {stage["name"]: stage for stage in metrics["stages"]}
+    for name in ["chunking", "classification", "csv_writing"]:
+        assert stages[name]["wall_seconds"] >= 0
+        assert stages[name]["cpu_seconds"] >= 0
+    assert stages["chunking"]["bytes_read"] == os.path.getsize(bam)
+    # the mapped reads are counted while chunking, not by another pass over the bam
+    assert "flagstat" not in stages
+    assert stages["csv_writing"]["bytes_written"] > 0
+
+    # one entry per chunk, every read is accounted for once
+    assert len(metrics["workers"]) == -(-stages["chunking"]["records"] // 10)
+    assert sorted(worker["chunk"] for worker in metrics["workers"]) == list(range(len(metrics["workers"])))
+    assert sum(worker["reads"] for worker in metrics["workers"]) == stages["classification"]["records"]
+    for worker in metrics["workers"]:
+        assert "alignment" in worker["time_split"]
+
+
+def test_run_progress_textfile(tmp_path):
+    bam = str(tmp_path / "reads.bam")
+    pysam.sort("-o", bam, reads_file)
+    pysam.index(bam)
+
+    # the default process pool, the workers count into shared memory the parent reads
+    textfile = str(tmp_path / "periscope.prom")
+    result = periscope.run(bam=bam, technology="illumina", output_prefix=str(tmp_path / "test"), sample="TEST", threads=2, chunk_reads=10, progress_textfile=textfile, progress_interval=0.05)
+
+    samples = {}
+    with open(textfile) as f:
+        for line in f:
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+
+    reads = [stage for stage in result.metrics["stages"] if stage["name"] == "classification"][0]["records"]
+    assert samples['periscope_reads_processed_total{sample="TEST",technology="illumina"}'] == reads
+    assert samples['periscope_done{sample="TEST",technology="illumina"}'] == 1
+    assert samples['periscope_eta_seconds{sample="TEST",technology="illumina"}'] == 0
+    by_class = sum(value for name, value in samples.items() if name.startswith("periscope_reads_by_class_total"))
+    alignments = sum(value for name, value in samples.items() if name.startswith("periscope_alignments_total"))
+    assert by_class == alignments == reads
+
+
+def test_run_profile(tmp_path):
+    # enough reads for the workers to be sampled, the test reads take them less than a sampling interval
+    simulate(str(tmp_path / "reads"), 1000, technology="illumina", seed=1)
+    bam = str(tmp_path / "reads.bam")
+
+    output_prefix = str(tmp_path / "test")
+    result = periscope.run(bam=bam, technology="illumina", output_prefix=output_prefix, sample="TEST", threads=2, profile="all")
+
+    # one merged collapsed stack file with the parent and the workers, and one pstats dump
+    with open(result.outputs["profile_collapsed"]) as f:
+        roots = {line.split(";")[0] for line in f}
+    assert roots == {"parent", "worker"}
+    stats = pstats.Stats(result.outputs["profile_pstats"])
+    assert any(function[2] == "extact_soft_clipped_bases" for function in stats.stats)
+
+    # the per process profiles are merged away
+    assert sorted(file for file in os.listdir(str(tmp_path)) if "_profile" in file) == ["test_periscope_profile.collapsed", "test_periscope_profile.pstats"]
+
+
+def test_stage_peak_rss(tmp_path):
+    from periscope.metrics import Metrics, reset_peak_rss
+    if not reset_peak_rss():
+        pytest.skip("the rss high-water mark can't be reset here")
+
+    metrics = Metrics(str(tmp_path / "test"))
+    with metrics.stage("outer") as outer:
+        with metrics.stage("heavy"):
+            block = bytearray(200 * 1024 * 1024)
+            block[::4096] = b"x" * len(block[::4096])
+            del block
+        with metrics.stage("light"):
+            pass
+    stages = {stage["name"]: stage for stage in metrics.stages}
+
+    # a stage after the heavy one doesn't inherit its peak, the stage enclosing both does
+    assert stages["heavy"]["peak_rss_bytes"] - stages["light"]["peak_rss_bytes"] > 150 * 1024 * 1024
+    assert outer["peak_rss_bytes"] >= stages["heavy"]["peak_rss_bytes"]
+    assert stages["light"]["peak_rss_children_bytes"] is None
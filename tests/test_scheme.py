@@ -0,0 +1,89 @@
+
+# the compiled primer schemes give the same primers as artic's bed parsing and find_primer
+
+import os
+
+import pytest
+
+from periscope.periscope import primer_versions
+from periscope.scheme import Scheme, bundled_scheme, compile_scheme, read_primers, resolve_scheme, scheme_sources
+
+dirname = os.path.dirname(__file__)
+resources = os.path.join(dirname, "..", "periscope", "resources")
+reference = os.path.join(resources, "nCoV-2019.reference.fasta")
+orf_bed = os.path.join(resources, "orf_start.bed")
+
+
+def beds(version):
+    return os.path.join(resources, "artic_amplicons_{}.bed".format(version)), os.path.join(resources, "artic_primers_{}.bed".format(version))
+
+
+def nearest(primers, position, direction):
+    # artic's find_primer: the closest primer by start (LEFT) or end (RIGHT), the first in the bed on a tie
+    key = "start" if direction == "+" else "end"
+    candidates = [primer for primer in primers if primer["direction"] == direction]
+    primer = min(candidates, key=lambda primer: abs(primer[key] - position))
+    return abs(primer[key] - position), primer[key] - position, primer
+
+
+@pytest.mark.parametrize("version", primer_versions)
+def test_bundled_scheme(version):
+    amplicon_bed, primer_bed = beds(version)
+    scheme = Scheme(bundled_scheme(version, resources))
+    # the shipped bundle was compiled from the shipped beds
+    assert scheme.metadata["sources"] == scheme_sources(amplicon_bed, primer_bed, orf_bed)
+
+    primers = read_primers(primer_bed)
+    assert scheme.primers == primers
+    for position in range(0, scheme.genome_length + 50, 7):
+        for direction in ["+", "-"]:
+            assert scheme.find_primer(position, direction) == nearest(primers, position, direction)
+
+
+def test_artic_equivalence():
+    vcftagprimersites = pytest.importorskip("artic.vcftagprimersites")
+    from artic.align_trim import find_primer
+
+    amplicon_bed, primer_bed = beds("V4.1")
+    scheme = Scheme(bundled_scheme("V4.1", resources))
+    primers = vcftagprimersites.read_bed_file(primer_bed)
+    for position in range(0, scheme.genome_length, 11):
+        for direction in ["+", "-"]:
+            assert scheme.find_primer(position, direction)[:2] == find_primer(primers, position, direction)[:2]
+
+
+def test_scheme_lookups(tmp_path):
+    amplicon_bed, primer_bed = beds("V3")
+    scheme = Scheme(bundled_scheme("V3", resources))
+    assert scheme.amplicons_at(30) == (1,)
+    # amplicons 1 and 2 overlap
+    assert scheme.amplicons_at(400) == (1, 2)
+    assert scheme.pool(1) != scheme.pool(2)
+    assert 1 in scheme.orf_amplicons("ORF1a")
+
+    # a custom scheme is compiled once into the cache, the bundle is used when the beds are the shipped ones
+    assert resolve_scheme(amplicon_bed, primer_bed, orf_bed, reference, str(tmp_path), bundled_scheme("V3", resources)) == bundled_scheme("V3", resources)
+    compiled = resolve_scheme(amplicon_bed, primer_bed, orf_bed, reference, str(tmp_path))
+    assert compiled.startswith(str(tmp_path)) and Scheme(compiled).primers == scheme.primers
+
+
+def test_scheme_validation(tmp_path):
+    amplicon_bed, primer_bed = beds("V3")
+    with open(primer_bed) as f:
+        lines = f.readlines()
+
+    # an amplicon with no RIGHT primer
+    broken = str(tmp_path / "primers.bed")
+    with open(broken, "w") as f:
+        f.writelines(line for line in lines if "_5_RIGHT" not in line)
+    with pytest.raises(ValueError, match="5"):
+        compile_scheme(amplicon_bed, broken, orf_bed, reference, str(tmp_path / "broken.pscheme"))
+
+    # a primer past the end of the reference
+    with open(broken, "w") as f:
+        f.writelines(lines + ["MN908947.3\t40000\t40020\tnCoV-2019_98_RIGHT\tnCoV-2019_2\n"])
+    with pytest.raises(ValueError):
+        compile_scheme(amplicon_bed, broken, orf_bed, reference, str(tmp_path / "broken.pscheme"))
+
+    with pytest.raises(ValueError, match="not a compiled periscope scheme"):
+        Scheme(primer_bed)
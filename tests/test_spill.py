@@ -0,0 +1,53 @@
+
+# with a memory budget the illumina reads are spilled to disk and merged back, the counts don't change
+
+import glob
+
+import pytest
+
+from periscope.spill import memory_plan, process_bytes
+
+
+def test_memory_plan():
+    plan = memory_plan(5 * (process_bytes + 10 ** 6), 4, 50000, "illumina")
+    assert plan["parent_bytes"] == 10 ** 6
+    assert plan["chunk_reads"] == 2000
+    assert memory_plan(5 * (process_bytes + 10 ** 6), 4, 50000, "ont")["chunk_reads"] == 50000
+    with pytest.raises(ValueError):
+        memory_plan(process_bytes, 4, 50000, "ont")
+
+
+def test_spilled_counts(simulated):
+    sample = simulated(4000, "illumina", seed=2)
+
+    def run(name, **options):
+        return sample.run(name, chunk_reads=500, **options)
+
+    in_memory = run("memory")
+    # a budget that holds about 600 reads in the parent
+    spilled = run("spilled", max_memory=3 * (process_bytes + 300000))
+
+    assert spilled.metrics["memory"]["spill_runs"] > 1
+    assert spilled.metrics["memory"]["spilled_reads"] > 0
+    assert spilled.counts == in_memory.counts
+    assert spilled.novel_counts == in_memory.novel_counts
+    # the pairs come back in another order, the amplicon of each is kept with it
+    def amplicon_rows(result):
+        return sorted(result.amplicons, key=lambda row: (row["amplicon"], row["orf"]))
+    assert amplicon_rows(spilled) == amplicon_rows(in_memory)
+    assert not glob.glob(sample.prefix + "_spilled_spill_*")
+
+
+def test_spilled_triage(simulated):
+    sample = simulated(4000, "illumina", seed=3, sgrna_fraction=0.3, novel_fraction=0.0)
+
+    def run(name, **options):
+        return sample.run(name, chunk_reads=500, target_precision=0.2, **options)
+
+    in_memory = run("memory")
+    # the rounds are spilled as they finish, the estimates and counts don't change
+    spilled = run("spilled", max_memory=3 * (process_bytes + 300000))
+    assert spilled.metrics["memory"]["spill_runs"] > 0
+    assert spilled.metrics["triage"]["fraction_processed"] == in_memory.metrics["triage"]["fraction_processed"]
+    assert spilled.counts == in_memory.counts
+    assert spilled.precision == in_memory.precision
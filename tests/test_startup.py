@@ -0,0 +1,46 @@
+
+# start-up budget for periscope, importing the entry point and the classifiers should not drag in the heavy
+# dependencies (snakemake, pairwise2, pybedtools, artic...) - these are only imported on the code path that needs them
+
+import os
+import subprocess
+import sys
+import time
+
+dirname = os.path.dirname(__file__)
+root = os.path.abspath(os.path.join(dirname, ".."))
+
+modules = ["periscope.periscope", "periscope.scripts.search_for_sgRNA_ont", "periscope.scripts.search_for_sgRNA_illumina"]
+heavy = ["snakemake", "Bio.pairwise2", "pybedtools", "artic", "numpy", "tqdm", "pandas"]
+
+# the whole interpreter start-up plus imports must fit in this many seconds
+budget = 1.0
+
+
+def run_python(code):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = root + os.pathsep + env.get("PYTHONPATH", "")
+    return subprocess.run([sys.executable, "-c", code], cwd=root, env=env, stdout=subprocess.PIPE, check=True, universal_newlines=True)
+
+
+def test_heavy_imports_are_deferred():
+    code = "import sys\n"
+    code += "".join("import {}\n".format(module) for module in modules)
+    code += "print(','.join(m for m in {} if m in sys.modules))".format(heavy)
+    loaded = run_python(code).stdout.strip()
+    assert loaded == ""
+
+
+def test_package_import_is_light():
+    # the package only holds constants and the lazy run(), setup.py imports it for the version
+    loaded = run_python("import sys\nimport periscope\nprint(','.join(sorted(m for m in sys.modules if m.startswith('periscope.'))))").stdout.strip()
+    assert loaded == ""
+
+
+def test_start_up_budget():
+    code = "".join("import {}\n".format(module) for module in modules)
+    # warm the bytecode cache so we measure imports rather than compilation
+    run_python(code)
+    start = time.time()
+    run_python(code)
+    assert time.time() - start < budget
@@ -0,0 +1,37 @@
+
+# the tagged bam policy only changes what is written, never the counts
+
+import os
+
+import pysam
+
+
+def tagged_classes(bam):
+    with pysam.AlignmentFile(bam) as f:
+        return [read.get_tag("XC") for read in f]
+
+
+def test_tagged_bam_policy(simulated):
+    sample = simulated(2000, "ont")
+
+    def run(name, **options):
+        return sample.run(name, chunk_reads=300, **options)
+
+    full = run("full")
+    none = run("none", tagged_bam="none")
+    sgrna = run("sgrna", tagged_bam="sgrna", grna_subsample=0.1, bam_compression=1)
+
+    assert none.counts == full.counts and sgrna.counts == full.counts
+    assert none.novel_counts == full.novel_counts and sgrna.novel_counts == full.novel_counts
+
+    assert "tagged_bam" not in none.outputs
+    assert not os.path.exists(sample.prefix + "_none_periscope.bam")
+
+    classes = tagged_classes(full.outputs["tagged_bam"])
+    classified = sum(stage["records"] for stage in full.metrics["stages"] if stage["name"] == "classification")
+    assert len(classes) == classified == full.metrics["tagged_bam"]["reads"]
+
+    kept = tagged_classes(sgrna.outputs["tagged_bam"])
+    assert [c for c in kept if c != "gRNA"] == [c for c in classes if c != "gRNA"]
+    grna = sum(1 for c in classes if c == "gRNA")
+    assert 0 < sum(1 for c in kept if c == "gRNA") < 0.2 * grna
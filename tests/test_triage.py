@@ -0,0 +1,89 @@
+
+# triage mode counts random chunks until the ratios are precise enough, and reports what it reached
+
+import glob
+import math
+
+import pysam
+
+from periscope.chunks import chunk_reads, make_chunks
+from periscope.triage import bucket_rounds, converged, default_floor, precision, read_round, round_bams, wilson_interval
+
+
+def test_wilson_interval():
+    lower, upper = wilson_interval(10, 100)
+    assert math.isclose(lower, 0.0552, abs_tol=1e-4) and math.isclose(upper, 0.1744, abs_tol=1e-4)
+    assert wilson_interval(0, 0) == (0.0, 1.0)
+    assert precision(0, 100) == math.inf
+    # four times the reads halves the interval
+    assert math.isclose(precision(400, 4000) / precision(100, 1000), 0.5, rel_tol=0.02)
+
+
+def test_converged_rare():
+    # no success and one success are settled by the same rule, once the whole interval is below the floor
+    for successes in [0, 1, 2]:
+        assert wilson_interval(successes, 2000)[1] < default_floor
+        assert converged(successes, 2000, 0.05)
+    # with few reads the interval is above the floor and too wide whether or not there is a success
+    assert wilson_interval(0, 20)[1] > default_floor
+    assert not converged(0, 20, 0.05) and not converged(1, 20, 0.05)
+    assert not converged(0, 0, 0.05)
+    # common estimates still need the target precision
+    assert not converged(100, 1000, 0.05) and converged(2000, 4000, 0.05)
+
+
+def test_triage_stops_early(simulated):
+    sample = simulated(20000, "illumina", sgrna_fraction=0.5, novel_fraction=0.0)
+
+    full = sample.run("full", chunk_reads=500)
+    triage = sample.run("triage", chunk_reads=500, target_precision=0.5)
+
+    report = triage.metrics["triage"]
+    assert report["converged"] == report["estimates"] > 0
+    assert report["fraction_processed"] < 1
+    assert all(row["converged"] for row in triage.precision)
+
+    # the normalised counts of the sample estimate those of the whole bam
+    full_sgRPHT = {row["orf"]: row["sgRPHT"] for row in full.counts}
+    for row in triage.counts:
+        assert abs(row["sgRPHT"] - full_sgRPHT[row["orf"]]) <= full_sgRPHT[row["orf"]] * 0.5 + 10
+
+
+def test_triage_runs_out_of_reads(simulated):
+    sample = simulated(2000, "ont", novel_fraction=0.02)
+    truth = sample.truth
+
+    # a precision that can't be reached counts every read, the counts are those of a full run
+    result = sample.run("out", chunk_reads=100, target_precision=0.001)
+    assert result.metrics["triage"]["fraction_processed"] == 1
+    assert result.metrics["triage"]["converged"] < result.metrics["triage"]["estimates"]
+    assert {row["orf"]: row["sgRNA_HQ_count"] for row in result.counts if row["sgRNA_HQ_count"]} == truth["sgRNA"]
+    with open(result.outputs["precision"]) as f:
+        assert f.readline().startswith("sample,kind,name")
+
+
+def test_bucket_rounds(simulated):
+    sample = simulated(2000, "illumina")
+    prefix = sample.prefix
+
+    # one pass writes every read to the bam of its round, the chunks of each round bam hold all of its reads
+    bams = round_bams(prefix)
+    totals = {}
+    chunks = bucket_rounds(prefix + ".bam", bams, 50, totals=totals)
+    assert len(chunks) == len(bams) == 20
+    names = []
+    for round_number, (bam, round_chunks) in enumerate(zip(bams, chunks)):
+        with pysam.AlignmentFile(bam) as inbamfile:
+            reads = [read for chunk in round_chunks for read in chunk_reads(inbamfile, chunk)]
+        assert all(read_round(read.query_name, 20) == round_number for read in reads)
+        assert len(reads) == sum(chunk[2] for chunk in round_chunks)
+        names.extend(read.query_name for read in reads)
+    with pysam.AlignmentFile(prefix + ".bam") as inbamfile:
+        assert sorted(names) == sorted(read.query_name for read in inbamfile)
+    chunking_totals = {}
+    make_chunks(prefix + ".bam", 50, totals=chunking_totals)
+    assert totals == chunking_totals
+
+    # a run leaves no round bams behind
+    sample.run("triage", chunk_reads=50, target_precision=0.5)
+    assert not glob.glob(prefix + "_triage_round_*")
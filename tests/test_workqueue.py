@@ -0,0 +1,85 @@
+
+# the shared filesystem work queue, with several `periscope worker` processes on this machine
+
+import csv
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from periscope import workqueue
+
+periscope_command = [sys.executable, "-c", "import sys; sys.argv[0] = 'periscope'; from periscope.periscope import main; main()"]
+
+
+@pytest.fixture
+def workers(tmp_path):
+    queue = str(tmp_path / "queue")
+    processes = [subprocess.Popen(periscope_command + ["worker", "--queue", queue, "--idle-exit", "120"])
+                 for _ in range(3)]
+    yield queue
+    workqueue.WorkQueue(queue).stop()
+    for process in processes:
+        assert process.wait(timeout=60) == 0
+
+
+def test_queue_counts(simulated, workers):
+    for technology in ["ont", "illumina"]:
+        sample = simulated(1500, technology, name=technology)
+
+        local = sample.run("local", chunk_reads=200)
+        with workqueue.QueueExecutor(workers, poll_seconds=0.1) as executor:
+            queued = sample.run("queue", chunk_reads=200, executor=executor)
+
+        assert queued.counts == local.counts
+        assert queued.novel_counts == local.novel_counts
+        # the chunks were spread over the workers
+        assert len({worker["pid"] for worker in queued.metrics["workers"]}) > 1
+
+    # nothing is left in the queue
+    assert not any(os.listdir(os.path.join(workers, name)) for name in ["tasks", "leases", "results"])
+
+    with workqueue.QueueExecutor(workers, poll_seconds=0.1) as executor:
+        # the workers' exceptions are raised in the coordinator
+        with pytest.raises(ValueError, match="invalid literal"):
+            executor.submit(int, "x").result()
+
+
+def test_distribute(tmp_path, simulated, workers):
+    sheet = str(tmp_path / "samples.csv")
+    with open(sheet, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["sample", "bam", "technology"])
+        for sample, seed in [("S1", 1), ("S2", 2)]:
+            writer.writerow([sample, simulated(1000, "ont", name=sample, seed=seed).bam, "ont"])
+
+    results, outputs = workqueue.distribute(workqueue.read_sample_sheet(sheet), workers, str(tmp_path / "plate"),
+                                            artic_primers="V3", chunk_reads=300)
+    assert [result.counts[0]["sample"] for result in results] == ["S1", "S2"]
+    with open(outputs["counts"]) as f:
+        rows = list(csv.DictReader(f))
+    assert rows == [{key: str(value) for key, value in row.items()} for result in results for row in result.counts]
+
+
+def test_expired_lease(tmp_path):
+    queue = workqueue.WorkQueue(str(tmp_path / "queue"), lease_seconds=10, max_attempts=2)
+    task_id = queue.submit(int, ["x"])
+
+    lease, func, args, _ = queue.claim()
+    assert (lease.task_id, lease.attempt, func, args) == (task_id, 0, int, ("x",))
+    # the lease is live, nobody else gets the task
+    assert queue.claim() is None
+
+    # the worker died, once its heartbeat is older than the lease time the task is claimed again
+    stale = time.time() - 60
+    os.utime(lease.path, (stale, stale))
+    retry = queue.claim()[0]
+    assert retry.attempt == 1 and lease.lost() and not retry.lost()
+
+    # and after max_attempts it is failed
+    os.utime(retry.path, (stale, stale))
+    assert queue.claim() is None
+    failed, error = queue.result(task_id)
+    assert failed and isinstance(error, workqueue.TaskFailed)